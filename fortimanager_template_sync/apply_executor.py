@@ -0,0 +1,245 @@
+"""Dependency aware executor of FMG write operations"""
+
+import asyncio
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, NamedTuple, Set, Tuple, Union
+
+from more_itertools import chunked
+
+from fortimanager_template_sync.exceptions import FMGSyncException
+from fortimanager_template_sync.fmg_api import AsyncFMGSync, BatchOperation, FMGSync
+from fortimanager_template_sync.fmg_api.operations import DEFAULT_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class ApplyNode(NamedTuple):
+    """Write operation with its dependencies
+
+    Attributes:
+        key: unique identifier of the node (e.g. ("template", "template1"))
+        operation: FMG write operation
+        depends_on: keys of the nodes which must succeed before this one
+    """
+
+    key: Hashable
+    operation: BatchOperation
+    depends_on: Tuple[Hashable, ...] = ()
+
+
+class ApplyResult(NamedTuple):
+    """Result of an executor run
+
+    Attributes:
+        succeeded: keys of the successful nodes
+        failed: error messages of the failed nodes by key
+        cancelled: keys of the nodes which were not run because a dependency failed
+    """
+
+    succeeded: Set[Hashable]
+    failed: Dict[Hashable, str]
+    cancelled: Set[Hashable]
+
+
+class ApplyExecutor:
+    """Run FMG write operations along their dependency graph
+
+    Nodes whose dependencies succeeded are ready. Ready nodes with the same JSON-RPC method are sent together in
+    batched requests, and independent batches run concurrently in a thread pool. The threads share the HTTP
+    connection pool of the FMG session. When a node fails, all nodes which depend on it directly or transitively are
+    cancelled, other nodes still run. With an asyncio connection `run_async` runs the batches as tasks of the event
+    loop instead of threads.
+
+    Attributes:
+        fmg (Union[FMGSync, AsyncFMGSync]): FMG connection
+        max_workers (int): maximum number of concurrent requests
+        batch_size (int): maximum number of operations in one request
+    """
+
+    def __init__(self, fmg: Union[FMGSync, AsyncFMGSync], max_workers: int = 1, batch_size: int = DEFAULT_BATCH_SIZE):
+        """Initialize executor
+
+        Args:
+            fmg: FMG connection
+            max_workers: maximum number of concurrent requests
+            batch_size: maximum number of operations in one request
+        """
+        self.fmg = fmg
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _build_graph(nodes: Dict[Hashable, ApplyNode]) -> Tuple[Dict[Hashable, List[Hashable]], Dict[Hashable, int]]:
+        """Build reverse dependencies and check the graph
+
+        Returns:
+            dependant node keys and number of dependencies by node key
+
+        Raises:
+            FMGSyncException: on unknown dependency or dependency loop
+        """
+        dependants: Dict[Hashable, List[Hashable]] = {key: [] for key in nodes}
+        waiting = {}
+        for node in nodes.values():
+            dependencies = set(node.depends_on)
+            unknown = dependencies - nodes.keys()
+            if unknown:
+                raise FMGSyncException(f"Unknown dependencies of {node.key}: {sorted(map(str, unknown))}")
+            waiting[node.key] = len(dependencies)
+            for dependency in dependencies:
+                dependants[dependency].append(node.key)
+        # topological sort to find loops
+        remaining = dict(waiting)
+        to_visit = [key for key, count in remaining.items() if not count]
+        while to_visit:
+            for dependant in dependants[to_visit.pop()]:
+                remaining[dependant] -= 1
+                if not remaining[dependant]:
+                    to_visit.append(dependant)
+        in_loop = [str(key) for key, count in remaining.items() if count]
+        if in_loop:
+            raise FMGSyncException(f"Dependency loop between {', '.join(in_loop)}")
+        return dependants, waiting
+
+    def _run_batch(self, batch: List[ApplyNode]) -> Dict[Hashable, str]:
+        """Execute a batch and return the errors by node key"""
+        try:
+            results = self.fmg.execute_batch([node.operation for node in batch], batch_size=self.batch_size)
+        except Exception as err:  # pylint: disable=broad-except  # whole request failed
+            return {node.key: str(err) for node in batch}
+        return self._batch_errors(batch, results)
+
+    async def _run_batch_async(self, batch: List[ApplyNode], slots: asyncio.Semaphore) -> Dict[Hashable, str]:
+        """Execute a batch on the asyncio connection and return the errors by node key"""
+        async with slots:
+            try:
+                results = await self.fmg.execute_batch([node.operation for node in batch], batch_size=self.batch_size)
+            except Exception as err:  # pylint: disable=broad-except  # whole request failed
+                return {node.key: str(err) for node in batch}
+        return self._batch_errors(batch, results)
+
+    @staticmethod
+    def _batch_errors(batch: List[ApplyNode], results: List[Tuple[BatchOperation, Any]]) -> Dict[Hashable, str]:
+        return {
+            node.key: str(response.data.get("error", response.data))
+            for node, (_, response) in zip(batch, results)
+            if not response.success
+        }
+
+    def _batches(self, graph: Dict[Hashable, ApplyNode], ready: List[Hashable]) -> Iterator[List[ApplyNode]]:
+        """Group ready nodes by method to batch them"""
+        by_method: Dict[str, List[ApplyNode]] = {}
+        for key in ready:
+            by_method.setdefault(graph[key].operation.method, []).append(graph[key])
+        for method_nodes in by_method.values():
+            yield from chunked(method_nodes, self.batch_size)
+
+    def _complete(
+        self,
+        batch: List[ApplyNode],
+        errors: Dict[Hashable, str],
+        dependants: Dict[Hashable, List[Hashable]],
+        waiting: Dict[Hashable, int],
+        result: ApplyResult,
+    ) -> List[Hashable]:
+        """Record result of a batch
+
+        Returns:
+            keys of the nodes which became ready
+        """
+        ready = []
+        for node in batch:
+            if node.key in errors:
+                result.failed[node.key] = errors[node.key]
+                self._cancel_dependants(node.key, dependants, result)
+                continue
+            result.succeeded.add(node.key)
+            for dependant in dependants[node.key]:
+                waiting[dependant] -= 1
+                if not waiting[dependant] and dependant not in result.cancelled:
+                    ready.append(dependant)
+        return ready
+
+    def run(self, nodes: Iterable[ApplyNode]) -> ApplyResult:
+        """Execute nodes
+
+        Args:
+            nodes: nodes to execute
+
+        Returns:
+            succeeded, failed and cancelled nodes
+
+        Raises:
+            FMGSyncException: on unknown dependency or dependency loop
+        """
+        graph = {node.key: node for node in nodes}
+        dependants, waiting = self._build_graph(graph)
+        result = ApplyResult(succeeded=set(), failed={}, cancelled=set())
+        ready = [key for key, count in waiting.items() if not count]
+        running: Dict[Future, List[ApplyNode]] = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fmg-apply") as pool:
+            while ready or running:
+                for batch in self._batches(graph, ready):
+                    running[pool.submit(self._run_batch, batch)] = batch
+                ready = []
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = running.pop(future)
+                    ready.extend(self._complete(batch, future.result(), dependants, waiting, result))
+        self._log_result(result)
+        return result
+
+    async def run_async(self, nodes: Iterable[ApplyNode]) -> ApplyResult:
+        """Execute nodes on the asyncio connection
+
+        At most `max_workers` batches are in flight at the same time.
+
+        Args:
+            nodes: nodes to execute
+
+        Returns:
+            succeeded, failed and cancelled nodes
+
+        Raises:
+            FMGSyncException: on unknown dependency or dependency loop
+        """
+        graph = {node.key: node for node in nodes}
+        dependants, waiting = self._build_graph(graph)
+        result = ApplyResult(succeeded=set(), failed={}, cancelled=set())
+        ready = [key for key, count in waiting.items() if not count]
+        running: Dict[asyncio.Task, List[ApplyNode]] = {}
+        slots = asyncio.Semaphore(self.max_workers)
+
+        while ready or running:
+            for batch in self._batches(graph, ready):
+                running[asyncio.ensure_future(self._run_batch_async(batch, slots))] = batch
+            ready = []
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                batch = running.pop(task)
+                ready.extend(self._complete(batch, task.result(), dependants, waiting, result))
+        self._log_result(result)
+        return result
+
+    @staticmethod
+    def _log_result(result: ApplyResult):
+        logger.debug(
+            "Applied %d operations, %d failed, %d cancelled",
+            len(result.succeeded),
+            len(result.failed),
+            len(result.cancelled),
+        )
+
+    @staticmethod
+    def _cancel_dependants(key: Hashable, dependants: Dict[Hashable, List[Hashable]], result: ApplyResult):
+        """Cancel all nodes depending on the failed node"""
+        to_cancel = list(dependants[key])
+        while to_cancel:
+            dependant = to_cancel.pop()
+            if dependant in result.cancelled:
+                continue
+            result.cancelled.add(dependant)
+            logger.warning("Skipping %s as its dependency %s failed", dependant, key)
+            to_cancel.extend(dependants[dependant])
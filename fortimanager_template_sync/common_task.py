@@ -1,11 +1,17 @@
+import asyncio
 import logging
-from typing import Any, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
 
+from more_itertools import chunked
 from pyfortinet.fmg_api.common import F, FilterList
 
 from fortimanager_template_sync.config import FMGSyncSettings
+from fortimanager_template_sync.device_groups import DeviceGroupIndex
 from fortimanager_template_sync.exceptions import FMGSyncInvalidStatusException
-from fortimanager_template_sync.fmg_api import FMGSync
+from fortimanager_template_sync.fmg_api import AsyncFMGSync, FMGSync
+from fortimanager_template_sync.status_cache import StatusCache, Statuses
 
 logger = logging.getLogger(__name__)
 
@@ -63,34 +69,175 @@ CONF_STATUS = {
     "outofsync": "outofsync",
 }
 
+# device group indexes by (FMG URL, ADOM), kept for the process lifetime
+DEVICE_GROUP_INDEXES: Dict[Tuple[str, str], DeviceGroupIndex] = {}
+# device status caches by snapshot file (None: in memory only), kept for the process lifetime
+STATUS_CACHES: Dict[Optional[Path], StatusCache] = {}
+
 
 class CommonTask:
     """Common task functionalities"""
 
-    def __init__(self, settings: FMGSyncSettings, fmg: Optional[FMGSync] = None):
+    def __init__(self, settings: FMGSyncSettings, fmg: Optional[Union[FMGSync, AsyncFMGSync]] = None):
         """Initialize task
 
         Args:
             settings: task settings
-            fmg: FMG connection if there is any
+            fmg: FMG connection if there is any, async entry points need an `AsyncFMGSync` connection
         """
         self.settings = settings
         self.fmg = fmg
 
+    def _connect(self) -> FMGSync:
+        """Open FMG connection"""
+        return FMGSync(
+            base_url=self.settings.fmg_url,
+            username=self.settings.fmg_user,
+            password=self.settings.fmg_pass,
+            adom=self.settings.fmg_adom,
+            verify=self.settings.fmg_verify,
+        ).open()
+
+    async def _connect_async(self) -> AsyncFMGSync:
+        """Open asyncio FMG connection"""
+        return await AsyncFMGSync(
+            base_url=self.settings.fmg_url,
+            username=self.settings.fmg_user,
+            password=self.settings.fmg_pass,
+            adom=self.settings.fmg_adom,
+            verify=self.settings.fmg_verify,
+        ).open()
+
+    def _device_group_index(self) -> DeviceGroupIndex:
+        """Get the device group index of the ADOM, the groups are loaded once per process"""
+        key = (str(self.settings.fmg_url), self.settings.fmg_adom)
+        if key not in DEVICE_GROUP_INDEXES:
+            DEVICE_GROUP_INDEXES[key] = DeviceGroupIndex(
+                self.fmg.iter_device_groups(page_size=self.settings.fmg_page_size)
+            )
+        return DEVICE_GROUP_INDEXES[key]
+
+    async def _device_group_index_async(self) -> DeviceGroupIndex:
+        """Get the device group index of the ADOM on the asyncio connection, see `_device_group_index`"""
+        key = (str(self.settings.fmg_url), self.settings.fmg_adom)
+        if key not in DEVICE_GROUP_INDEXES:
+            DEVICE_GROUP_INDEXES[key] = DeviceGroupIndex(
+                [group async for group in self.fmg.iter_device_groups(page_size=self.settings.fmg_page_size)]
+            )
+        return DEVICE_GROUP_INDEXES[key]
+
+    def _status_cache(self) -> Optional[StatusCache]:
+        """Get the device status cache if it's enabled"""
+        if self.settings.status_cache_ttl <= 0:
+            return None
+        path = self.settings.cache_dir / "device-status.json" if self.settings.status_snapshot else None
+        return STATUS_CACHES.setdefault(path, StatusCache(path))
+
+    def _status_cache_key(self, group: str) -> str:
+        return f"{self.settings.fmg_url}|{self.settings.fmg_adom}|{group}"
+
+    def _cached_firewall_statuses(self, group: str) -> Optional[Statuses]:
+        """Get statuses of the group from the cache if they are not older than `status_cache_ttl`"""
+        cache = self._status_cache()
+        if cache is None:
+            return None
+        statuses = cache.get(self._status_cache_key(group), ttl=self.settings.status_cache_ttl)
+        if statuses is not None:
+            logger.info("Using cached firewall statuses of group '%s'", group)
+        return statuses
+
+    def _cache_firewall_statuses(self, group: str, statuses: Statuses):
+        cache = self._status_cache()
+        if cache is not None:
+            cache.put(self._status_cache_key(group), statuses)
+
+    def _invalidate_firewall_statuses(self, group: str):
+        """Drop cached statuses of the group, it must be called after changes which affect device statuses"""
+        cache = self._status_cache()
+        if cache is not None:
+            cache.invalidate(self._status_cache_key(group))
+
     def _get_firewall_statuses(self, group: str) -> Dict[str, Dict[str, Any]]:
-        """Gather firewall statuses in the specified group"""
+        """Gather firewall statuses in the specified group
+
+        Devices of sub-groups are included. Statuses are reused for `status_cache_ttl` seconds.
+        """
+        statuses = self._cached_firewall_statuses(group)
+        if statuses is not None:
+            return statuses
         logger.info("Gathering firewall statuses in group '%s'", group)
-        statuses = {}
-        device_list = self.fmg.get_group_members(group_name=group)
-        if "object member" not in device_list.data.get("data", {}):
+        devices = self._device_group_index().devices(group)
+        if not devices:
             logger.debug("No devices found in group '%s'", group)
+        statuses = self._get_device_statuses(devices)
+        self._cache_firewall_statuses(group, statuses)
+        return statuses
+
+    async def _get_firewall_statuses_async(self, group: str) -> Dict[str, Dict[str, Any]]:
+        """Gather firewall statuses in the specified group on the asyncio connection, see `_get_firewall_statuses`"""
+        statuses = self._cached_firewall_statuses(group)
+        if statuses is not None:
             return statuses
-        filters = FilterList()
-        for device in device_list.data.get("data", {}).get("object member"):
-            filters += F(name=device["name"])
-        logger.debug("Found %d devices", len(filters))
-        device_list = self.fmg.get_devices(filters=filters)
-        for device_status in device_list.data.get("data"):
+        logger.info("Gathering firewall statuses in group '%s'", group)
+        devices = (await self._device_group_index_async()).devices(group)
+        if not devices:
+            logger.debug("No devices found in group '%s'", group)
+        statuses = await self._get_device_statuses_async(devices)
+        self._cache_firewall_statuses(group, statuses)
+        return statuses
+
+    def _get_device_statuses(self, devices: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Gather statuses of the devices
+
+        Devices are loaded in chunks of `status_chunk_size` devices by `status_workers` concurrent requests.
+        """
+        filters = self._device_filters(devices)
+        workers = min(self.settings.status_workers, len(filters))
+        if workers > 1:
+            self.fmg.set_connection_pool_size(workers)
+        statuses = {}
+        with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="fmg-status") as pool:
+            for response in pool.map(lambda chunk: self.fmg.get_devices(filters=chunk), filters):
+                statuses.update(self._parse_firewall_statuses(response.data))
+        return statuses
+
+    async def _get_device_statuses_async(self, devices: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Gather statuses of the devices on the asyncio connection, see `_get_device_statuses`"""
+        slots = asyncio.Semaphore(max(self.settings.status_workers, 1))
+
+        async def get_devices(chunk: FilterList):
+            async with slots:
+                return await self.fmg.get_devices(filters=chunk)
+
+        statuses = {}
+        for response in await asyncio.gather(*(get_devices(chunk) for chunk in self._device_filters(devices))):
+            statuses.update(self._parse_firewall_statuses(response.data))
+        return statuses
+
+    def _device_filters(self, devices: List[str]) -> List[FilterList]:
+        """Build device filters
+
+        Returns:
+            filters of at most `status_chunk_size` devices
+        """
+        logger.debug("Getting status of %d devices", len(devices))
+        filters = []
+        for chunk in chunked(devices, max(self.settings.status_chunk_size, 1)):
+            chunk_filter = FilterList()
+            for device in chunk:
+                chunk_filter += F(name=device)
+            filters.append(chunk_filter)
+        return filters
+
+    @staticmethod
+    def _parse_firewall_statuses(device_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Get statuses and CLI template assignments of devices
+
+        Raises:
+            FMGSyncInvalidStatusException: if a device has unknown status
+        """
+        statuses = {}
+        for device_status in device_data.get("data"):
             statuses[device_status["name"]] = {
                 "conf_status": CONF_STATUS.get(device_status["conf_status"]),
                 "db_status": DB_STATUS.get(device_status["db_status"]),
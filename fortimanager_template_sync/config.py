@@ -1,8 +1,8 @@
 """Configuration model"""
 from pathlib import Path
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import AnyHttpUrl, SecretStr, field_validator
+from pydantic import AnyHttpUrl, Field, SecretStr, field_validator
 from pydantic_core import Url
 from pydantic_core.core_schema import ValidationInfo
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -15,13 +15,35 @@ class FMGSyncSettings(BaseSettings):
     template_repo: str
     template_branch: str
     local_repo: Path
+    repo_mode: Literal["worktree", "bare"] = "worktree"  # bare: read templates from git objects, no checkout
+    git_depth: Optional[int] = None  # shallow clone/fetch with this many commits
+    git_single_branch: bool = False  # clone/fetch template branch only
+    git_filter: Optional[str] = None  # partial clone filter, e.g. blob:none
+    git_sparse: bool = False  # check out template folders only
+    cache_dir: Optional[Path] = Field(None, validate_default=True)  # defaults to a folder next to local_repo
+    parse_cache: bool = True
+    parse_cache_size: int = 10000  # max number of cached files
+    parse_workers: int = 1  # number of processes to parse templates
     fmg_url: str
     fmg_user: str
     fmg_pass: SecretStr
     fmg_adom: str
     fmg_verify: bool = True
+    fmg_page_size: int = 1000
+    fmg_batch_size: int = 50
+    apply_workers: int = 1
+    status_chunk_size: int = 200
+    status_workers: int = 4
+    status_cache_ttl: int = 0  # reuse device statuses for this many seconds, 0 disables the cache
+    status_snapshot: bool = False  # share cached device statuses between runs in cache_dir
+    deploy_wave_size: int = 0  # number of firewall/VDOMs in one install task, 0: all in one task
+    deploy_canary_size: int = 0  # number of firewall/VDOMs to install first in a separate wave
+    deploy_workers: int = 1  # number of concurrent install tasks in a wave
+    deploy_fail_rate: float = 1.0  # stop after a wave if more installs failed (0-1)
     protected_fw_group: str
     delete_unused_templates: bool = False
+    incremental_sync: bool = False
+    sync_state_ttl: int = 0
     prod_run: bool = False
 
     model_config = SettingsConfigDict(
@@ -56,3 +78,11 @@ class FMGSyncSettings(BaseSettings):
         """ensure local repo exists"""
         path.mkdir(exist_ok=True)
         return path
+
+    @field_validator("cache_dir", mode="after")
+    def default_cache_dir(cls, path: Optional[Path], info: ValidationInfo):
+        """put cache next to local repo by default"""
+        if path is None and info.data.get("local_repo"):
+            local_repo: Path = info.data["local_repo"]
+            path = local_repo.absolute().parent / f".{local_repo.absolute().name}-cache"
+        return path
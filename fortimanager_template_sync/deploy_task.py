@@ -1,17 +1,61 @@
 """FW deployment task"""
 
+import asyncio
 import logging
-from typing import List, Dict, Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Iterable, NamedTuple, Optional, Tuple
 
-from pyfortinet.fmg_api.common import Scope
+from more_itertools import chunked
+from pyfortinet.fmg_api.common import F, Scope
 from pyfortinet.fmg_api.securityconsole import InstallDeviceTask
+from pyfortinet.fmg_api.task import Task, TaskLine
 
 from fortimanager_template_sync.common_task import CommonTask
 from fortimanager_template_sync.exceptions import FMGSyncInvalidStatusException
-from fortimanager_template_sync.fmg_api import FMGSync
 
 logger = logging.getLogger("fortimanager_template_sync.deploy_task")
 
+# install task line states of installed scopes
+INSTALLED_STATES = ("done", "warning")
+# install state of scopes without install task line
+UNKNOWN_STATE = "unknown"
+# upper limit of concurrent install tasks, more tasks would just queue up in FMG
+MAX_CONCURRENT_INSTALLS = 4
+
+
+class ScopeResult(NamedTuple):
+    """Deployment result of a firewall VDOM
+
+    Attributes:
+        device: firewall name
+        vdom: VDOM name
+        install_state: state of the install task line of the scope, "unknown" if the task didn't report it
+        detail: last message of the install task line
+        modified: CLI template status is still modified after installation, None if it wasn't verified
+    """
+
+    device: str
+    vdom: str
+    install_state: str = UNKNOWN_STATE
+    detail: str = ""
+    modified: Optional[bool] = None
+
+    @property
+    def success(self) -> bool:
+        """Check if the scope was installed and its templates are not modified anymore
+
+        Without install task line the template status alone decides.
+        """
+        if self.install_state == UNKNOWN_STATE:
+            return self.modified is False
+        return self.install_state in INSTALLED_STATES and self.modified is False
+
+    @property
+    def install_failed(self) -> bool:
+        """Check if the install task reported a failure of the scope"""
+        return self.install_state not in (*INSTALLED_STATES, UNKNOWN_STATE)
+
 
 class FMGDeployTask(CommonTask):
     """
@@ -21,11 +65,11 @@ class FMGDeployTask(CommonTask):
 
         1. check firewall statuses
         2. deploy changes to firewalls in protected group only
-        3. check firewall statuses again
+        3. check status of the installed firewall VDOMs again
 
     Attributes:
         settings (FMGSyncSettings): task settings to use
-        fmg (FMGSync): FMG instance
+        fmg (Union[FMGSync, AsyncFMGSync]): FMG instance, `run_async` needs an `AsyncFMGSync` connection
     """
 
     def run(self) -> bool:
@@ -37,13 +81,7 @@ class FMGDeployTask(CommonTask):
         success = True
         try:
             if not self.fmg:
-                self.fmg = FMGSync(
-                    base_url=self.settings.fmg_url,
-                    username=self.settings.fmg_user,
-                    password=self.settings.fmg_pass,
-                    adom=self.settings.fmg_adom,
-                    verify=self.settings.fmg_verify,
-                ).open()
+                self.fmg = self._connect()
             # 1. check firewall statuses
             statuses = self._get_firewall_statuses(self.settings.protected_fw_group)
 
@@ -52,22 +90,74 @@ class FMGDeployTask(CommonTask):
 
             # 3. deploy changes to firewalls in protected group only
             if to_deploy:
-                self._deploy_changes(to_deploy)
+                if self.settings.prod_run:
+                    self._invalidate_firewall_statuses(self.settings.protected_fw_group)
+                results = self._deploy_changes(to_deploy)
 
-            # 4. check firewall statuses again
+            # 4. check status of the installed firewall VDOMs again
             if self.settings.prod_run and to_deploy:
-                statuses = self._get_firewall_statuses(self.settings.protected_fw_group)
-                to_deploy = self._get_deployable_firewalls(statuses)
-                if to_deploy:
-                    logger.warning("The following firewalls are still not updated: %s", list(to_deploy.keys()))
+                results = self._verify_deployment(results)
+                logger.info("Deployment results:\n%s", self._format_results(results.values()))
+                failed = [f"{device}/{vdom}" for (device, vdom), result in results.items() if not result.success]
+                if failed:
+                    logger.warning("The following firewalls are still not updated: %s", failed)
                     success = False
                 else:
                     logger.info("CLI template install task ran successfully")
             else:
                 logger.info("No checking required")
+        except Exception as err:
+            logger.error(err)
+            success = False
         finally:
-            self.fmg.close()
-            return success
+            if self.fmg:
+                self.fmg.close()
+        return success
+
+    async def run_async(self) -> bool:
+        """Run deployment task on an asyncio FMG connection
+
+        Same as `run`, but status checks and install task polling don't block the event loop, so multiple tasks can
+        run concurrently in one thread.
+
+        Returns:
+            (bool): True if task succeeded, False otherwise
+        """
+        success = True
+        try:
+            if not self.fmg:
+                self.fmg = await self._connect_async()
+            # 1. check firewall statuses
+            statuses = await self._get_firewall_statuses_async(self.settings.protected_fw_group)
+
+            # 2. find firewalls with applicable status
+            to_deploy = self._get_deployable_firewalls(statuses)
+
+            # 3. deploy changes to firewalls in protected group only
+            if to_deploy:
+                if self.settings.prod_run:
+                    self._invalidate_firewall_statuses(self.settings.protected_fw_group)
+                results = await self._deploy_changes_async(to_deploy)
+
+            # 4. check status of the installed firewall VDOMs again
+            if self.settings.prod_run and to_deploy:
+                results = await self._verify_deployment_async(results)
+                logger.info("Deployment results:\n%s", self._format_results(results.values()))
+                failed = [f"{device}/{vdom}" for (device, vdom), result in results.items() if not result.success]
+                if failed:
+                    logger.warning("The following firewalls are still not updated: %s", failed)
+                    success = False
+                else:
+                    logger.info("CLI template install task ran successfully")
+            else:
+                logger.info("No checking required")
+        except Exception as err:
+            logger.error(err)
+            success = False
+        finally:
+            if self.fmg:
+                await self.fmg.close()
+        return success
 
     @staticmethod
     def _get_deployable_firewalls(statuses: Dict[str, Dict[str, Any]]) -> Dict[str, List[str]]:
@@ -117,15 +207,265 @@ class FMGDeployTask(CommonTask):
         for fw, status in statuses.items():
             if status.get("conf_status") == "outofsync" or status.get("db_status") == "mod":
                 raise FMGSyncInvalidStatusException(f"Firewall {fw} has modified configuration or database")
-            modified_vdoms = [vdom for vdom in status.get("cli_status") if status["cli_status"][vdom].get("status") == "modified"]
+            modified_vdoms = [
+                vdom for vdom in status.get("cli_status") if status["cli_status"][vdom].get("status") == "modified"
+            ]
             if modified_vdoms:
                 to_deploy[fw] = modified_vdoms
                 num_of_vdoms += len(to_deploy[fw])
         logger.info(f"Found {num_of_vdoms} firewall/VDOMs to deploy")
         return to_deploy
 
-    def _deploy_changes(self, to_deploy: Dict[str, List[str]]):
-        """Deploy changes to firewalls"""
+    def _deploy_changes(self, to_deploy: Dict[str, List[str]]) -> Dict[Tuple[str, str], ScopeResult]:
+        """Deploy changes to firewalls in waves
+
+        Every wave runs up to `deploy_workers` install tasks of `deploy_wave_size` scopes concurrently, an optional
+        canary wave of `deploy_canary_size` scopes goes first. Deployment stops if the failure rate of the installed
+        scopes exceeds `deploy_fail_rate`, the remaining scopes are skipped.
+
+        Concurrent install tasks would compete for the workspace lock, so in workspace mode the ADOM is locked once
+        before the first wave and kept locked until the connection is closed.
+
+        Returns:
+            install results by (firewall, VDOM), empty on test run
+        """
+        scopes = self._deploy_scopes(to_deploy)
+        if not scopes:
+            return {}
+        waves = self._waves(scopes)
+        workers = max(len(wave) for wave in waves)
+        if workers > 1:
+            self.fmg.set_connection_pool_size(workers)
+            self.fmg.lock(self.fmg.adom)
+        results = {}
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fmg-install") as pool:
+            for number, wave in enumerate(waves, start=1):
+                start = time.monotonic()
+                wave_results = {}
+                for batch_results in pool.map(self._install, wave):
+                    wave_results.update(batch_results)
+                results.update(wave_results)
+                if self._wave_done(number, waves, wave_results, results, time.monotonic() - start):
+                    break
+        return results
+
+    async def _deploy_changes_async(self, to_deploy: Dict[str, List[str]]) -> Dict[Tuple[str, str], ScopeResult]:
+        """Deploy changes to firewalls in waves on the asyncio connection, see `_deploy_changes`"""
+        scopes = self._deploy_scopes(to_deploy)
+        if not scopes:
+            return {}
+        waves = self._waves(scopes)
+        if max(len(wave) for wave in waves) > 1:
+            await self.fmg.lock(self.fmg.adom)
+        results = {}
+        for number, wave in enumerate(waves, start=1):
+            start = time.monotonic()
+            wave_results = {}
+            for batch_results in await asyncio.gather(*(self._install_async(batch) for batch in wave)):
+                wave_results.update(batch_results)
+            results.update(wave_results)
+            if self._wave_done(number, waves, wave_results, results, time.monotonic() - start):
+                break
+        return results
+
+    def _install(self, scopes: List[Scope]) -> Dict[Tuple[str, str], ScopeResult]:
+        """Run an install task and get the results of its scopes"""
+        result = self._install_task(scopes).exec()
+        lines = []
+        if result.success:
+            logger.info(f"Running install for {len(scopes)} items")
+            try:
+                result.wait_for_task(timeout=len(scopes) * 120, callback=self._install_log_callback())
+            except TimeoutError as err:
+                logger.error(err)
+            task_id = self._task_id(result)
+            if task_id is not None:
+                lines = self._task_lines(self.fmg.get(Task, F(id=task_id)).first())
+        else:
+            logger.error(f"Error by installation: {result.data}")
+        return self._install_results(scopes, lines)
+
+    async def _install_async(self, scopes: List[Scope]) -> Dict[Tuple[str, str], ScopeResult]:
+        """Run an install task on the asyncio connection and get the results of its scopes"""
+        result = await self._install_task(scopes).exec()
+        lines = []
+        if result.success:
+            logger.info(f"Running install for {len(scopes)} items")
+            try:
+                await result.wait_for_task(timeout=len(scopes) * 120, callback=self._install_log_callback())
+            except TimeoutError as err:
+                logger.error(err)
+            task_id = self._task_id(result)
+            if task_id is not None:
+                lines = self._task_lines((await self.fmg.get(Task, F(id=task_id))).first())
+        else:
+            logger.error(f"Error by installation: {result.data}")
+        return self._install_results(scopes, lines)
+
+    def _waves(self, scopes: List[Scope]) -> List[List[List[Scope]]]:
+        """Split scopes into waves of concurrent install task scopes"""
+        canary_size = max(self.settings.deploy_canary_size, 0)
+        wave_size = self.settings.deploy_wave_size if self.settings.deploy_wave_size > 0 else len(scopes)
+        workers = min(max(self.settings.deploy_workers, 1), MAX_CONCURRENT_INSTALLS)
+        waves = [[scopes[:canary_size]]] if canary_size else []
+        waves.extend(chunked(chunked(scopes[canary_size:], wave_size), workers))
+        return waves
+
+    def _wave_done(
+        self,
+        number: int,
+        waves: List[List[List[Scope]]],
+        wave_results: Dict[Tuple[str, str], ScopeResult],
+        results: Dict[Tuple[str, str], ScopeResult],
+        duration: float,
+    ) -> bool:
+        """Log throughput of a finished wave and check the failure rate
+
+        Scopes of the remaining waves are added to the results as skipped if the deployment has to stop.
+
+        Returns:
+            True if the deployment has to stop
+        """
+        failed = sum(result.install_failed for result in wave_results.values())
+        logger.info(
+            "Wave %d/%d: installed %d firewall/VDOMs in %d tasks, %d failed, %.1fs (%.2f firewall/VDOMs per second)",
+            number,
+            len(waves),
+            len(wave_results),
+            len(waves[number - 1]),
+            failed,
+            duration,
+            len(wave_results) / duration if duration else 0.0,
+        )
+        all_failed = sum(result.install_failed for result in results.values())
+        failure_rate = all_failed / len(results)
+        if number == len(waves) or failure_rate <= self.settings.deploy_fail_rate:
+            return False
+        logger.error(
+            "Stopping deployment, failure rate %.0f%% is over the %.0f%% limit",
+            failure_rate * 100,
+            self.settings.deploy_fail_rate * 100,
+        )
+        for wave in waves[number:]:
+            for batch in wave:
+                for scope in batch:
+                    results[(scope.name, scope.vdom)] = ScopeResult(
+                        device=scope.name, vdom=scope.vdom, install_state="skipped", detail="deployment stopped"
+                    )
+        return True
+
+    @staticmethod
+    def _task_id(result: Any) -> Optional[int]:
+        data = result.data.get("data") or {}
+        return data.get("taskid") or data.get("task")
+
+    @staticmethod
+    def _task_lines(task: Optional[Task]) -> List[TaskLine]:
+        if task is None:
+            logger.warning("Install task is not found, results of the firewalls are unknown")
+            return []
+        return task.line or []
+
+    @staticmethod
+    def _install_results(scopes: List[Scope], lines: Iterable[TaskLine]) -> Dict[Tuple[str, str], ScopeResult]:
+        """Get install result of each firewall VDOM from the install task lines
+
+        A line without VDOM applies to all VDOMs of the firewall.
+
+        Args:
+            scopes: installed firewall VDOMs
+            lines: lines of the install task
+
+        Returns:
+            install results by (firewall, VDOM)
+        """
+        lines_by_scope = {(line.name, line.vdom): line for line in lines}
+        results = {}
+        for scope in scopes:
+            line = lines_by_scope.get((scope.name, scope.vdom)) or lines_by_scope.get((scope.name, None))
+            if line is None:
+                results[(scope.name, scope.vdom)] = ScopeResult(device=scope.name, vdom=scope.vdom)
+            else:
+                results[(scope.name, scope.vdom)] = ScopeResult(
+                    device=scope.name, vdom=scope.vdom, install_state=line.state, detail=line.detail or ""
+                )
+        return results
+
+    def _verify_deployment(self, results: Dict[Tuple[str, str], ScopeResult]) -> Dict[Tuple[str, str], ScopeResult]:
+        """Check CLI template status of the installed firewall VDOMs
+
+        Only the installed firewalls are queried, not the whole protected group.
+
+        Returns:
+            install results with template status
+        """
+        return self._verified_results(results, self._get_device_statuses(sorted({device for device, _ in results})))
+
+    async def _verify_deployment_async(
+        self, results: Dict[Tuple[str, str], ScopeResult]
+    ) -> Dict[Tuple[str, str], ScopeResult]:
+        """Check CLI template status of the installed firewall VDOMs on the asyncio connection"""
+        statuses = await self._get_device_statuses_async(sorted({device for device, _ in results}))
+        return self._verified_results(results, statuses)
+
+    @staticmethod
+    def _verified_results(
+        results: Dict[Tuple[str, str], ScopeResult], statuses: Dict[str, Dict[str, Any]]
+    ) -> Dict[Tuple[str, str], ScopeResult]:
+        verified = {}
+        for (device, vdom), result in results.items():
+            if device in statuses:
+                cli_status = statuses[device]["cli_status"].get(vdom, {})
+                verified[(device, vdom)] = result._replace(modified=cli_status.get("status") == "modified")
+            else:
+                verified[(device, vdom)] = result
+        return verified
+
+    @staticmethod
+    def _format_results(results: Iterable[ScopeResult]) -> str:
+        """Format deployment results as a table"""
+        template_status = {None: "unknown", True: "modified", False: "installed"}
+        rows = [("FIREWALL", "VDOM", "INSTALL", "TEMPLATES", "DETAIL")]
+        rows.extend(
+            (result.device, result.vdom, result.install_state, template_status[result.modified], result.detail)
+            for result in results
+        )
+        widths = [max(len(row[column]) for row in rows) for column in range(4)]
+        return "\n".join(
+            "  ".join([*(value.ljust(width) for value, width in zip(row, widths)), row[4]]).rstrip() for row in rows
+        )
+
+    def _deploy_scopes(self, to_deploy: Dict[str, List[str]]) -> List[Scope]:
+        """Get the firewall VDOMs to install
+
+        Returns:
+            install scopes, empty if there is nothing to install or it is a test run
+        """
+        scopes = []
+        for fw, vdoms in to_deploy.items():
+            for vdom in vdoms:
+                scopes.append(Scope(name=fw, vdom=vdom))
+        if not scopes:
+            logger.info("No firewalls/VDOMs to install templates to")
+            return []
+        if not self.settings.prod_run:
+            logger.info("TEST - to deploy to %s", to_deploy)
+            return []
+        return scopes
+
+    def _install_task(self, scopes: List[Scope]) -> InstallDeviceTask:
+        """Build install task of the firewall VDOMs
+
+        The task locks the workspace itself unless the ADOM is already locked for concurrent install tasks.
+        """
+        logger.debug(f"Deploying to {scopes}")
+        flags = ["none"] if self.fmg.adom in self.fmg.lock.locked_adoms else ["auto_lock_ws"]
+        return self.fmg.get_obj(InstallDeviceTask, adom=self.fmg.adom, flags=flags, scope=scopes)
+
+    @staticmethod
+    def _install_log_callback() -> Callable[[int, str], None]:
+        """Get callback which logs install progress changes"""
+
         def log_install(percent, log):
             nonlocal last_log, last_percent
             if percent == last_percent and last_log == log:
@@ -136,22 +476,4 @@ class FMGDeployTask(CommonTask):
 
         last_log = ""
         last_percent = 0
-        scopes = []
-        for fw, vdoms in to_deploy.items():
-            for vdom in vdoms:
-                scopes.append(Scope(name=fw, vdom=vdom))
-        if scopes:
-            if not self.settings.prod_run:
-                logger.info("TEST - to deploy to %s", to_deploy)
-                return
-            logger.debug(f"Deploying to {scopes}")
-            task = self.fmg.get_obj(InstallDeviceTask, adom=self.fmg.adom, flags=["auto_lock_ws"], scope=scopes)
-            result = task.exec()
-            if result.success:
-                logger.info(f"Running install for {len(scopes)} items")
-                result.wait_for_task(timeout=len(scopes)*120,
-                                     callback=log_install)
-            else:
-                logger.error(f"Error by installation: {result.data}")
-        else:
-            logger.info("No firewalls/VDOMs to install templates to")
+        return log_install
@@ -0,0 +1,66 @@
+"""Membership index of FMG device groups"""
+
+import logging
+from typing import Any, Dict, Iterable, List, Tuple
+
+from fortimanager_template_sync.exceptions import FMGSyncException
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceGroupIndex:
+    """Device and sub-group members of FMG device groups
+
+    The index is built from the group table of the ADOM. A member which is the name of a group is a sub-group,
+    every other member is a device. Resolved device lists are cached in the index.
+
+    Attributes:
+        members (Dict[str, List[str]]): direct member names by group name
+    """
+
+    def __init__(self, groups: Iterable[Dict[str, Any]]):
+        """Build index
+
+        Args:
+            groups: device group data as FMG returns it with the "object member" option
+        """
+        self.members: Dict[str, List[str]] = {
+            group["name"]: [member["name"] for member in group.get("object member") or []] for group in groups
+        }
+        self._devices: Dict[str, List[str]] = {}
+        logger.debug("Indexed %d device groups", len(self.members))
+
+    def __contains__(self, group: str) -> bool:
+        return group in self.members
+
+    def devices(self, group: str) -> List[str]:
+        """Get devices of a group including the devices of its sub-groups
+
+        Args:
+            group: device group name
+
+        Returns:
+            device names in member order without duplicates
+
+        Raises:
+            FMGSyncException: if the group doesn't exist or groups contain each other
+        """
+        if group not in self.members:
+            raise FMGSyncException(f"Device group '{group}' doesn't exist")
+        if group not in self._devices:
+            self._devices[group] = list(self._resolve(group, (group,)))
+        return self._devices[group]
+
+    def _resolve(self, group: str, path: Tuple[str, ...]) -> Dict[str, None]:
+        """Resolve devices of a group along the path of parent groups (ordered set)"""
+        devices: Dict[str, None] = {}
+        for member in self.members[group]:
+            if member not in self.members:
+                devices[member] = None
+            elif member in path:
+                raise FMGSyncException(f"Device group loop: {' -> '.join((*path, member))}")
+            elif member in self._devices:
+                devices.update(dict.fromkeys(self._devices[member]))
+            else:
+                devices.update(self._resolve(member, (*path, member)))
+        return devices
@@ -1,5 +1,7 @@
 """FMG API extension"""
 
+from fortimanager_template_sync.fmg_api.async_connection import AsyncFMGSync
 from fortimanager_template_sync.fmg_api.connection import FMGSync
+from fortimanager_template_sync.fmg_api.operations import BatchOperation
 
-__all__ = ("FMGSync",)
+__all__ = ("AsyncFMGSync", "BatchOperation", "FMGSync")
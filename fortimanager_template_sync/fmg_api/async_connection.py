@@ -0,0 +1,389 @@
+"""Asyncio FMG connection"""
+
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+from pyfortinet import AsyncFMG, AsyncFMGResponse
+from pyfortinet.exceptions import (
+    FMGAuthenticationException,
+    FMGEmptyResultException,
+    FMGLockNeededException,
+    FMGTokenException,
+)
+from pyfortinet.fmg_api.common import FILTER_TYPE
+from pyfortinet.settings import FMGSettings
+
+from fortimanager_template_sync.fmg_api.data import CLITemplate
+from fortimanager_template_sync.fmg_api.operations import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_PAGE_SIZE,
+    BatchOperation,
+    FMGSyncOperations,
+    batch_request_body,
+    batch_statuses,
+)
+
+try:
+    import aiohttp
+except ModuleNotFoundError:  # optional dependency, AsyncFMG raises on init without it
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+# default maximum number of concurrent HTTP connections to FMG
+DEFAULT_MAX_CONNECTIONS = 100
+
+
+class AsyncFMGSync(FMGSyncOperations, AsyncFMG):
+    """Asyncio Fortimanager connection class
+
+    It provides the same template, template group, variable and device methods as `FMGSync` as coroutines. Requests
+    are built by the same code, so both connections send the same requests. Many requests can be in flight in one
+    thread, their number is limited by the connection pool of the HTTP session.
+
+    Login and logout is done by using the connection as async context manager, the ADOM workspace can be locked by
+    the `workspace` async context manager.
+
+    Examples:
+        ```pycon
+        >>> async def get_templates(**settings):
+        ...     async with AsyncFMGSync(**settings) as fmg:
+        ...         return await fmg.get_cli_templates()
+        ```
+
+    Notes:
+        Needs the `async` extra (aiohttp) to be installed.
+    """
+
+    def __init__(
+        self, settings: Optional[FMGSettings] = None, max_connections: int = DEFAULT_MAX_CONNECTIONS, **kwargs
+    ):
+        """Initialize connection
+
+        Args:
+            settings: FortiManager settings
+            max_connections: maximum number of concurrent HTTP connections to FMG
+
+        Keyword Args:
+            base_url (str): Base URL to access FMG (e.g.: https://myfmg/jsonrpc)
+            username (str): User to authenticate
+            password (str): Password for authentication
+            adom (str): ADOM to use for this connection
+            verify (bool): Verify SSL certificate
+        """
+        super().__init__(settings, **kwargs)
+        self.max_connections = max_connections
+
+    async def open(self) -> "AsyncFMGSync":
+        """Open connection and log in"""
+        logger.debug("Initializing connection to %s with id: %s", self._settings.base_url, self._id)
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        self._token = await self._get_token()
+        return self
+
+    @asynccontextmanager
+    async def workspace(self, adom: Optional[str] = None) -> AsyncIterator["AsyncFMGSync"]:
+        """Lock the ADOM workspace for the duration of the context
+
+        Changes are committed on successful exit. The workspace is unlocked at exit only if it was locked here.
+        Nothing is done if FMG doesn't use workspace mode.
+
+        Args:
+            adom: ADOM to lock, the connection ADOM by default
+        """
+        adom = adom or self._settings.adom
+        locked_here = adom not in self.lock.locked_adoms
+        if locked_here:
+            await self.lock(adom)
+        try:
+            yield self
+            if locked_here and adom in self.lock.locked_adoms:
+                await self.lock.commit_changes([adom])
+        finally:
+            if locked_here and adom in self.lock.locked_adoms:
+                await self.lock.unlock_adoms(adom)
+
+    async def iter_pages(
+        self, request: Dict[str, Any], page_size: int = DEFAULT_PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Get objects page by page
+
+        Args:
+            request: get request without range
+            page_size: number of objects in one page
+
+        Yields:
+            objects in the order FMG returns them
+        """
+        offset = 0
+        while True:
+            try:
+                page = (await self.get({**request, "range": [offset, page_size]})).data.get("data") or []
+            except FMGEmptyResultException:
+                return
+            logger.debug("Got %d objects from %s (offset %d)", len(page), request["url"], offset)
+            for obj in page:
+                yield obj
+            if len(page) < page_size:
+                return
+            offset += page_size
+
+    async def execute_batch(
+        self, operations: List[BatchOperation], batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> List[Tuple[BatchOperation, AsyncFMGResponse]]:
+        """Execute write operations in batched requests
+
+        Args:
+            operations: operations to execute in order
+            batch_size: maximum number of operations in one request
+
+        Returns:
+            operations with their responses in the original order
+        """
+        if not self._token:
+            raise FMGTokenException("No token was obtained. Open connection first!")
+        results = []
+        start = 0
+        while start < len(operations):
+            method = operations[start].method
+            end = start + 1
+            while end < len(operations) and end - start < batch_size and operations[end].method == method:
+                end += 1
+            batch = operations[start:end]
+            statuses = await self._post_batch(method, [operation.request for operation in batch])
+            for operation, status in zip(batch, statuses):
+                response = AsyncFMGResponse(fmg=self, status=status.get("code", 400), success=status.get("code") == 0)
+                if not response.success:
+                    response.data = {"error": status.get("message", "no status in response")}
+                results.append((operation, response))
+            start = end
+        return results
+
+    async def _post_batch(self, method: str, params: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Send a batched request, lock the ADOM and retry if needed"""
+        try:
+            return await self._send_batch(method, params)
+        except FMGLockNeededException:
+            if self._settings.adom in self.lock.locked_adoms:
+                raise
+            await self.lock(self._settings.adom)
+            return await self._send_batch(method, params)
+
+    async def _send_batch(self, method: str, params: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Send a batched request, refresh token if needed"""
+        try:
+            return await self._send_batch_request(method, params)
+        except FMGAuthenticationException:
+            self._token = await self._get_token()
+            return await self._send_batch_request(method, params)
+
+    async def _send_batch_request(self, method: str, params: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        body = batch_request_body(method, params, session=self._token.get_secret_value(), request_id=self._id)
+        logger.debug("posting %d %s operations", len(params), method)
+        req = await self._session.post(
+            str(self._settings.base_url), json=body, ssl=self._settings.verify, timeout=self._settings.timeout
+        )
+        return batch_statuses(await req.json(), len(params))
+
+    # CLI Template operations
+
+    async def assign_cli_template(
+        self, template: str, target: Union[Dict[str, str], List[Dict[str, str]]]
+    ) -> AsyncFMGResponse:
+        """Assign group or device to template
+
+        Args:
+            template: name of template
+            target: a single object or a list of objects to assign to the template
+        """
+        return await self.add(self.assign_cli_template_operation(template=template, target=target).request)
+
+    async def unassign_cli_template(
+        self, template: str, target: Union[Dict[str, str], List[Dict[str, str]]]
+    ) -> AsyncFMGResponse:
+        """Remove assignment of group or device from template
+
+        Args:
+            template: name of template
+            target: a single object or a list of objects to remove from the template scope
+        """
+        return await self.delete(self.unassign_cli_template_operation(template=template, target=target).request)
+
+    async def set_cli_template(self, template: CLITemplate, new_name: str = "") -> AsyncFMGResponse:
+        """Update a CLI template
+
+        Args:
+            template: template to set
+            new_name: rename the template to this name
+        """
+        return await self.set(self.set_cli_template_operation(template, new_name=new_name).request)
+
+    async def get_cli_template(self, name: str) -> AsyncFMGResponse:
+        """Get a specific CLI template"""
+        return await self.get(self._cli_template_request(name))
+
+    async def get_cli_templates(
+        self, filters: FILTER_TYPE = None, fields: Optional[List[str]] = None
+    ) -> AsyncFMGResponse:
+        """Get CLI templates
+
+        Args:
+            filters: filter of the templates
+            fields: load only these attributes (projection, "scope member" loads the assignments too), all attributes
+                and scope members by default
+        """
+        try:
+            return await self.get(self._cli_templates_request(filters=filters, fields=fields))
+        except FMGEmptyResultException:
+            return AsyncFMGResponse(data={"data": []})
+
+    def iter_cli_templates(
+        self, filters: FILTER_TYPE = None, fields: Optional[List[str]] = None, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Get CLI templates page by page
+
+        Args:
+            filters: filter of the templates
+            fields: load only these attributes (projection, "scope member" loads the assignments too), all attributes
+                and scope members by default
+            page_size: number of templates in one request
+
+        Yields:
+            raw template data
+        """
+        return self.iter_pages(self._cli_templates_request(filters=filters, fields=fields), page_size=page_size)
+
+    async def delete_cli_template(self, name: str) -> AsyncFMGResponse:
+        """Delete CLI template"""
+        return await self.delete(self.delete_cli_template_operation(name=name).request)
+
+    # Template group operations
+
+    async def assign_cli_template_group(
+        self, template_group: str, target: Union[Dict[str, str], List[Dict[str, str]]]
+    ) -> AsyncFMGResponse:
+        """Assign group or device to template group
+
+        Args:
+            template_group: name of template
+            target: a single object or a list of objects to assign to the template
+        """
+        return await self.add(
+            self.assign_cli_template_group_operation(template_group=template_group, target=target).request
+        )
+
+    async def unassign_cli_template_group(
+        self, template_group: str, target: Union[Dict[str, str], List[Dict[str, str]]]
+    ) -> AsyncFMGResponse:
+        """Remove assignment of group or device from template group
+
+        Args:
+            template_group: name of template group
+            target: a single object or a list of objects to remove from the template group scope
+        """
+        return await self.delete(
+            self.unassign_cli_template_group_operation(template_group=template_group, target=target).request
+        )
+
+    async def set_cli_template_group(
+        self,
+        name: str,
+        description: str = "",
+        member: Optional[List[str]] = None,
+        variables: Optional[List[dict]] = None,
+    ) -> AsyncFMGResponse:
+        """Set CLI template group"""
+        return await self.set(
+            self.set_cli_template_group_operation(
+                name=name, description=description, member=member, variables=variables
+            ).request
+        )
+
+    async def get_cli_template_group(self, name: str) -> AsyncFMGResponse:
+        """Get a specific CLI template group"""
+        return await self.get(self._cli_template_group_request(name))
+
+    async def get_cli_template_groups(self, filters: FILTER_TYPE = None) -> AsyncFMGResponse:
+        """Get CLI template groups"""
+        try:
+            return await self.get(self._cli_template_groups_request(filters=filters))
+        except FMGEmptyResultException:
+            return AsyncFMGResponse(data={"data": []})
+
+    def iter_cli_template_groups(
+        self, filters: FILTER_TYPE = None, fields: Optional[List[str]] = None, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Get CLI template groups page by page
+
+        Args:
+            filters: filter of the template groups
+            fields: load only these attributes (projection, "scope member" loads the assignments too), all attributes
+                and scope members by default
+            page_size: number of template groups in one request
+
+        Yields:
+            raw template group data
+        """
+        return self.iter_pages(self._cli_template_groups_request(filters=filters, fields=fields), page_size=page_size)
+
+    async def delete_cli_template_group(self, name: str) -> AsyncFMGResponse:
+        """Delete CLI template group"""
+        return await self.delete(self.delete_cli_template_group_operation(name=name).request)
+
+    # Variable operations
+
+    async def get_fmg_variable(self, name: str) -> AsyncFMGResponse:
+        """Get a specific variable"""
+        return await self.get(self._fmg_variable_request(name))
+
+    async def get_fmg_variables(self, filters: FILTER_TYPE = None) -> AsyncFMGResponse:
+        """Get metadata variables based on filter"""
+        return await self.get(self._fmg_variables_request(filters=filters))
+
+    def iter_fmg_variables(
+        self, filters: FILTER_TYPE = None, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Get metadata variables page by page
+
+        Args:
+            filters: filter of the variables
+            page_size: number of variables in one request
+
+        Yields:
+            raw variable data
+        """
+        return self.iter_pages(self._fmg_variables_request(filters=filters), page_size=page_size)
+
+    async def set_fmg_variable(
+        self, name: str, value: Optional[str] = None, description: Optional[str] = None
+    ) -> AsyncFMGResponse:
+        """Update metadata variable to use in CLI templates
+
+        Args:
+            name (str): variable name
+            value (str): default value
+            description (str): variable description
+        """
+        return await self.set(self.set_fmg_variable_operation(name=name, value=value, description=description).request)
+
+    # Device operations
+
+    async def get_devices(self, filters: FILTER_TYPE = None) -> AsyncFMGResponse:
+        """Get devices"""
+        return await self.get(self._devices_request(filters=filters))
+
+    async def get_group_members(self, group_name: str) -> AsyncFMGResponse:
+        """Get group members"""
+        return await self.get(self._group_members_request(group_name))
+
+    def iter_device_groups(self, page_size: int = DEFAULT_PAGE_SIZE) -> AsyncIterator[Dict[str, Any]]:
+        """Get device groups with their direct members page by page
+
+        Args:
+            page_size: number of groups in one request
+
+        Yields:
+            raw device group data
+        """
+        return self.iter_pages(self._device_groups_request(), page_size=page_size)
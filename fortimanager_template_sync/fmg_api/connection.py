@@ -1,17 +1,170 @@
 """FMG connection"""
 
 import logging
-from typing import Dict, List, Literal, Optional, Union
+import threading
+from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
 
+from pydantic import SecretStr
 from pyfortinet import FMG, FMGResponse
-from pyfortinet.exceptions import FMGEmptyResultException
+from pyfortinet.exceptions import (
+    FMGAuthenticationException,
+    FMGEmptyResultException,
+    FMGLockNeededException,
+    FMGTokenException,
+)
 from pyfortinet.fmg_api.common import FILTER_TYPE
+from requests.adapters import HTTPAdapter
+
+from fortimanager_template_sync.fmg_api.data import CLITemplate
+from fortimanager_template_sync.fmg_api.operations import (
+    DEFAULT_BATCH_SIZE,
+    DEFAULT_PAGE_SIZE,
+    BatchOperation,
+    FMGSyncOperations,
+    batch_request_body,
+    batch_statuses,
+)
 
 logger = logging.getLogger(__name__)
 
 
-class FMGSync(FMG):
-    """Fortimanager connection class"""
+class FMGSync(FMGSyncOperations, FMG):
+    """Fortimanager connection class
+
+    The connection can be shared by threads, expired sessions are refreshed by one login.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Initialize connection, arguments are passed to `FMG`"""
+        super().__init__(*args, **kwargs)
+        self._token_lock = threading.Lock()
+        # session token of the last request of each thread which failed to authenticate
+        self._expired = threading.local()
+
+    def _get_token(self) -> SecretStr:
+        """Get authentication token
+
+        Threads which failed with the same expired token log in once. If the token was already refreshed since the
+        failed request, the new token is returned without logging in.
+        """
+        expired, self._expired.session = getattr(self._expired, "session", None), None
+        with self._token_lock:
+            if expired is not None and self._token is not None and self._token.get_secret_value() != expired:
+                return self._token  # refreshed by another thread meanwhile
+            self._token = super()._get_token()
+            return self._token
+
+    def _post(self, request: dict) -> Any:
+        """Post request, remember the session token if it's not valid anymore"""
+        try:
+            return super()._post(request)
+        except FMGAuthenticationException:
+            self._expired.session = request.get("session")
+            raise
+
+    def iter_pages(self, request: Dict[str, Any], page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+        """Get objects page by page
+
+        The `range` option of the request is set for each page, the next page is requested only when the previous
+        one is consumed. The last page is the one with less than `page_size` objects.
+
+        Args:
+            request: get request without range
+            page_size: number of objects in one page
+
+        Yields:
+            objects in the order FMG returns them
+        """
+        offset = 0
+        while True:
+            try:
+                page = self.get({**request, "range": [offset, page_size]}).data.get("data") or []
+            except FMGEmptyResultException:
+                return
+            logger.debug("Got %d objects from %s (offset %d)", len(page), request["url"], offset)
+            yield from page
+            if len(page) < page_size:
+                return
+            offset += page_size
+
+    def set_connection_pool_size(self, size: int):
+        """Set the number of HTTP connections which can be kept open to FMG for concurrent requests
+
+        Args:
+            size: maximum number of pooled connections
+        """
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def execute_batch(
+        self, operations: List[BatchOperation], batch_size: int = DEFAULT_BATCH_SIZE
+    ) -> List[Tuple[BatchOperation, FMGResponse]]:
+        """Execute write operations in batched requests
+
+        Consecutive operations with the same method are sent with multiple `params` entries in one request. Each
+        entry gets its own status from FMG which is mapped back to the originating operation. Failed entries don't
+        stop the other ones.
+
+        Args:
+            operations: operations to execute in order
+            batch_size: maximum number of operations in one request
+
+        Returns:
+            operations with their responses in the original order
+        """
+        if not self._token:
+            raise FMGTokenException("No token was obtained. Open connection first!")
+        results = []
+        start = 0
+        while start < len(operations):
+            method = operations[start].method
+            end = start + 1
+            while end < len(operations) and end - start < batch_size and operations[end].method == method:
+                end += 1
+            batch = operations[start:end]
+            statuses = self._post_batch(method, [operation.request for operation in batch])
+            for operation, status in zip(batch, statuses):
+                response = FMGResponse(fmg=self, status=status.get("code", 400), success=status.get("code") == 0)
+                if not response.success:
+                    response.data = {"error": status.get("message", "no status in response")}
+                results.append((operation, response))
+            start = end
+        return results
+
+    def _post_batch(self, method: str, params: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Send a batched request, lock the ADOM and retry if needed
+
+        Returns:
+            status of each params entry
+        """
+        try:
+            return self._send_batch(method, params)
+        except FMGLockNeededException:
+            if self._settings.adom in self.lock.locked_adoms:
+                raise
+            self.lock(self._settings.adom)
+            return self._send_batch(method, params)
+
+    def _send_batch(self, method: str, params: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Send a batched request, refresh token if needed"""
+        try:
+            return self._send_batch_request(method, params)
+        except FMGAuthenticationException:
+            self._token = self._get_token()
+            return self._send_batch_request(method, params)
+
+    def _send_batch_request(self, method: str, params: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        body = batch_request_body(method, params, session=self._token.get_secret_value(), request_id=self._id)
+        logger.debug("posting %d %s operations", len(params), method)
+        req = self._session.post(
+            self._settings.base_url, json=body, verify=self._settings.verify, timeout=self._settings.timeout
+        )
+        try:
+            return batch_statuses(req.json(), len(params))
+        except FMGAuthenticationException:
+            self._expired.session = body["session"]
+            raise
 
     # CLI Template operations
 
@@ -58,15 +211,16 @@ class FMGSync(FMG):
             template: name of template
             target: a single object or a list of objects to assign to the template
         """
-        if not isinstance(target, list):
-            target = [target]
+        return self.add(self.assign_cli_template_operation(template=template, target=target).request)
 
-        if self._settings.adom == "global":
-            url = f"/pm/config/global/obj/cli/template/{template}/scope member"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template/{template}/scope member"
-        request = {"data": target, "url": url}
-        return self.add(request)
+    def unassign_cli_template(self, template: str, target: Union[Dict[str, str], List[Dict[str, str]]]):
+        """Remove assignment of group or device from template
+
+        Args:
+            template: name of template
+            target: a single object or a list of objects to remove from the template scope
+        """
+        return self.delete(self.unassign_cli_template_operation(template=template, target=target).request)
 
     def assign_cli_template_group(self, template_group: str, target: Union[Dict[str, str], List[Dict[str, str]]]):
         """Assign group or device to template group
@@ -85,15 +239,18 @@ class FMGSync(FMG):
         Raises:
             FMGInvalidDataException: if target is invalid or non-existent
         """
-        if not isinstance(target, list):
-            target = [target]
+        return self.add(self.assign_cli_template_group_operation(template_group=template_group, target=target).request)
 
-        if self._settings.adom == "global":
-            url = f"/pm/config/global/obj/cli/template-group/{template_group}/scope member"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group/{template_group}/scope member"
-        request = {"data": target, "url": url}
-        return self.add(request)
+    def unassign_cli_template_group(self, template_group: str, target: Union[Dict[str, str], List[Dict[str, str]]]):
+        """Remove assignment of group or device from template group
+
+        Args:
+            template_group: name of template group
+            target: a single object or a list of objects to remove from the template group scope
+        """
+        return self.delete(
+            self.unassign_cli_template_group_operation(template_group=template_group, target=target).request
+        )
 
     def update_cli_template(
         self,
@@ -127,75 +284,51 @@ class FMGSync(FMG):
         }
         return self.update(request)
 
-    def set_cli_template(
-        self,
-        name: str,
-        script: str,
-        new_name: str = "",
-        description: str = "",
-        provision: Literal["disable", "enable"] = "disable",
-        type: Literal["cli", "jinja"] = "jinja",
-        variables: Optional[List[dict]] = None,
-    ) -> FMGResponse:
-        """Update a CLI template"""
-        if not variables:
-            variables = []
-        if self._settings.adom == "global":
-            url = f"/pm/config/global/obj/cli/template/{name}"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template/{name}"
-        if new_name:
-            name = new_name
-        request = {
-            "data": {
-                "description": description,
-                "name": name,
-                "provision": provision,
-                "script": script,
-                "type": type,
-                "variables": [variable["name"] for variable in variables],
-            },
-            "url": url,
-        }
-        return self.set(request)
+    def set_cli_template(self, template: CLITemplate, new_name: str = "") -> FMGResponse:
+        """Update a CLI template
+
+        Args:
+            template: template to set
+            new_name: rename the template to this name
+        """
+        return self.set(self.set_cli_template_operation(template, new_name=new_name).request)
 
     def get_cli_template(self, name: str) -> FMGResponse:
         """Get a specific CLI template"""
-        if self._settings.adom == "global":
-            url = f"/pm/config/global/obj/cli/template/{name}"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template/{name}"
-        request = {
-            "url": url,
-            "option": "scope member",
-        }
-        return self.get(request)
+        return self.get(self._cli_template_request(name))
 
-    def get_cli_templates(self, filters: FILTER_TYPE = None) -> FMGResponse:
-        """Get CLI templates"""
-        if self._settings.adom == "global":
-            url = "/pm/config/global/obj/cli/template"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template"
+    def get_cli_templates(self, filters: FILTER_TYPE = None, fields: Optional[List[str]] = None) -> FMGResponse:
+        """Get CLI templates
 
-        request = {
-            "url": url,
-            "option": "scope member",
-        }
-        if filters:
-            request["filter"] = self._get_filter_list(filters)
-        return self.get(request)
+        Args:
+            filters: filter of the templates
+            fields: load only these attributes (projection, "scope member" loads the assignments too), all attributes
+                and scope members by default
+        """
+        try:
+            return self.get(self._cli_templates_request(filters=filters, fields=fields))
+        except FMGEmptyResultException:
+            return FMGResponse(data={"data": []})
+
+    def iter_cli_templates(
+        self, filters: FILTER_TYPE = None, fields: Optional[List[str]] = None, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Iterator[Dict[str, Any]]:
+        """Get CLI templates page by page
+
+        Args:
+            filters: filter of the templates
+            fields: load only these attributes (projection, "scope member" loads the assignments too), all attributes
+                and scope members by default
+            page_size: number of templates in one request
+
+        Yields:
+            raw template data
+        """
+        return self.iter_pages(self._cli_templates_request(filters=filters, fields=fields), page_size=page_size)
 
     def delete_cli_template(self, name: str) -> FMGResponse:
         """Delete CLI template"""
-        if self._settings.adom == "global":
-            url = f"/pm/config/global/obj/cli/template/{name}"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template/{name}"
-        request = {
-            "url": url,
-        }
-        return self.delete(request)
+        return self.delete(self.delete_cli_template_operation(name=name).request)
 
     # Template group operations
 
@@ -261,64 +394,42 @@ class FMGSync(FMG):
         variables: Optional[List[dict]] = None,
     ) -> FMGResponse:
         """Set CLI template group"""
-        if not variables:
-            variables = []
-        if not member:
-            member = []
-        if self._settings.adom == "global":
-            url = "/pm/config/global/obj/cli/template-group"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group"
-        request = {
-            "data": {
-                "description": description,
-                "name": name,
-                "member": member,
-                "variables": [variable["name"] for variable in variables],
-            },
-            "url": url,
-        }
-        return self.set(request)
+        return self.set(
+            self.set_cli_template_group_operation(
+                name=name, description=description, member=member, variables=variables
+            ).request
+        )
 
     def get_cli_template_group(self, name: str) -> FMGResponse:
         """Get a specific CLI template group"""
-        if self._settings.adom == "global":
-            url = f"/pm/config/global/obj/cli/template-group/{name}"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group/{name}"
-        request = {
-            "url": url,
-            "option": "scope member",
-        }
-        return self.get(request)
+        return self.get(self._cli_template_group_request(name))
 
     def get_cli_template_groups(self, filters: FILTER_TYPE = None) -> FMGResponse:
         """Get CLI template groups"""
-        if self._settings.adom == "global":
-            url = "/pm/config/global/obj/cli/template-group"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group"
-        request = {
-            "url": url,
-            "option": "scope member",
-        }
-        if filters:
-            request["filter"] = self._get_filter_list(filters)
         try:
-            return self.get(request)
+            return self.get(self._cli_template_groups_request(filters=filters))
         except FMGEmptyResultException:
             return FMGResponse(data={"data": []})
 
+    def iter_cli_template_groups(
+        self, filters: FILTER_TYPE = None, fields: Optional[List[str]] = None, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Iterator[Dict[str, Any]]:
+        """Get CLI template groups page by page
+
+        Args:
+            filters: filter of the template groups
+            fields: load only these attributes (projection, "scope member" loads the assignments too), all attributes
+                and scope members by default
+            page_size: number of template groups in one request
+
+        Yields:
+            raw template group data
+        """
+        return self.iter_pages(self._cli_template_groups_request(filters=filters, fields=fields), page_size=page_size)
+
     def delete_cli_template_group(self, name: str) -> FMGResponse:
         """Delete CLI template"""
-        if self._settings.adom == "global":
-            url = f"/pm/config/global/obj/cli/template-group/{name}"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group/{name}"
-        request = {
-            "url": url,
-        }
-        return self.delete(request)
+        return self.delete(self.delete_cli_template_group_operation(name=name).request)
 
     def add_fmg_variable(
         self, name: str, value: Optional[str] = None, description: Optional[str] = None
@@ -346,27 +457,25 @@ class FMGSync(FMG):
 
     def get_fmg_variable(self, name: str) -> FMGResponse:
         """Get a specific variable"""
-        if self._settings.adom == "global":
-            url = f"/pm/config/global/obj/fmg/variable/{name}"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/fmg/variable/{name}"
-        request = {
-            "url": url,
-        }
-        return self.get(request)
+        return self.get(self._fmg_variable_request(name))
 
     def get_fmg_variables(self, filters: FILTER_TYPE = None) -> FMGResponse:
         """Get metadata variables based on filter"""
-        if self._settings.adom == "global":
-            url = "/pm/config/global/obj/fmg/variable"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/fmg/variable"
-        request = {
-            "url": url,
-        }
-        if filters:
-            request["filter"] = self._get_filter_list(filters)
-        return self.get(request)
+        return self.get(self._fmg_variables_request(filters=filters))
+
+    def iter_fmg_variables(
+        self, filters: FILTER_TYPE = None, page_size: int = DEFAULT_PAGE_SIZE
+    ) -> Iterator[Dict[str, Any]]:
+        """Get metadata variables page by page
+
+        Args:
+            filters: filter of the variables
+            page_size: number of variables in one request
+
+        Yields:
+            raw variable data
+        """
+        return self.iter_pages(self._fmg_variables_request(filters=filters), page_size=page_size)
 
     def update_fmg_variable(
         self, name: str, value: Optional[str] = None, description: Optional[str] = None
@@ -402,46 +511,23 @@ class FMGSync(FMG):
             value (str): default value
             description (str): variable description
         """
-        if self._settings.adom == "global":
-            url = "/pm/config/global/obj/fmg/variable"
-        else:
-            url = f"/pm/config/adom/{self._settings.adom}/obj/fmg/variable"
-        request = {
-            "data": {
-                "description": description,
-                "name": name,
-                "value": value,
-            },
-            "url": url,
-        }
-        return self.set(request)
+        return self.set(self.set_fmg_variable_operation(name=name, value=value, description=description).request)
 
     def get_devices(self, filters: FILTER_TYPE = None):
         """Get devices"""
-        if self._settings.adom == "global":
-            url = "/dvmdb/device"
-        else:
-            url = f"/dvmdb/adom/{self._settings.adom}/device"
-
-        request = {
-            "url": url,
-            "fields": ["name", "conf_status", "conn_status", "db_status", "dev_status"],
-            "loadsub": 1,  # gather vdoms
-            "option": [
-                "extra info",
-                "assignment info",
-            ],
-        }
-        if filters:
-            request["filter"] = self._get_filter_list(filters)
-        return self.get(request)
+        return self.get(self._devices_request(filters=filters))
 
     def get_group_members(self, group_name: str):
         """Get group members"""
-        if self._settings.adom == "global":
-            url = f"/dvmdb/group/{group_name}"
-        else:
-            url = f"/dvmdb/adom/{self._settings.adom}/group/{group_name}"
+        return self.get(self._group_members_request(group_name))
+
+    def iter_device_groups(self, page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+        """Get device groups with their direct members page by page
 
-        request = {"option": "object member", "url": url}
-        return self.get(request)
+        Args:
+            page_size: number of groups in one request
+
+        Yields:
+            raw device group data
+        """
+        return self.iter_pages(self._device_groups_request(), page_size=page_size)
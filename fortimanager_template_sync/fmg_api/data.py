@@ -1,11 +1,15 @@
 """Pydantic data types"""
 
-from typing import Dict, List, Literal, Optional
+import hashlib
+import json
+from abc import abstractmethod
+from functools import cached_property
+from typing import Any, Dict, List, Literal, Optional, Set
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, computed_field, field_validator
 from pydantic.dataclasses import dataclass
 
-from fortimanager_template_sync.misc import sanitize_variables
+from fortimanager_template_sync.misc import VariableRegistry
 
 
 class Variable(BaseModel):
@@ -23,7 +27,60 @@ class Variable(BaseModel):
             return super().__eq__(other)
 
 
-class CLITemplate(BaseModel):
+def canonical_fingerprint(**attributes: Any) -> str:
+    """Calculate stable hash of object attributes
+
+    Args:
+        **attributes: JSON serializable normalized attributes
+
+    Returns:
+        hex SHA256 digest
+    """
+    canonical = json.dumps(attributes, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _variable_names(variables: Optional[List[Variable]]) -> List[str]:
+    return sorted(variable.name for variable in variables or [])
+
+
+def _scopes(scope_member: Optional[List[Dict[str, str]]]) -> List[List[str]]:
+    return sorted([scope.get("name", ""), scope.get("vdom") or ""] for scope in scope_member or [])
+
+
+class FingerprintModel(BaseModel):
+    """Base model with cached content fingerprint
+
+    The fingerprint is calculated on first access and dropped when an attribute is set. It is part of the pickled
+    state and of JSON exports. In-place changes of list attributes are not tracked.
+    """
+
+    def __setattr__(self, name: str, value: Any):
+        """Invalidate fingerprint on attribute change"""
+        super().__setattr__(name, value)
+        self.__dict__.pop("fingerprint", None)
+
+    @abstractmethod
+    def fingerprint_attributes(self) -> Dict[str, Any]:
+        """Get normalized attributes which make up the fingerprint"""
+
+    @computed_field
+    @cached_property
+    def fingerprint(self) -> str:
+        """Get canonical content hash of the object"""
+        return canonical_fingerprint(**self.fingerprint_attributes())
+
+    def __eq__(self, other):
+        """Add support for string equality, objects are compared by fingerprint"""
+        if isinstance(other, str):
+            return self.name == other
+        elif isinstance(other, type(self)):
+            return self.fingerprint == other.fingerprint
+        else:  # e.g. None
+            return False
+
+
+class CLITemplate(FingerprintModel):
     """CLI template model
 
     Docs for assigning template to device
@@ -38,28 +95,19 @@ class CLITemplate(BaseModel):
     variables: Optional[List[Variable]] = None
     # return value only on loadsub
     scope_member: Optional[List[Dict[str, str]]] = Field(None, exclude=True)  # list of object this is assigned to
-
-    def __eq__(self, other):
-        """Add support for string equality"""
-        if isinstance(other, str):
-            return self.name == other
-        elif isinstance(other, CLITemplate):
-            # return super().__eq__(other)  # not working, variables can differ being list of other objects
-            svars = sorted([var.name for var in self.variables]) if self.variables else self.variables
-            ovars = sorted([var.name for var in other.variables]) if other.variables else other.variables
-            sscope = sorted([scope for scope in self.scope_member]) if self.scope_member else self.scope_member
-            oscope = sorted([scope for scope in other.scope_member]) if other.scope_member else other.scope_member
-            return (
-                self.name == other.name
-                and self.description == other.description
-                and self.provision == other.provision
-                and self.script == other.script
-                and self.type == other.type
-                and svars == ovars
-                and sscope == oscope
-            )
-        else:  # e.g. None
-            return False
+    # return value only from FMG
+    version: Optional[int] = Field(None, exclude=True)  # FMG object version ("obj ver")
+
+    def fingerprint_attributes(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "description": self.description or "",
+            "provision": self.provision,
+            "type": self.type,
+            "script": self.script,
+            "variables": _variable_names(self.variables),
+            "scope_member": _scopes(self.scope_member),
+        }
 
     @field_validator("provision", mode="before")
     def standardize_provision(cls, v):
@@ -78,7 +126,7 @@ class CLITemplate(BaseModel):
             return v
 
 
-class CLITemplateGroup(BaseModel):
+class CLITemplateGroup(FingerprintModel):
     """CLI Template Group model"""
 
     name: str
@@ -87,34 +135,17 @@ class CLITemplateGroup(BaseModel):
     variables: Optional[List[Variable]] = None
     # return value only on loadsub
     scope_member: Optional[List[Dict[str, str]]] = Field(None, exclude=True)  # list of object this is assigned to
+    # return value only from FMG
+    version: Optional[int] = Field(None, exclude=True)  # FMG object version ("obj ver")
 
-    def __eq__(self, other):
-        """Add support for string equality"""
-        if isinstance(other, str):
-            return self.name == other
-        elif isinstance(other, CLITemplateGroup):
-            # return super().__eq__(other)  # not working, variables can differ being list of other objects
-            if not self.name == other.name:
-                return False
-            if not self.description == other.description:
-                return False
-            if not isinstance(self.member, list):
-                if not self.member == other.member:
-                    return False
-            elif not sorted(self.member) == sorted(other.member):
-                return False
-            if not isinstance(self.variables, list):
-                if not self.variables == other.variables:
-                    return False
-            elif not sorted([var.name for var in self.variables]) == sorted([var.name for var in other.variables]):
-                return False
-            if not isinstance(self.scope_member, list):
-                if not self.scope_member == other.scope_member:
-                    return False
-            else:
-                return sorted([scope for scope in self.scope_member]) == sorted([scope for scope in other.scope_member])
-        else:  # e.g. None
-            return False
+    def fingerprint_attributes(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "description": self.description or "",
+            "member": sorted(self.member or []),
+            "variables": _variable_names(self.variables),
+            "scope_member": _scopes(self.scope_member),
+        }
 
 
 @dataclass
@@ -139,16 +170,45 @@ class TemplateTree:
         """
         return bool(len(self.pre_run_templates) + len(self.templates) + len(self.template_groups))
 
+    @property
+    def names(self) -> Set[str]:
+        """Get names of all templates and template groups"""
+        return {template.name for template in self.pre_run_templates + self.templates + self.template_groups}
+
+    @cached_property
+    def variable_registry(self) -> VariableRegistry:
+        """Get registry of all variables, it's built on first access
+
+        Raises:
+            FMGSyncVariableException: on conflicting variable definitions
+        """
+        registry = VariableRegistry()
+        for template in self.pre_run_templates + self.templates + self.template_groups:
+            registry.update(template.variables or [], source=template.name)
+        return registry
+
     @property
     def variables(self) -> List[Variable]:
         """Get list of all variables"""
-        variables = [
-            template.variables
-            for template in self.pre_run_templates + self.templates + self.template_groups
-            if template.variables
-        ]
-        result = []
-        for variable_list in variables:
-            result.extend(variable_list)
-        result = sanitize_variables(result)
-        return result
+        return self.variable_registry.variables
+
+
+@dataclass
+class RepoChanges:
+    """Changed files in the template repository between two commits
+
+    Attributes:
+        changed (Dict[str, Set[str]]): added or modified object names by repository directory
+        deleted (Dict[str, Set[str]]): deleted object names by repository directory
+    """
+
+    changed: Dict[str, Set[str]] = Field(default_factory=dict)
+    deleted: Dict[str, Set[str]] = Field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        """Check for empty change set
+
+        Returns:
+            True if there is any changed or deleted object
+        """
+        return any(self.changed.values()) or any(self.deleted.values())
@@ -0,0 +1,336 @@
+"""FMG request builders shared by the blocking and the asyncio connection"""
+
+import re
+from typing import Any, Dict, List, NamedTuple, Optional, Union
+
+from pyfortinet.exceptions import FMGAuthenticationException, FMGLockNeededException
+from pyfortinet.fmg_api.common import FILTER_TYPE
+
+from fortimanager_template_sync.fmg_api.data import CLITemplate
+
+# default number of objects to get in one paged request
+DEFAULT_PAGE_SIZE = 1000
+# default number of write operations in one batched request
+DEFAULT_BATCH_SIZE = 50
+
+
+class BatchOperation(NamedTuple):
+    """Write operation which can be sent in a batched request
+
+    Attributes:
+        key: name of the object the operation originates from
+        method: JSON-RPC method (add, set, update, delete)
+        request: request parameters with `url` and optional `data`
+    """
+
+    key: str
+    method: str
+    request: Dict[str, Any]
+
+
+def batch_request_body(method: str, params: List[Dict[str, Any]], session: str, request_id: int) -> Dict[str, Any]:
+    """Build JSON-RPC body of a batched request
+
+    Args:
+        method: JSON-RPC method
+        params: request parameters of the operations
+        session: session token
+        request_id: JSON-RPC id
+
+    Returns:
+        request body with one `params` entry for each operation
+    """
+    return {
+        "method": method,
+        "params": [{key: request[key] for key in ("url", "data") if key in request} for request in params],
+        "session": session,
+        "id": request_id,
+    }
+
+
+def batch_statuses(response: Dict[str, Any], count: int) -> List[Dict[str, Any]]:
+    """Get status of each operation from a batched response
+
+    Args:
+        response: JSON-RPC response
+        count: number of operations in the request
+
+    Returns:
+        status of each operation, missing statuses are reported as errors
+
+    Raises:
+        FMGAuthenticationException: if the session is not valid anymore
+        FMGLockNeededException: if the ADOM needs to be locked
+    """
+    statuses = [result.get("status", {}) for result in response.get("result", [])]
+    for status in statuses:
+        message = status.get("message", "")
+        if message == "No permission for the resource":
+            raise FMGAuthenticationException(status)
+        if re.search(r"no( write)? permission$", message, flags=re.I):
+            raise FMGLockNeededException(status)
+    # FMG returns one result for each params entry
+    statuses.extend({"code": 400, "message": "no status in response"} for _ in range(count - len(statuses)))
+    return statuses
+
+
+class FMGSyncOperations:
+    """Request builders of FMG objects
+
+    Requests are built once and executed by the blocking or the asyncio connection class.
+    """
+
+    # CLI Template operations
+
+    def assign_cli_template_operation(
+        self, template: str, target: Union[Dict[str, str], List[Dict[str, str]]]
+    ) -> BatchOperation:
+        """Build `assign_cli_template` request as batch operation"""
+        if not isinstance(target, list):
+            target = [target]
+
+        if self._settings.adom == "global":
+            url = f"/pm/config/global/obj/cli/template/{template}/scope member"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template/{template}/scope member"
+        request = {"data": target, "url": url}
+        return BatchOperation(key=template, method="add", request=request)
+
+    def unassign_cli_template_operation(
+        self, template: str, target: Union[Dict[str, str], List[Dict[str, str]]]
+    ) -> BatchOperation:
+        """Build `unassign_cli_template` request as batch operation"""
+        return self.assign_cli_template_operation(template=template, target=target)._replace(method="delete")
+
+    def assign_cli_template_group_operation(
+        self, template_group: str, target: Union[Dict[str, str], List[Dict[str, str]]]
+    ) -> BatchOperation:
+        """Build `assign_cli_template_group` request as batch operation"""
+        if not isinstance(target, list):
+            target = [target]
+
+        if self._settings.adom == "global":
+            url = f"/pm/config/global/obj/cli/template-group/{template_group}/scope member"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group/{template_group}/scope member"
+        request = {"data": target, "url": url}
+        return BatchOperation(key=template_group, method="add", request=request)
+
+    def unassign_cli_template_group_operation(
+        self, template_group: str, target: Union[Dict[str, str], List[Dict[str, str]]]
+    ) -> BatchOperation:
+        """Build `unassign_cli_template_group` request as batch operation"""
+        return self.assign_cli_template_group_operation(template_group=template_group, target=target)._replace(
+            method="delete"
+        )
+
+    def set_cli_template_operation(self, template: CLITemplate, new_name: str = "") -> BatchOperation:
+        """Build `set_cli_template` request as batch operation
+
+        Args:
+            template: template to set
+            new_name: rename the template to this name
+        """
+        if self._settings.adom == "global":
+            url = f"/pm/config/global/obj/cli/template/{template.name}"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template/{template.name}"
+        request = {
+            "data": {
+                "description": template.description,
+                "name": new_name or template.name,
+                "provision": template.provision,
+                "script": template.script,
+                "type": template.type,
+                "variables": [variable.name for variable in template.variables or []],
+            },
+            "url": url,
+        }
+        return BatchOperation(key=template.name, method="set", request=request)
+
+    def _cli_template_request(self, name: str) -> Dict[str, Any]:
+        """Build request to get a specific CLI template"""
+        if self._settings.adom == "global":
+            url = f"/pm/config/global/obj/cli/template/{name}"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template/{name}"
+        return {
+            "url": url,
+            "option": "scope member",
+        }
+
+    def _cli_templates_request(self, filters: FILTER_TYPE = None, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Build request to get CLI templates"""
+        if self._settings.adom == "global":
+            url = "/pm/config/global/obj/cli/template"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template"
+
+        request = {
+            "url": url,
+        }
+        if fields:
+            request["fields"] = [field for field in fields if field != "scope member"]
+        if not fields or "scope member" in fields:
+            request["option"] = "scope member"
+        if filters:
+            request["filter"] = self._get_filter_list(filters)
+        return request
+
+    def delete_cli_template_operation(self, name: str) -> BatchOperation:
+        """Build `delete_cli_template` request as batch operation"""
+        if self._settings.adom == "global":
+            url = f"/pm/config/global/obj/cli/template/{name}"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template/{name}"
+        request = {
+            "url": url,
+        }
+        return BatchOperation(key=name, method="delete", request=request)
+
+    # Template group operations
+
+    def set_cli_template_group_operation(
+        self,
+        name: str,
+        description: str = "",
+        member: Optional[List[str]] = None,
+        variables: Optional[List[dict]] = None,
+    ) -> BatchOperation:
+        """Build `set_cli_template_group` request as batch operation"""
+        if not variables:
+            variables = []
+        if not member:
+            member = []
+        if self._settings.adom == "global":
+            url = "/pm/config/global/obj/cli/template-group"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group"
+        request = {
+            "data": {
+                "description": description,
+                "name": name,
+                "member": member,
+                "variables": [variable["name"] for variable in variables],
+            },
+            "url": url,
+        }
+        return BatchOperation(key=name, method="set", request=request)
+
+    def _cli_template_group_request(self, name: str) -> Dict[str, Any]:
+        """Build request to get a specific CLI template group"""
+        if self._settings.adom == "global":
+            url = f"/pm/config/global/obj/cli/template-group/{name}"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group/{name}"
+        return {
+            "url": url,
+            "option": "scope member",
+        }
+
+    def _cli_template_groups_request(
+        self, filters: FILTER_TYPE = None, fields: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
+        """Build request to get CLI template groups"""
+        if self._settings.adom == "global":
+            url = "/pm/config/global/obj/cli/template-group"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group"
+        request = {
+            "url": url,
+        }
+        if fields:
+            request["fields"] = [field for field in fields if field != "scope member"]
+        if not fields or "scope member" in fields:
+            request["option"] = "scope member"
+        if filters:
+            request["filter"] = self._get_filter_list(filters)
+        return request
+
+    def delete_cli_template_group_operation(self, name: str) -> BatchOperation:
+        """Build `delete_cli_template_group` request as batch operation"""
+        if self._settings.adom == "global":
+            url = f"/pm/config/global/obj/cli/template-group/{name}"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/cli/template-group/{name}"
+        request = {
+            "url": url,
+        }
+        return BatchOperation(key=name, method="delete", request=request)
+
+    # Variable operations
+
+    def _fmg_variable_request(self, name: str) -> Dict[str, Any]:
+        """Build request to get a specific variable"""
+        if self._settings.adom == "global":
+            url = f"/pm/config/global/obj/fmg/variable/{name}"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/fmg/variable/{name}"
+        return {
+            "url": url,
+        }
+
+    def _fmg_variables_request(self, filters: FILTER_TYPE = None) -> Dict[str, Any]:
+        """Build request to get metadata variables"""
+        if self._settings.adom == "global":
+            url = "/pm/config/global/obj/fmg/variable"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/fmg/variable"
+        request = {
+            "url": url,
+        }
+        if filters:
+            request["filter"] = self._get_filter_list(filters)
+        return request
+
+    def set_fmg_variable_operation(
+        self, name: str, value: Optional[str] = None, description: Optional[str] = None
+    ) -> BatchOperation:
+        """Build `set_fmg_variable` request as batch operation"""
+        if self._settings.adom == "global":
+            url = "/pm/config/global/obj/fmg/variable"
+        else:
+            url = f"/pm/config/adom/{self._settings.adom}/obj/fmg/variable"
+        request = {
+            "data": {
+                "description": description,
+                "name": name,
+                "value": value,
+            },
+            "url": url,
+        }
+        return BatchOperation(key=name, method="set", request=request)
+
+    # Device operations
+
+    def _devices_request(self, filters: FILTER_TYPE = None) -> Dict[str, Any]:
+        """Build request to get devices with their status and CLI template assignments"""
+        url = "/dvmdb/device" if self._settings.adom == "global" else f"/dvmdb/adom/{self._settings.adom}/device"
+
+        request = {
+            "url": url,
+            "fields": ["name", "conf_status", "conn_status", "db_status", "dev_status"],
+            "loadsub": 1,  # gather vdoms
+            "option": [
+                "extra info",
+                "assignment info",
+            ],
+        }
+        if filters:
+            request["filter"] = self._get_filter_list(filters)
+        return request
+
+    def _group_members_request(self, group_name: str) -> Dict[str, Any]:
+        """Build request to get members of a device group"""
+        if self._settings.adom == "global":
+            url = f"/dvmdb/group/{group_name}"
+        else:
+            url = f"/dvmdb/adom/{self._settings.adom}/group/{group_name}"
+
+        return {"option": "object member", "url": url}
+
+    def _device_groups_request(self) -> Dict[str, Any]:
+        """Build request to get all device groups with their members"""
+        url = "/dvmdb/group" if self._settings.adom == "global" else f"/dvmdb/adom/{self._settings.adom}/group"
+
+        return {"option": "object member", "url": url}
@@ -2,13 +2,12 @@
 
 import logging
 from pathlib import Path
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Union
 
-from jinja2 import Environment, meta
-from more_itertools import first
 from ruamel.yaml import YAML
 
 from fortimanager_template_sync.exceptions import FMGSyncVariableException
+from fortimanager_template_sync.template_analyzer import analyzer
 
 if TYPE_CHECKING:
     from fortimanager_template_sync.fmg_api.data import Variable
@@ -64,11 +63,102 @@ def find_all_vars(template_content: str) -> set:
 
     Returns:
         list: A list of undeclared variables found in the template content.
+
+    Raises:
+        TemplateSyntaxError: if template can't be parsed
     """
-    env = Environment()
-    parsed_content = env.parse(template_content)
+    analysis = analyzer.analyze(template_content)
+    if analysis.error:
+        raise analysis.error
+
+    return set(analysis.variables)
+
+
+class VariableRegistry:
+    """Variables indexed by name
+
+    Every variable name is registered once. Adding a variable again with the same default value only records its
+    source, a different default value is an error.
+
+    Attributes:
+        variables (List[Variable]): registered variables in order of registration
+    """
+
+    def __init__(self, variables: Iterable["Variable"] = (), source: Optional[str] = None):
+        """Initialize registry
+
+        Args:
+            variables: variables to register
+            source: name of the template which declared the variables
+        """
+        self._variables: Dict[str, Variable] = {}
+        self._sources: Dict[str, List[str]] = {}
+        self.update(variables, source=source)
+
+    def add(self, variable: "Variable", source: Optional[str] = None):
+        """Register variable
+
+        Args:
+            variable: variable to register
+            source: name of the template which declared the variable
+
+        Raises:
+            FMGSyncVariableException: if the variable is already registered with another default value
+        """
+        existing_var = self._variables.get(variable.name)
+        if existing_var is None:
+            self._variables[variable.name] = variable
+            self._sources[variable.name] = []
+        elif variable.value != existing_var.value:
+            error = f"Variable {variable.name} has multiple default values amongst templates!"
+            if source and self._sources[variable.name]:
+                error += f" ({', '.join(self._sources[variable.name])} vs. {source})"
+            logger.error(error)
+            raise FMGSyncVariableException(error)
+        if source and source not in self._sources[variable.name]:
+            self._sources[variable.name].append(source)
+
+    def update(self, variables: Iterable["Variable"], source: Optional[str] = None):
+        """Register multiple variables
 
-    return meta.find_undeclared_variables(parsed_content)
+        Args:
+            variables: variables to register
+            source: name of the template which declared the variables
+
+        Raises:
+            FMGSyncVariableException: if a variable is already registered with another default value
+        """
+        for variable in variables:
+            self.add(variable, source=source)
+
+    def sources(self, name: str) -> List[str]:
+        """Get templates which declared the variable
+
+        Args:
+            name: variable name
+
+        Returns:
+            template names
+        """
+        return list(self._sources.get(name, []))
+
+    @property
+    def variables(self) -> List["Variable"]:
+        """Get registered variables"""
+        return list(self._variables.values())
+
+    def __contains__(self, item: Union[str, "Variable"]) -> bool:
+        name = item if isinstance(item, str) else item.name
+        return name in self._variables
+
+    def __getitem__(self, name: str) -> "Variable":
+        return self._variables[name]
+
+    def __iter__(self) -> Iterator["Variable"]:
+        return iter(self._variables.values())
+
+    def __len__(self) -> int:
+        return len(self._variables)
 
 
 def sanitize_variables(variables: List["Variable"]) -> List["Variable"]:
@@ -83,15 +173,4 @@ def sanitize_variables(variables: List["Variable"]) -> List["Variable"]:
     Raises:
         FMGSyncVariableException: on variable definition problem
     """
-    good_variables = []
-    for variable in variables:
-        if variable.name not in good_variables:
-            good_variables.append(variable)
-            continue
-        existing_var = first([var for var in good_variables if var.name == variable.name])
-        if variable.value != existing_var.value:
-            error = f"Variable {variable.name} has multiple default values amongst templates!"
-            logger.error(error)
-            raise FMGSyncVariableException(error)
-
-    return good_variables
+    return VariableRegistry(variables).variables
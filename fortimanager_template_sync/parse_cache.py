@@ -0,0 +1,128 @@
+"""On-disk cache of parsed repository files"""
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def git_blob_sha(data: str) -> str:
+    """Calculate the git blob SHA of a text file content
+
+    Args:
+        data: file content
+
+    Returns:
+        hex SHA1 digest, same as `git hash-object` gives for the file
+    """
+    raw = data.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(raw) + raw).hexdigest()
+
+
+class ParseCache:
+    """Parse results of repository files keyed by git blob SHA
+
+    The cache is a single JSON file. Entries are kept in least recently used order and the oldest ones are evicted
+    when there are more than `max_entries`. The file is rewritten only if entries were added, evicted or dropped.
+    The whole cache is dropped if it was written by another parser version.
+
+    Attributes:
+        path (Path): cache file
+        parser_version (int): version of the parser which produced the entries
+        max_entries (int): maximum number of entries to keep
+        hits (int): number of cache hits
+        misses (int): number of cache misses
+    """
+
+    def __init__(self, path: Path, parser_version: int, max_entries: int = 10000):
+        """Initialize and load cache
+
+        Args:
+            path: cache file
+            parser_version: version of the parser which produced the entries
+            max_entries: maximum number of entries to keep
+        """
+        self.path = path
+        self.parser_version = parser_version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self._dirty = False
+        self.load()
+
+    @staticmethod
+    def _key(kind: str, sha: str) -> str:
+        return f"{kind}:{sha}"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self):
+        """Load cache file if it exists and was written by the same parser version"""
+        if not self.path.is_file():
+            return
+        try:
+            with open(self.path, encoding="UTF-8") as fi:
+                cache = json.load(fi)
+        except (OSError, ValueError) as err:
+            logger.warning("Parse cache '%s' is unreadable, starting with empty cache: %s", self.path, err)
+            self._dirty = True
+            return
+        if cache.get("parser_version") != self.parser_version:
+            logger.info("Parse cache was created by another parser version, dropping it")
+            self._dirty = True
+            return
+        self._entries = OrderedDict(cache.get("entries", {}))
+        logger.debug("Loaded %d entries from parse cache", len(self._entries))
+
+    def get(self, kind: str, sha: str) -> Optional[Dict[str, Any]]:
+        """Get cached parse result
+
+        Args:
+            kind: type of the parsed file (e.g. template or group)
+            sha: git blob SHA of the file
+
+        Returns:
+            cached data or None if it's not cached
+        """
+        key = self._key(kind, sha)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        # reordering alone doesn't make the cache dirty, the order is saved with the next change
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, kind: str, sha: str, data: Dict[str, Any]):
+        """Store parse result and evict the least recently used entries over the limit
+
+        Args:
+            kind: type of the parsed file (e.g. template or group)
+            sha: git blob SHA of the file
+            data: JSON serializable parse result
+        """
+        key = self._key(kind, sha)
+        self._entries[key] = data
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def save(self):
+        """Write cache to disk if it was changed"""
+        if not self._dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.path.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="UTF-8") as fo:
+            json.dump({"parser_version": self.parser_version, "entries": self._entries}, fo)
+        temp_file.replace(self.path)
+        self._dirty = False
+        logger.debug("Parse cache saved (hits: %d, misses: %d)", self.hits, self.misses)
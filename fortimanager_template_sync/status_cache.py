@@ -0,0 +1,91 @@
+"""Cache of device statuses"""
+
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# device statuses by name as `CommonTask._get_firewall_statuses` returns them
+Statuses = Dict[str, Dict[str, Any]]
+
+
+class StatusCache:
+    """Device statuses of groups with their query time
+
+    Entries are kept in memory and, if a snapshot file is given, on disk as well, so separate runs can share them.
+    Entries older than the TTL of the reader are ignored.
+
+    Attributes:
+        path (Optional[Path]): snapshot file
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        """Initialize cache
+
+        Args:
+            path: snapshot file, entries are kept in memory only if not given
+        """
+        self.path = path
+        self._entries: Dict[str, Tuple[float, Statuses]] = {}
+
+    def get(self, key: str, ttl: int) -> Optional[Statuses]:
+        """Get statuses if they are fresh enough
+
+        Args:
+            key: cache key (e.g. FMG, ADOM and group)
+            ttl: maximum age of the entry in seconds
+
+        Returns:
+            cached statuses or None
+        """
+        if key not in self._entries:
+            self._entries.update(self._load_snapshot())
+        queried, statuses = self._entries.get(key, (0.0, None))
+        age = time.time() - queried
+        if statuses is None or age > ttl:
+            return None
+        logger.debug("Using device statuses of '%s' from %.0f seconds ago", key, age)
+        return statuses
+
+    def put(self, key: str, statuses: Statuses):
+        """Store statuses queried now
+
+        Args:
+            key: cache key
+            statuses: device statuses
+        """
+        self._entries[key] = (time.time(), statuses)
+        self._save_snapshot()
+
+    def invalidate(self, key: str):
+        """Drop statuses after a change which affects them
+
+        Args:
+            key: cache key
+        """
+        self._entries.update(self._load_snapshot())
+        if self._entries.pop(key, None) is not None:
+            logger.debug("Dropped cached device statuses of '%s'", key)
+            self._save_snapshot()
+
+    def _load_snapshot(self) -> Dict[str, Tuple[float, Statuses]]:
+        if self.path is None or not self.path.is_file():
+            return {}
+        try:
+            with open(self.path, encoding="UTF-8") as fi:
+                return {key: (queried, statuses) for key, (queried, statuses) in json.load(fi).items()}
+        except (OSError, TypeError, ValueError) as err:
+            logger.warning("Device status snapshot '%s' is unreadable, ignoring it: %s", self.path, err)
+            return {}
+
+    def _save_snapshot(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.path.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="UTF-8") as fo:
+            json.dump(self._entries, fo)
+        temp_file.replace(self.path)
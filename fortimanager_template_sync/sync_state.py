@@ -0,0 +1,187 @@
+"""Persistent state of sync runs"""
+
+import logging
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """\
+CREATE TABLE IF NOT EXISTS adom_state (
+    adom TEXT PRIMARY KEY,
+    last_commit TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS object_state (
+    adom TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    version INTEGER,
+    commit_sha TEXT,
+    updated REAL,
+    PRIMARY KEY (adom, kind, name)
+);
+CREATE TABLE IF NOT EXISTS fmg_version (
+    adom TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    version INTEGER,
+    PRIMARY KEY (adom, kind, name)
+);
+"""
+
+
+class ObjectState(NamedTuple):
+    """Last applied state of an FMG object
+
+    Attributes:
+        kind: TemplateTree attribute of the object (e.g. templates)
+        name: object name
+        fingerprint: content fingerprint of the applied object
+        version: FMG object version if known
+        commit: repository commit the object came from
+        updated: time of recording
+    """
+
+    kind: str
+    name: str
+    fingerprint: str
+    version: Optional[int] = None
+    commit: Optional[str] = None
+    updated: float = 0.0
+
+
+class SyncState:
+    """Local state database of successful sync runs
+
+    State is kept in an SQLite file. It can be used as a context manager which closes the database at the end.
+
+    Attributes:
+        path (Path): database file
+    """
+
+    def __init__(self, path: Path):
+        """Open or create state database
+
+        Args:
+            path: database file
+        """
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path))
+        self._db.executescript(SCHEMA)
+
+    def __enter__(self) -> "SyncState":
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def close(self):
+        """Close database"""
+        self._db.close()
+
+    def last_commit(self, adom: str) -> Optional[str]:
+        """Get the last commit which was successfully applied to the ADOM
+
+        Args:
+            adom: ADOM name
+
+        Returns:
+            commit SHA or None if there was no successful sync yet
+        """
+        row = self._db.execute("SELECT last_commit FROM adom_state WHERE adom = ?", (adom,)).fetchone()
+        return row[0] if row else None
+
+    def set_last_commit(self, adom: str, commit: str):
+        """Record the commit which was successfully applied to the ADOM
+
+        Args:
+            adom: ADOM name
+            commit: commit SHA
+        """
+        with self._db:
+            self._db.execute(
+                "INSERT INTO adom_state (adom, last_commit, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(adom) DO UPDATE SET last_commit = excluded.last_commit, updated = excluded.updated",
+                (adom, commit, time.time()),
+            )
+        logger.debug("Recorded commit %s as last applied for ADOM '%s'", commit, adom)
+
+    def object_states(self, adom: str) -> Dict[Tuple[str, str], ObjectState]:
+        """Get last applied state of the objects in the ADOM
+
+        Args:
+            adom: ADOM name
+
+        Returns:
+            object states by (kind, name)
+        """
+        rows = self._db.execute(
+            "SELECT kind, name, fingerprint, version, commit_sha, updated FROM object_state WHERE adom = ?", (adom,)
+        )
+        return {(row[0], row[1]): ObjectState(*row) for row in rows}
+
+    def record_objects(self, adom: str, states: Iterable[ObjectState]):
+        """Record applied state of objects
+
+        Args:
+            adom: ADOM name
+            states: object states, the update time is set to the current time
+        """
+        now = time.time()
+        with self._db:
+            cursor = self._db.executemany(
+                "INSERT INTO object_state (adom, kind, name, fingerprint, version, commit_sha, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(adom, kind, name) DO UPDATE SET fingerprint = excluded.fingerprint, "
+                "version = excluded.version, commit_sha = excluded.commit_sha, updated = excluded.updated",
+                (
+                    (adom, state.kind, state.name, state.fingerprint, state.version, state.commit, now)
+                    for state in states
+                ),
+            )
+        logger.debug("Recorded state of %d objects for ADOM '%s'", cursor.rowcount, adom)
+
+    def forget_objects(self, adom: str, objects: Iterable[Tuple[str, str]]):
+        """Remove state of deleted objects
+
+        Args:
+            adom: ADOM name
+            objects: (kind, name) of the objects
+        """
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM object_state WHERE adom = ? AND kind = ? AND name = ?",
+                ((adom, kind, name) for kind, name in objects),
+            )
+
+    def fmg_versions(self, adom: str) -> Dict[Tuple[str, str], Optional[int]]:
+        """Get FMG object versions recorded at the end of the last successful sync
+
+        Args:
+            adom: ADOM name
+
+        Returns:
+            FMG object version by (kind, name) of all templates and template groups in the ADOM
+        """
+        rows = self._db.execute("SELECT kind, name, version FROM fmg_version WHERE adom = ?", (adom,))
+        return {(row[0], row[1]): row[2] for row in rows}
+
+    def record_fmg_versions(self, adom: str, versions: Dict[Tuple[str, str], Optional[int]]):
+        """Replace recorded FMG object versions of the ADOM
+
+        Args:
+            adom: ADOM name
+            versions: FMG object version by (kind, name) of all templates and template groups in the ADOM
+        """
+        with self._db:
+            self._db.execute("DELETE FROM fmg_version WHERE adom = ?", (adom,))
+            self._db.executemany(
+                "INSERT INTO fmg_version (adom, kind, name, version) VALUES (?, ?, ?, ?)",
+                ((adom, kind, name, version) for (kind, name), version in versions.items()),
+            )
+        logger.debug("Recorded version of %d FMG objects for ADOM '%s'", len(versions), adom)
@@ -1,23 +1,90 @@
 """FMG Sync Task"""
 
+import asyncio
 import json
 import logging
 import re
-from copy import copy
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
 
-from git import GitCommandError, InvalidGitRepositoryError, Repo
-from more_itertools import first
+from git import Commit, GitCommandError, InvalidGitRepositoryError, Repo
+from git.exc import BadName
+from more_itertools import chunked
+from pyfortinet.fmg_api.common import FILTER_TYPE, F
 
+from fortimanager_template_sync.apply_executor import ApplyExecutor, ApplyNode, ApplyResult
 from fortimanager_template_sync.common_task import CommonTask
-from fortimanager_template_sync.exceptions import FMGSyncDeleteError
-from fortimanager_template_sync.fmg_api import FMGSync
-from fortimanager_template_sync.fmg_api.data import CLITemplate, CLITemplateGroup, TemplateTree, Variable
-from fortimanager_template_sync.misc import find_all_vars, sanitize_variables
+from fortimanager_template_sync.config import FMGSyncSettings
+from fortimanager_template_sync.exceptions import FMGSyncDeleteError, FMGSyncException
+from fortimanager_template_sync.fmg_api import AsyncFMGSync, FMGSync
+from fortimanager_template_sync.fmg_api.data import (
+    CLITemplate,
+    CLITemplateGroup,
+    RepoChanges,
+    TemplateTree,
+    Variable,
+)
+from fortimanager_template_sync.misc import sanitize_variables
+from fortimanager_template_sync.parse_cache import ParseCache, git_blob_sha
+from fortimanager_template_sync.sync_state import ObjectState, SyncState
+from fortimanager_template_sync.template_analyzer import analyzer
+from fortimanager_template_sync.template_diff import TREE_KINDS, changed_fields, diff_template_trees, scope_delta
+from fortimanager_template_sync.template_graph import MembershipGraph
 
 logger = logging.getLogger("fortimanager_template_sync.sync_task")
 
+# Increase this on any change of the repository parsing logic to invalidate the parse cache
+PARSER_VERSION = 3
+# parse serially below this number of files, process pool overhead is not worth it
+PARALLEL_PARSE_MIN_FILES = 50
+# repository directories holding FMG objects
+REPO_DIRS = ("pre-run", "templates", "template-groups")
+# template attributes to load from FMG in the first phase of the two-phase load
+TEMPLATE_METADATA_FIELDS = ["name", "description", "provision", "type", "variables", "scope member", "obj ver"]
+# attributes to load from FMG to compare object versions
+TEMPLATE_VERSION_FIELDS = ["name", "provision", "obj ver"]
+GROUP_VERSION_FIELDS = ["name", "obj ver"]
+# number of template scripts to load in one request
+SCRIPT_FETCH_BATCH = 100
+
+
+class SyncPlan(NamedTuple):
+    """Repository side of a sync run
+
+    Attributes:
+        head_commit: commit to sync
+        repo_data: templates and template groups from the repository
+        repo_changes: changes since the last successful sync, None on full comparison
+        object_states: last applied object states by (kind, name)
+        fmg_versions: FMG object versions by (kind, name) recorded at the end of the last successful sync
+    """
+
+    head_commit: str
+    repo_data: TemplateTree
+    repo_changes: Optional[RepoChanges]
+    object_states: Dict[Tuple[str, str], ObjectState]
+    fmg_versions: Dict[Tuple[str, str], Optional[int]]
+
+
+class ObjectChange(NamedTuple):
+    """Change of a template or template group in FMG
+
+    Attributes:
+        kind_name: FMG name of the object kind
+        obj: object from the repository
+        needs_set: object needs to be set as anything but its scope differs
+        to_assign: scopes to assign
+        to_unassign: scopes to unassign
+    """
+
+    kind_name: str
+    obj: Union[CLITemplate, CLITemplateGroup]
+    needs_set: bool
+    to_assign: List[Dict[str, str]]
+    to_unassign: List[Dict[str, str]]
+
 
 class FMGSyncTask(CommonTask):
     """
@@ -35,70 +102,507 @@ class FMGSyncTask(CommonTask):
 
     Attributes:
         settings (FMGSyncSettings): task settings to use
-        fmg (FMGSync): FMG instance
+        fmg (Union[FMGSync, AsyncFMGSync]): FMG instance
+        failed_objects (Set[str]): names of objects which couldn't be updated in FMG
     """
 
+    def __init__(self, settings: FMGSyncSettings, fmg: Optional[Union[FMGSync, AsyncFMGSync]] = None):
+        """Initialize task
+
+        Args:
+            settings: task settings
+            fmg: FMG connection if there is any, `run_async` needs an `AsyncFMGSync` connection
+        """
+        super().__init__(settings=settings, fmg=fmg)
+        self.failed_objects: Set[str] = set()
+
     def run(self) -> bool:
         """Run sync task
 
         Returns:
             (bool): True if sync task succeeded, False otherwise
         """
+        # 1-2. update and load local repository
+        plan = self._plan_run()
+        if not isinstance(plan, SyncPlan):
+            return plan
         success = False
         changes = False
-        # 1. update local repository from remote
-        repo = self._update_local_repository()
-        if not repo:
-            logger.error("Repository couldn't be updated!")
-            return success
-        # 2. load data from the repo
-        repo_data = self._load_local_repository()
-        if not repo_data:
-            logger.error("Repository couldn't be parsed!")
-            return success
+        repo_data = plan.repo_data
+        fmg_templates = to_delete = fmg_versions = None
+        self.failed_objects = set()
         # Initialize FMG connection
         # 3. check FMG device status list in protected group
         #    If firewalls are not in sync, stop
         try:
             if not self.fmg:
-                self.fmg = FMGSync(
-                    base_url=self.settings.fmg_url,
-                    username=self.settings.fmg_user,
-                    password=self.settings.fmg_pass,
-                    adom=self.settings.fmg_adom,
-                    verify=self.settings.fmg_verify,
-                ).open()
+                self.fmg = self._connect()
+            fmg_versions = self._load_fmg_versions() if self.settings.incremental_sync else None
+            moved = self._moved_objects(plan.fmg_versions, fmg_versions)
+            if self._is_unchanged(plan, moved):
+                success = True
+                return success
             self._ensure_device_statuses(self._get_firewall_statuses(self.settings.protected_fw_group))
             # 4. download FMG templates and template groups from FMG
-            fmg_templates = self._load_fmg_templates()
-            # 5. build list of templates to delete from FMG
-            to_delete = None
-            if self.settings.delete_unused_templates:
-                to_delete = self._find_unused_templates(repo_data, fmg_templates)
-            # 6. build list of templates to upload to FMG
-            to_upload = self._changed_templates(repo_data, fmg_templates)
+            repo_data, names = self._narrow_repo_data(plan, moved)
+            fmg_templates = self._load_fmg_templates(names=names, repo_data=repo_data, object_states=plan.object_states)
+            # 5-6. build list of templates to delete from and upload to FMG
+            to_delete, to_upload = self._plan_changes(repo_data, fmg_templates)
             # 7. execute changes in FMG
             if to_delete:
                 changes = self._delete_templates(to_delete)
-            elif self.settings.delete_unused_templates:
-                logger.info("No templates to delete")
             if to_upload:
                 changes = self._update_fmg_templates(templates=to_upload, fmg_templates=fmg_templates) or changes
-            else:
-                logger.info("No templates to update!")
+            if self._versions_changed(fmg_versions, changes):
+                fmg_versions = self._load_fmg_versions()
             success = True
         except Exception as err:
             logger.error(err)
         finally:
-            if changes and self.settings.prod_run:
-                logger.info("Changes applied successfully")
-            else:
-                logger.info("No changes happened")
+            self._log_changes(changes)
             if self.fmg:
                 self.fmg.close(discard_changes=not success)
 
+        if success and self.settings.prod_run:
+            self._record_run(plan.head_commit, repo_data, fmg_templates, to_delete, fmg_versions)
         return success
 
+    async def run_async(self) -> bool:
+        """Run sync task on an asyncio FMG connection
+
+        Same as `run`, but FMG requests are sent from the event loop: independent reads run concurrently and changes
+        are applied by `apply_workers` concurrent requests without a thread for each. Repository handling runs in a
+        worker thread to keep the event loop responsive.
+
+        Returns:
+            (bool): True if sync task succeeded, False otherwise
+        """
+        plan = await asyncio.to_thread(self._plan_run)
+        if not isinstance(plan, SyncPlan):
+            return plan
+        success = False
+        changes = False
+        repo_data = plan.repo_data
+        fmg_templates = to_delete = fmg_versions = None
+        self.failed_objects = set()
+        try:
+            if not self.fmg:
+                self.fmg = await self._connect_async()
+            fmg_versions = await self._load_fmg_versions_async() if self.settings.incremental_sync else None
+            moved = self._moved_objects(plan.fmg_versions, fmg_versions)
+            if self._is_unchanged(plan, moved):
+                success = True
+                return success
+            self._ensure_device_statuses(await self._get_firewall_statuses_async(self.settings.protected_fw_group))
+            repo_data, names = self._narrow_repo_data(plan, moved)
+            fmg_templates = await self._load_fmg_templates_async(
+                names=names, repo_data=repo_data, object_states=plan.object_states
+            )
+            to_delete, to_upload = self._plan_changes(repo_data, fmg_templates)
+            if to_delete:
+                changes = await self._delete_templates_async(to_delete)
+            if to_upload:
+                changes = (
+                    await self._update_fmg_templates_async(templates=to_upload, fmg_templates=fmg_templates) or changes
+                )
+            if self._versions_changed(fmg_versions, changes):
+                fmg_versions = await self._load_fmg_versions_async()
+            success = True
+        except Exception as err:
+            logger.error(err)
+        finally:
+            self._log_changes(changes)
+            if self.fmg:
+                await self.fmg.close(discard_changes=not success)
+
+        if success and self.settings.prod_run:
+            self._record_run(plan.head_commit, repo_data, fmg_templates, to_delete, fmg_versions)
+        return success
+
+    def _plan_run(self) -> Union[bool, SyncPlan]:
+        """Update and load the local repository
+
+        Returns:
+            repository side of the run, or the result of the run if there is nothing to sync
+        """
+        # 1. update local repository from remote
+        repo = self._update_local_repository()
+        if not repo:
+            logger.error("Repository couldn't be updated!")
+            return False
+        # 2. check if there was a change since the last successful sync
+        commit = self._target_commit(repo)
+        head_commit = commit.hexsha
+        repo_changes = last_commit = None
+        fmg_versions, object_states = {}, {}
+        # nothing is recorded before the first production run, don't create the database on a test run
+        if self._sync_state_path.exists():
+            with self._open_sync_state() as state:
+                object_states = state.object_states(self.settings.fmg_adom)
+                if self.settings.incremental_sync:
+                    last_commit = state.last_commit(self.settings.fmg_adom)
+                    fmg_versions = state.fmg_versions(self.settings.fmg_adom)
+        if self.settings.incremental_sync:
+            if last_commit == head_commit:
+                if not fmg_versions:
+                    logger.info("No new commits since last successful sync (%s)", head_commit)
+                    return True
+                logger.info("No new commits since last successful sync (%s), checking FMG", head_commit)
+            repo_changes = self._get_repo_changes(repo, last_commit, commit)
+        # load data from the repo
+        repo_data = self._load_local_repository(commit=commit if self.settings.repo_mode == "bare" else None)
+        if not repo_data:
+            logger.error("Repository couldn't be parsed!")
+            return False
+        return SyncPlan(
+            head_commit=head_commit,
+            repo_data=repo_data,
+            repo_changes=repo_changes,
+            object_states=object_states,
+            fmg_versions=fmg_versions,
+        )
+
+    def _load_fmg_versions(self) -> Dict[Tuple[str, str], Optional[int]]:
+        """Load version of all templates and template groups in FMG
+
+        Only names and versions are loaded, this is much cheaper than loading the objects.
+
+        Returns:
+            FMG object version by (kind, name)
+        """
+        page_size = self.settings.fmg_page_size
+        return self._versions_of(
+            self.fmg.iter_cli_templates(fields=TEMPLATE_VERSION_FIELDS, page_size=page_size),
+            self.fmg.iter_cli_template_groups(fields=GROUP_VERSION_FIELDS, page_size=page_size),
+        )
+
+    async def _load_fmg_versions_async(self) -> Dict[Tuple[str, str], Optional[int]]:
+        """Load version of all templates and template groups in FMG on the asyncio connection"""
+        page_size = self.settings.fmg_page_size
+        return self._versions_of(
+            *await asyncio.gather(
+                self._collect(self.fmg.iter_cli_templates(fields=TEMPLATE_VERSION_FIELDS, page_size=page_size)),
+                self._collect(self.fmg.iter_cli_template_groups(fields=GROUP_VERSION_FIELDS, page_size=page_size)),
+            )
+        )
+
+    @staticmethod
+    def _versions_of(
+        all_templates: Iterable[Dict[str, Any]], all_groups: Iterable[Dict[str, Any]]
+    ) -> Dict[Tuple[str, str], Optional[int]]:
+        versions = {}
+        for template in all_templates:
+            if template.get("provision") == 1:
+                versions[("pre_run_templates", template["name"])] = template.get("obj ver")
+            elif template.get("provision") == 0:
+                versions[("templates", template["name"])] = template.get("obj ver")
+        for group in all_groups:
+            versions[("template_groups", group["name"])] = group.get("obj ver")
+        return versions
+
+    @staticmethod
+    def _moved_objects(
+        recorded: Dict[Tuple[str, str], Optional[int]], current: Optional[Dict[Tuple[str, str], Optional[int]]]
+    ) -> Optional[Set[str]]:
+        """Find FMG objects which changed since the last successful sync
+
+        Args:
+            recorded: FMG object versions recorded at the end of the last successful sync
+            current: current FMG object versions, None if they were not loaded
+
+        Returns:
+            names of the added, modified and deleted objects or None if the versions can't be compared
+        """
+        if not recorded or current is None or any(version is None for version in current.values()):
+            return None
+        return {key[1] for key in recorded.keys() | current.keys() if recorded.get(key) != current.get(key)}
+
+    @staticmethod
+    def _is_unchanged(plan: SyncPlan, moved: Optional[Set[str]]) -> bool:
+        """Check if neither the repository nor FMG changed since the last successful sync"""
+        if plan.repo_changes is None or plan.repo_changes or moved is None or moved:
+            if moved:
+                logger.info("%d objects changed in FMG since last successful sync", len(moved))
+            return False
+        logger.info("No changes in FMG and in the repository since last successful sync")
+        return True
+
+    def _narrow_repo_data(
+        self, plan: SyncPlan, moved: Optional[Set[str]] = None
+    ) -> Tuple[TemplateTree, Optional[Set[str]]]:
+        """Select repository objects to compare with FMG
+
+        Incremental run and recorded object states narrow the comparison unless deletion needs the whole picture.
+        Objects changed in FMG since the last sync are always compared.
+
+        Args:
+            plan: repository side of the run
+            moved: names of the objects changed in FMG since the last successful sync
+
+        Returns:
+            repository objects to compare and the names of the FMG objects to load (None for all)
+        """
+        repo_data, repo_changes = plan.repo_data, plan.repo_changes
+        narrow = not self.settings.delete_unused_templates or (
+            repo_changes is not None and not any(repo_changes.deleted.values())
+        )
+        if not narrow or (repo_changes is None and not (self.settings.sync_state_ttl and plan.object_states)):
+            return repo_data, None
+        if repo_changes is not None:
+            repo_data = self._select_changed_objects(repo_data, repo_changes)
+        if self.settings.sync_state_ttl:
+            repo_data = self._select_stale_objects(repo_data, plan.object_states, self.settings.sync_state_ttl)
+        if not moved:
+            return repo_data, repo_data.names
+        if self.settings.delete_unused_templates and not moved <= plan.repo_data.names:
+            # membership of unknown objects can only be checked with all objects
+            logger.info("Objects missing from the repository changed in FMG, comparing all objects")
+            return plan.repo_data, None
+        selected = repo_data.names | moved
+        repo_data = TemplateTree(
+            **{kind: [obj for obj in getattr(plan.repo_data, kind) if obj.name in selected] for kind in TREE_KINDS}
+        )
+        return repo_data, selected
+
+    def _plan_changes(
+        self, repo_data: TemplateTree, fmg_templates: TemplateTree
+    ) -> Tuple[Optional[TemplateTree], TemplateTree]:
+        """Build list of templates to delete from and to upload to FMG
+
+        Cached firewall statuses of the protected group are invalidated on a production run with planned changes.
+
+        Returns:
+            objects to delete (None if deletion is disabled) and objects to upload
+        """
+        to_delete = None
+        if self.settings.delete_unused_templates:
+            to_delete = self._find_unused_templates(repo_data, fmg_templates, explain=not self.settings.prod_run)
+            if not to_delete:
+                logger.info("No templates to delete")
+        to_upload = self._changed_templates(repo_data, fmg_templates)
+        if not to_upload:
+            logger.info("No templates to update!")
+        if self.settings.prod_run and (to_delete or to_upload):
+            self._invalidate_firewall_statuses(self.settings.protected_fw_group)
+        return to_delete, to_upload
+
+    def _versions_changed(self, fmg_versions: Optional[Dict[Tuple[str, str], Optional[int]]], changes: bool) -> bool:
+        """Check if the FMG versions loaded before the sync need to be reloaded for recording
+
+        Versions are not recorded if some objects couldn't be updated, see `_record_run`.
+        """
+        return fmg_versions is not None and changes and self.settings.prod_run and not self.failed_objects
+
+    def _log_changes(self, changes: bool):
+        if changes and self.settings.prod_run:
+            logger.info("Changes applied successfully")
+        else:
+            logger.info("No changes happened")
+
+    def _record_run(
+        self,
+        head_commit: str,
+        repo_data: TemplateTree,
+        fmg_templates: TemplateTree,
+        to_delete: Optional[TemplateTree],
+        fmg_versions: Optional[Dict[Tuple[str, str], Optional[int]]] = None,
+    ):
+        """Record the state of a successful run
+
+        The last applied commit and the FMG versions are not recorded if some objects couldn't be updated, so the
+        next incremental run doesn't skip and compares them again.
+
+        Args:
+            head_commit: synced commit
+            repo_data: synced templates and template groups from the repository
+            fmg_templates: templates and template groups loaded from FMG before the sync
+            to_delete: deleted objects
+            fmg_versions: FMG object versions after the sync
+        """
+        if self.failed_objects:
+            # versions loaded before the sync are outdated for the updated objects
+            fmg_versions = None
+        with self._open_sync_state() as state:
+            if self.failed_objects:
+                logger.warning(
+                    "%d objects couldn't be updated, keeping last applied state for the next run",
+                    len(self.failed_objects),
+                )
+            else:
+                state.set_last_commit(self.settings.fmg_adom, head_commit)
+            state.record_objects(
+                self.settings.fmg_adom,
+                self._applied_object_states(repo_data, fmg_templates, head_commit, self.failed_objects, fmg_versions),
+            )
+            if fmg_versions is not None:
+                state.record_fmg_versions(self.settings.fmg_adom, fmg_versions)
+            if self.failed_objects:
+                # an older state of a failed object must not be trusted
+                state.forget_objects(
+                    self.settings.fmg_adom,
+                    (
+                        (kind, obj.name)
+                        for kind in TREE_KINDS
+                        for obj in getattr(repo_data, kind)
+                        if obj.name in self.failed_objects
+                    ),
+                )
+            if to_delete:
+                state.forget_objects(
+                    self.settings.fmg_adom,
+                    ((kind, obj.name) for kind in TREE_KINDS for obj in getattr(to_delete, kind)),
+                )
+
+    @property
+    def _sync_state_path(self) -> Path:
+        return self.settings.cache_dir / "sync-state.sqlite"
+
+    def _open_sync_state(self) -> SyncState:
+        """Open local sync state database
+
+        The state is recorded on every production run regardless of `incremental_sync` and `sync_state_ttl`: the
+        recorded object versions let the next run skip loading template scripts which are known to be current.
+        """
+        return SyncState(self._sync_state_path)
+
+    @staticmethod
+    def _select_stale_objects(
+        repo_tree: TemplateTree,
+        object_states: Dict[Tuple[str, str], ObjectState],
+        ttl: int,
+        now: Optional[float] = None,
+    ) -> TemplateTree:
+        """Select objects which need to be compared with FMG
+
+        An object is trusted to be the same in FMG if it was applied with the same fingerprint within `ttl` seconds.
+
+        Args:
+            repo_tree: templates and template groups from the repository
+            object_states: last applied object states by (kind, name)
+            ttl: seconds to trust the recorded state
+            now: current time (for testing)
+
+        Returns:
+            objects which are new, changed or have an outdated state
+        """
+        now = time.time() if now is None else now
+
+        def is_stale(kind: str, obj: Union[CLITemplate, CLITemplateGroup]) -> bool:
+            state = object_states.get((kind, obj.name))
+            return state is None or state.fingerprint != obj.fingerprint or now - state.updated > ttl
+
+        selected = TemplateTree(
+            **{kind: [obj for obj in getattr(repo_tree, kind) if is_stale(kind, obj)] for kind in TREE_KINDS}
+        )
+        skipped = len(repo_tree.names) - len(selected.names)
+        if skipped:
+            logger.info("Skipping %d objects unchanged since last sync", skipped)
+        return selected
+
+    @staticmethod
+    def _applied_object_states(
+        repo_tree: TemplateTree,
+        fmg_tree: TemplateTree,
+        commit: str,
+        failed: Optional[Set[str]] = None,
+        fmg_versions: Optional[Dict[Tuple[str, str], Optional[int]]] = None,
+    ) -> Iterator[ObjectState]:
+        """Get state of the repository objects after a successful sync
+
+        Args:
+            repo_tree: synced templates and template groups from the repository
+            fmg_tree: templates and template groups loaded from FMG before the sync
+            commit: commit SHA of the repository
+            failed: names of objects which couldn't be updated
+            fmg_versions: FMG object versions after the sync if known
+
+        Yields:
+            state of every synced object, without FMG versions after the sync the version is kept only for objects
+            which were unchanged
+        """
+        for kind in TREE_KINDS:
+            fmg_index = {obj.name: obj for obj in getattr(fmg_tree, kind)}
+            for obj in getattr(repo_tree, kind):
+                if failed and obj.name in failed:
+                    continue
+                fmg_obj = fmg_index.get(obj.name)
+                if fmg_versions is not None:
+                    version = fmg_versions.get((kind, obj.name))
+                elif fmg_obj is not None and fmg_obj.fingerprint == obj.fingerprint:
+                    version = fmg_obj.version
+                else:
+                    version = None
+                yield ObjectState(kind=kind, name=obj.name, fingerprint=obj.fingerprint, version=version, commit=commit)
+
+    @staticmethod
+    def _get_repo_changes(repo: Repo, since: Optional[str], until: Optional[Commit] = None) -> Optional[RepoChanges]:
+        """Collect changed objects in the repository since the given commit
+
+        Args:
+            repo: template repository
+            since: commit SHA of the last successful sync
+            until: commit to compare to (HEAD by default)
+
+        Returns:
+            changed and deleted object names or None if full sync is needed
+        """
+        if not since:
+            logger.info("No previous successful sync recorded, running full sync")
+            return None
+        try:
+            diff = repo.commit(since).diff(until or repo.head.commit, paths=list(REPO_DIRS))
+        except (ValueError, BadName, GitCommandError) as err:
+            logger.warning("Last synced commit %s is not available (%s), running full sync", since, err)
+            return None
+        changes = RepoChanges(
+            changed={directory: set() for directory in REPO_DIRS}, deleted={directory: set() for directory in REPO_DIRS}
+        )
+        for item in diff:
+            if item.deleted_file:
+                paths = [(item.a_path, changes.deleted)]
+            elif item.renamed_file:
+                paths = [(item.a_path, changes.deleted), (item.b_path, changes.changed)]
+            else:
+                paths = [(item.b_path, changes.changed)]
+            for path, target in paths:
+                directory, _, file_name = path.rpartition("/")
+                if directory in REPO_DIRS and file_name.endswith(".j2"):
+                    target[directory].add(file_name[: -len(".j2")])
+        logger.info(
+            "Changes since %s: %d changed, %d deleted objects",
+            since,
+            sum(len(names) for names in changes.changed.values()),
+            sum(len(names) for names in changes.deleted.values()),
+        )
+        return changes
+
+    @staticmethod
+    def _select_changed_objects(repo_data: TemplateTree, changes: RepoChanges) -> TemplateTree:
+        """Select repository objects affected by the changes
+
+        Template groups are affected by their own change and by the change of any of their (nested) members.
+        """
+        changed_templates = changes.changed.get("templates", set())
+        # index groups by their members to find the affected ones
+        member_of: Dict[str, List[str]] = {}
+        for group in repo_data.template_groups:
+            for member in group.member or []:
+                member_of.setdefault(member, []).append(group.name)
+        affected_groups = set(changes.changed["template-groups"])
+        to_check = list(changed_templates | affected_groups)
+        while to_check:
+            for group_name in member_of.get(to_check.pop(), []):
+                if group_name not in affected_groups:
+                    affected_groups.add(group_name)
+                    to_check.append(group_name)
+        return TemplateTree(
+            pre_run_templates=[
+                template for template in repo_data.pre_run_templates if template.name in changes.changed["pre-run"]
+            ],
+            templates=[template for template in repo_data.templates if template.name in changed_templates],
+            template_groups=[group for group in repo_data.template_groups if group.name in affected_groups],
+        )
+
     def _update_local_repository(self) -> Optional[Repo]:
         """Clone or update local repository
 
@@ -125,17 +629,33 @@ class FMGSyncTask(CommonTask):
         Returns:
             Repository with cloned templates
         """
+        if self.settings.repo_mode == "bare":
+            return self._update_bare_repository()
         logger.info("Checking out template repository")
+        fetch_options = self._git_fetch_options()
         try:
             repo = Repo(self.settings.local_repo)
-            repo.git.pull()  # download updates
-            repo.git.checkout(self.settings.template_branch)
+            if self.settings.git_sparse:
+                repo.git.sparse_checkout("set", *REPO_DIRS)
+            if fetch_options or self.settings.git_single_branch:
+                # fetch only the template branch and move local branch to it
+                repo.git.fetch(self.settings.template_repo, self.settings.template_branch, **fetch_options)
+                repo.git.checkout("-B", self.settings.template_branch, "FETCH_HEAD")
+            else:
+                repo.git.pull()  # download updates
+                repo.git.checkout(self.settings.template_branch)
             return repo
         except InvalidGitRepositoryError:  # in case of an empty directory
             logger.info("Cloning template repository")
             repo = Repo.clone_from(
-                url=self.settings.template_repo, to_path=self.settings.local_repo, branch=self.settings.template_branch
+                url=self.settings.template_repo,
+                to_path=self.settings.local_repo,
+                branch=self.settings.template_branch,
+                sparse=self.settings.git_sparse,
+                **self._git_clone_options(),
             )
+            if self.settings.git_sparse:
+                repo.git.sparse_checkout("set", *REPO_DIRS)
             return repo
         except GitCommandError:
             logger.error(
@@ -143,44 +663,217 @@ class FMGSyncTask(CommonTask):
             )
             raise
 
-    def _load_local_repository(self) -> TemplateTree:
-        """Load files from repository"""
+    def _update_bare_repository(self) -> Repo:
+        """Clone or update local repository without working tree
+
+        Only the template branch is fetched to `origin/<template_branch>`. An existing repository with working tree
+        can be used as well, its working tree is left untouched.
+
+        Returns:
+            Repository with fetched templates
+        """
+        logger.info("Fetching template repository")
+        try:
+            repo = Repo(self.settings.local_repo)
+        except InvalidGitRepositoryError:  # in case of an empty directory
+            logger.info("Cloning bare template repository")
+            repo = Repo.clone_from(
+                url=self.settings.template_repo,
+                to_path=self.settings.local_repo,
+                branch=self.settings.template_branch,
+                bare=True,
+                **self._git_clone_options(),
+            )
+        branch = self.settings.template_branch
+        try:
+            repo.git.fetch(
+                self.settings.template_repo,
+                f"+refs/heads/{branch}:refs/remotes/origin/{branch}",
+                **self._git_fetch_options(),
+            )
+        except GitCommandError:
+            logger.error("Can't fetch repo: '%s' branch: '%s'", self.settings.template_repo, branch)
+            raise
+        return repo
+
+    def _git_fetch_options(self) -> Dict[str, Union[str, int]]:
+        """Git options to limit the size of fetches"""
+        options: Dict[str, Union[str, int]] = {}
+        if self.settings.git_depth:
+            options["depth"] = self.settings.git_depth
+        if self.settings.git_filter:
+            options["filter"] = self.settings.git_filter
+        return options
+
+    def _git_clone_options(self) -> Dict[str, Union[str, int, bool]]:
+        """Git options to limit the size of the clone"""
+        options: Dict[str, Union[str, int, bool]] = dict(self._git_fetch_options())
+        if self.settings.git_single_branch:
+            options["single_branch"] = True
+        return options
+
+    def _target_commit(self, repo: Repo) -> Commit:
+        """Get the commit to sync from
+
+        Args:
+            repo: template repository
+
+        Returns:
+            checked out commit or the fetched branch commit in bare mode
+        """
+        if self.settings.repo_mode == "bare":
+            return repo.commit(f"origin/{self.settings.template_branch}")
+        return repo.head.commit
+
+    def _load_local_repository(self, commit: Optional[Commit] = None) -> TemplateTree:
+        """Load files from repository
+
+        Unchanged files are taken from the parse cache if it's enabled.
+
+        Args:
+            commit: read files of this commit from the git object database instead of the working tree
+        """
         logger.info("Load files from repository")
-        template_path = Path(self.settings.local_repo) / "templates"
-        templates = []
-        if template_path.is_dir():
-            logger.debug("Loading templates from %s", template_path)
-            for template_file in template_path.glob("*.j2"):
-                with open(template_file) as fi:
-                    data = fi.read()
-                    parsed_data = self._parse_template_data(name=template_file.name.replace(".j2", ""), data=data)
-                    templates.append(parsed_data)
+        cache = self._open_parse_cache()
+        try:
+            templates = self._load_templates(list(self._iter_repo_files("templates", commit)), cache)
 
-        pre_run_templates = []
-        template_path = Path(self.settings.local_repo) / "pre-run"
-        if template_path.is_dir():
-            logger.debug("Loading pre-run templates from %s", template_path)
-            for template_file in template_path.glob("*.j2"):
-                with open(template_file) as fi:
-                    data = fi.read()
-                    parsed_data = self._parse_template_data(name=template_file.name.replace(".j2", ""), data=data)
-                    parsed_data.provision = "enable"
-                    pre_run_templates.append(parsed_data)
-
-        template_groups = []
-        template_path = Path(self.settings.local_repo) / "template-groups"
-        if template_path.is_dir():
-            logger.debug("Loading template groups from %s", template_path)
-            for template_group_file in template_path.glob("*.j2"):
-                with open(template_group_file) as fi:
-                    data = fi.read()
-                    parsed_data = self._parse_template_groups_data(
-                        name=template_group_file.name.replace(".j2", ""), data=data, templates=templates
-                    )
-                    template_groups.append(parsed_data)
+            pre_run_templates = self._load_templates(list(self._iter_repo_files("pre-run", commit)), cache)
+            for template in pre_run_templates:
+                template.provision = "enable"
+
+            template_groups = [
+                self._load_template_group(name, data, cache, sha)
+                for name, sha, data in self._iter_repo_files("template-groups", commit)
+            ]
+            self._resolve_group_variables(template_groups, templates)
+        finally:
+            if cache:
+                cache.save()
 
         return TemplateTree(templates=templates, pre_run_templates=pre_run_templates, template_groups=template_groups)
 
+    def _iter_repo_files(self, directory: str, commit: Optional[Commit] = None) -> Iterator[Tuple[str, str, str]]:
+        """Iterate over template files in a repository directory
+
+        Args:
+            directory: directory name in the repository (e.g. templates)
+            commit: read files of this commit from the git object database instead of the working tree
+
+        Yields:
+            tuple of object name (file name without extension), git blob SHA and file content
+        """
+        if commit is not None:
+            yield from self._iter_commit_files(directory, commit)
+            return
+        template_path = Path(self.settings.local_repo) / directory
+        if not template_path.is_dir():
+            return
+        logger.debug("Loading %s from %s", directory, template_path)
+        for template_file in template_path.glob("*.j2"):
+            with open(template_file) as fi:
+                data = fi.read()
+                yield template_file.name.replace(".j2", ""), git_blob_sha(data), data
+
+    @staticmethod
+    def _iter_commit_files(directory: str, commit: Commit) -> Iterator[Tuple[str, str, str]]:
+        """Iterate over template files of a commit
+
+        Objects are read through the persistent `git cat-file --batch` process of the repository, no working tree
+        is needed.
+
+        Args:
+            directory: directory name in the repository (e.g. templates)
+            commit: commit to read
+
+        Yields:
+            tuple of object name (file name without extension), git blob SHA and file content
+        """
+        try:
+            tree = commit.tree / directory
+        except KeyError:
+            return
+        logger.debug("Loading %s from commit %s", directory, commit.hexsha)
+        for blob in tree.blobs:
+            if blob.name.endswith(".j2"):
+                yield blob.name[: -len(".j2")], blob.hexsha, blob.data_stream.read().decode("utf-8")
+
+    def _open_parse_cache(self) -> Optional[ParseCache]:
+        """Open parse cache if it's enabled"""
+        if not self.settings.parse_cache:
+            return None
+        return ParseCache(
+            path=self.settings.cache_dir / "parse-cache.json",
+            parser_version=PARSER_VERSION,
+            max_entries=self.settings.parse_cache_size,
+        )
+
+    def _load_templates(
+        self, files: List[Tuple[str, str, str]], cache: Optional[ParseCache] = None
+    ) -> List[CLITemplate]:
+        """Parse templates or take them from the cache
+
+        Args:
+            files: list of object name, git blob SHA and file content
+            cache: parse cache to use
+
+        Returns:
+            templates in the order of files
+        """
+        entries = [cache.get("template", sha) if cache else None for _, sha, _ in files]
+        to_parse = [index for index, entry in enumerate(entries) if entry is None]
+        parsed_entries = self._parse_templates([(files[index][0], files[index][2]) for index in to_parse])
+        for index, entry in zip(to_parse, parsed_entries):
+            entries[index] = entry
+            if cache:
+                cache.put("template", files[index][1], entry)
+        return [CLITemplate(name=name, script=data, **entry) for (name, _, data), entry in zip(files, entries)]
+
+    def _parse_templates(self, files: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        """Parse template files, in a process pool if there are enough of them
+
+        Args:
+            files: list of object name and file content
+
+        Returns:
+            compact parse results in the order of files
+        """
+        workers = self.settings.parse_workers
+        if workers > 1 and len(files) >= PARALLEL_PARSE_MIN_FILES:
+            logger.debug("Parsing %d templates with %d workers", len(files), workers)
+            names, contents = zip(*files)
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                return list(
+                    executor.map(parse_template_entry, names, contents, chunksize=max(1, len(files) // (workers * 4)))
+                )
+        return [parse_template_entry(name, data) for name, data in files]
+
+    @classmethod
+    def _load_template_group(
+        cls, name: str, data: str, cache: Optional[ParseCache] = None, sha: Optional[str] = None
+    ) -> CLITemplateGroup:
+        """Parse template group or take it from the cache
+
+        Variables are not resolved here as they are derived from the members.
+        """
+        if cache is None:
+            return cls._parse_template_groups_data(name=name, data=data)
+        sha = sha or git_blob_sha(data)
+        entry = cache.get("group", sha)
+        if entry is not None:
+            return CLITemplateGroup(name=name, variables=[], **entry)
+        template_group = cls._parse_template_groups_data(name=name, data=data)
+        cache.put(
+            "group",
+            sha,
+            {
+                "description": template_group.description,
+                "member": template_group.member,
+                "scope_member": template_group.scope_member,
+            },
+        )
+        return template_group
+
     @staticmethod
     def _parse_template_data(name: str, data: str) -> CLITemplate:
         """Parse template script text
@@ -228,7 +921,11 @@ class FMGSyncTask(CommonTask):
                     logger.warning("Assignment target of '%s' at template '%s' is not valid JSON!")
                     raise
 
-        template_vars = find_all_vars(data)
+        analysis = analyzer.analyze(data)
+        if analysis.error:
+            logger.error("Template '%s' has syntax error: %s", name, analysis.error)
+            raise analysis.error
+        template_vars = analysis.variables
         # filter out built-in datasource
         template_vars = [var for var in template_vars if not var.startswith("DVMDB")]
         # filter out already documented variables
@@ -244,11 +941,18 @@ class FMGSyncTask(CommonTask):
     def _parse_template_groups_data(
         name: str, data: str, templates: Optional[List[CLITemplate]] = None
     ) -> CLITemplateGroup:
-        """Parse template group file"""
+        """Parse template group file
+
+        Members are the included templates (`templates/*.j2`) and template groups (`template-groups/*.j2`).
+
+        Args:
+            name (str): name of the template group (file name without extension)
+            data (str): raw text of the template group file
+            templates (List[CLITemplate]): templates to resolve the group variables from
+        """
         logger.debug("Parsing '%s' group", name)
-        description = None
+        description = ""
         members = []
-        variables = []
         scope_members = None
         # gather metadata
         match = re.match(r"^{#(.*?)#}", data, re.S + re.I)
@@ -265,46 +969,158 @@ class FMGSyncTask(CommonTask):
                     logger.warning("Assignment target of '%s' at template '%s' is not valid JSON!")
                     raise
         # gather members
-        for match in re.finditer(r"{%\s*include\s*\"templates/(?P<member>.*).j2\"\s*%}", data, re.M):
-            members.append(match.group("member"))
-        # gather variables
-        for template in templates:
-            variables.extend(template.variables)  # flat out lists
-        # deduplicate and sanity check on variables
-        variables = sanitize_variables(variables=variables)
-
-        return CLITemplateGroup(
-            name=name, description=description, member=members, variables=variables, scope_member=scope_members
+        analysis = analyzer.analyze(data)
+        if analysis.error:
+            logger.error("Template group '%s' has syntax error: %s", name, analysis.error)
+            raise analysis.error
+        for include in analysis.includes:
+            match = re.fullmatch(r"(?:templates|template-groups)/(?P<member>.*)\.j2", include)
+            if match:
+                members.append(match.group("member"))
+
+        template_group = CLITemplateGroup(
+            name=name, description=description, member=members, variables=[], scope_member=scope_members
         )
+        if templates is not None:
+            FMGSyncTask._resolve_group_variables([template_group], templates)
+        return template_group
+
+    @staticmethod
+    def _resolve_group_variables(template_groups: List[CLITemplateGroup], templates: List[CLITemplate]):
+        """Set variables of template groups from their members
+
+        Variables are collected from the member templates and recursively from the member groups. Every group is
+        resolved only once.
+
+        Args:
+            template_groups: template groups to resolve, they can be members of each other
+            templates: templates which can be members of the groups
+
+        Raises:
+            FMGSyncException: on template group include loop
+            FMGSyncVariableException: on conflicting variable definitions
+        """
+        template_index = {template.name: template for template in templates}
+        group_index = {group.name: group for group in template_groups}
+        resolved: Dict[str, List[Variable]] = {}
+
+        def resolve(group: CLITemplateGroup, path: Tuple[str, ...]) -> List[Variable]:
+            if group.name in resolved:
+                return resolved[group.name]
+            if group.name in path:
+                error = f"Template group include loop: {' -> '.join(path + (group.name,))}"
+                logger.error(error)
+                raise FMGSyncException(error)
+            variables = []
+            for member in group.member or []:
+                if member in template_index:
+                    variables.extend(template_index[member].variables or [])
+                elif member in group_index:
+                    variables.extend(resolve(group_index[member], path + (group.name,)))
+                else:
+                    logger.warning("Member '%s' of template group '%s' is not in the repository", member, group.name)
+            # deduplicate and sanity check on variables
+            resolved[group.name] = sanitize_variables(variables=variables)
+            return resolved[group.name]
+
+        for template_group in template_groups:
+            template_group.variables = resolve(template_group, ())
 
-    def _load_fmg_templates(self) -> TemplateTree:
-        """Load template data from FMG"""
+    def _load_fmg_templates(
+        self,
+        names: Optional[Set[str]] = None,
+        repo_data: Optional[TemplateTree] = None,
+        object_states: Optional[Dict[Tuple[str, str], ObjectState]] = None,
+    ) -> TemplateTree:
+        """Load template data from FMG
+
+        Without recorded object versions templates are loaded with their scripts in one request. With recorded
+        versions template metadata is loaded first and scripts are fetched only for templates which may differ from the
+        repository. The others get the script of their repository version.
+
+        Args:
+            names: load only these templates and template groups (all by default)
+            repo_data: templates and template groups from the repository
+            object_states: last applied object states by (kind, name)
+        """
         logger.info("Loading templates from FMG")
-        all_templates = self.fmg.get_cli_templates()
-        pre_run_templates = [
-            CLITemplate(
-                name=template["name"],
-                description=template.get("description"),
-                provision="enable",
-                script=template["script"],
-                variables=[Variable(name=var) for var in template["variables"]],
+        filters = F(name__in=sorted(names)) if names is not None else None
+        if names is not None and not names:
+            return TemplateTree(templates=[], pre_run_templates=[], template_groups=[])
+        # two-phase load only pays off if object versions are known
+        if self._use_two_phase_load(repo_data, object_states):
+            all_templates = self._load_fmg_template_data(filters, repo_data, object_states)
+        else:
+            all_templates = self.fmg.iter_cli_templates(filters=filters, page_size=self.settings.fmg_page_size)
+        all_groups = self.fmg.iter_cli_template_groups(filters=filters, page_size=self.settings.fmg_page_size)
+        return self._build_fmg_tree(all_templates, all_groups)
+
+    async def _load_fmg_templates_async(
+        self,
+        names: Optional[Set[str]] = None,
+        repo_data: Optional[TemplateTree] = None,
+        object_states: Optional[Dict[Tuple[str, str], ObjectState]] = None,
+    ) -> TemplateTree:
+        """Load template data from FMG on the asyncio connection
+
+        Templates and template groups are loaded concurrently, see `_load_fmg_templates`.
+        """
+        logger.info("Loading templates from FMG")
+        filters = F(name__in=sorted(names)) if names is not None else None
+        if names is not None and not names:
+            return TemplateTree(templates=[], pre_run_templates=[], template_groups=[])
+        if self._use_two_phase_load(repo_data, object_states):
+            load_templates = self._load_fmg_template_data_async(filters, repo_data, object_states)
+        else:
+            load_templates = self._collect(
+                self.fmg.iter_cli_templates(filters=filters, page_size=self.settings.fmg_page_size)
             )
-            for template in all_templates.data.get("data")
-            if template.get("provision") == 1
-        ]
-        logger.debug("%d pre-run templates loaded", len(pre_run_templates))
-        templates = [
-            CLITemplate(
-                name=template["name"],
-                description=template.get("description"),
-                script=template["script"],
-                variables=[Variable(name=var) for var in template["variables"]],
+        all_templates, all_groups = await asyncio.gather(
+            load_templates,
+            self._collect(self.fmg.iter_cli_template_groups(filters=filters, page_size=self.settings.fmg_page_size)),
+        )
+        return self._build_fmg_tree(all_templates, all_groups)
+
+    @staticmethod
+    async def _collect(objects: AsyncIterator[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [obj async for obj in objects]
+
+    @staticmethod
+    def _use_two_phase_load(
+        repo_data: Optional[TemplateTree], object_states: Optional[Dict[Tuple[str, str], ObjectState]]
+    ) -> bool:
+        return bool(repo_data is not None and object_states and any(state.version for state in object_states.values()))
+
+    @staticmethod
+    def _build_fmg_tree(all_templates: Iterable[Dict[str, Any]], all_groups: Iterable[Dict[str, Any]]) -> TemplateTree:
+        """Build template tree from raw FMG data
+
+        Args:
+            all_templates: template data as FMG returns it
+            all_groups: template group data as FMG returns it
+        """
+        pre_run_templates = []
+        templates = []
+        for template in all_templates:
+            if template.get("provision") == 1:
+                template_list, provision = pre_run_templates, "enable"
+            elif template.get("provision") == 0:
+                template_list, provision = templates, "disable"
+            else:
+                continue
+            template_list.append(
+                CLITemplate(
+                    name=template["name"],
+                    description=template.get("description"),
+                    provision=provision,
+                    script=template["script"],
+                    variables=[Variable(name=var) for var in template["variables"]],
+                    scope_member=template.get("scope member"),
+                    version=template.get("obj ver"),
+                )
             )
-            for template in all_templates.data.get("data")
-            if template.get("provision") == 0
-        ]
+        logger.debug("%d pre-run templates loaded", len(pre_run_templates))
         logger.debug("%d templates loaded", len(templates))
-        all_groups = self.fmg.get_cli_template_groups()
         template_groups = [
             CLITemplateGroup(
                 name=group["name"],
@@ -312,158 +1128,551 @@ class FMGSyncTask(CommonTask):
                 member=group.get("member"),
                 variables=[Variable(name=var) for var in group["variables"]],
                 scope_member=group.get("scope member"),
+                version=group.get("obj ver"),
             )
-            for group in all_groups.data.get("data")
+            for group in all_groups
         ]
         logger.debug("%d template groups loaded", len(template_groups))
         return TemplateTree(templates=templates, pre_run_templates=pre_run_templates, template_groups=template_groups)
 
+    def _load_fmg_template_data(
+        self,
+        filters: Optional[FILTER_TYPE],
+        repo_data: TemplateTree,
+        object_states: Dict[Tuple[str, str], ObjectState],
+    ) -> List[Dict[str, Any]]:
+        """Load raw template data from FMG in two phases
+
+        1. load metadata of the templates without scripts
+        2. load scripts in batches for templates which may differ from the repository
+
+        Args:
+            filters: FMG filter of the templates
+            repo_data: templates and template groups from the repository
+            object_states: last applied object states by (kind, name)
+
+        Returns:
+            template data as FMG returns it
+        """
+        all_templates = list(
+            self.fmg.iter_cli_templates(
+                filters=filters, fields=TEMPLATE_METADATA_FIELDS, page_size=self.settings.fmg_page_size
+            )
+        )
+        for batch in chunked(self._scripts_to_fetch(all_templates, repo_data, object_states), SCRIPT_FETCH_BATCH):
+            self._set_scripts(batch, self.fmg.get_cli_templates(**self._scripts_request(batch)))
+        return all_templates
+
+    async def _load_fmg_template_data_async(
+        self,
+        filters: Optional[FILTER_TYPE],
+        repo_data: TemplateTree,
+        object_states: Dict[Tuple[str, str], ObjectState],
+    ) -> List[Dict[str, Any]]:
+        """Load raw template data from FMG in two phases on the asyncio connection
+
+        Script batches are loaded concurrently, see `_load_fmg_template_data`.
+        """
+        all_templates = await self._collect(
+            self.fmg.iter_cli_templates(
+                filters=filters, fields=TEMPLATE_METADATA_FIELDS, page_size=self.settings.fmg_page_size
+            )
+        )
+        batches = list(chunked(self._scripts_to_fetch(all_templates, repo_data, object_states), SCRIPT_FETCH_BATCH))
+        responses = await asyncio.gather(
+            *(self.fmg.get_cli_templates(**self._scripts_request(batch)) for batch in batches)
+        )
+        for batch, response in zip(batches, responses):
+            self._set_scripts(batch, response)
+        return all_templates
+
+    def _scripts_to_fetch(
+        self,
+        all_templates: List[Dict[str, Any]],
+        repo_data: TemplateTree,
+        object_states: Dict[Tuple[str, str], ObjectState],
+    ) -> List[Dict[str, Any]]:
+        """Select templates which may differ from the repository
+
+        Templates which are known to be the same get the script of their repository version.
+
+        Returns:
+            metadata of the templates to load the script of
+        """
+        repo_templates = {
+            template.name: (kind, template)
+            for kind in ("pre_run_templates", "templates")
+            for template in getattr(repo_data, kind)
+        }
+        to_fetch = []
+        for template in all_templates:
+            kind, repo_template = repo_templates.get(template["name"], (None, None))
+            if repo_template is None:
+                # not in the repository, script is not compared
+                template["script"] = ""
+                continue
+            if self._is_fmg_script_current(object_states.get((kind, repo_template.name)), repo_template, template):
+                template["script"] = repo_template.script
+            else:
+                template["script"] = ""  # in case FMG doesn't return it
+                to_fetch.append(template)
+        logger.debug("Loading scripts of %d out of %d templates", len(to_fetch), len(all_templates))
+        return to_fetch
+
+    @staticmethod
+    def _scripts_request(batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return {"filters": F(name__in=sorted(template["name"] for template in batch)), "fields": ["name", "script"]}
+
+    @staticmethod
+    def _set_scripts(batch: List[Dict[str, Any]], response: Any):
+        batch_index = {template["name"]: template for template in batch}
+        for script in response.data.get("data"):
+            batch_index[script["name"]]["script"] = script["script"]
+
     @staticmethod
-    def _find_unused_templates(repo_tree: TemplateTree, fmg_tree: TemplateTree) -> TemplateTree:
+    def _is_fmg_script_current(
+        state: Optional[ObjectState], repo_template: CLITemplate, fmg_metadata: Dict[str, Any]
+    ) -> bool:
+        """Check if the FMG script is known to be the same as in the repository
+
+        The script is the same if the template was applied with the same fingerprint and FMG still reports the same
+        object version. Without object version the script is not trusted.
+
+        Args:
+            state: last applied state of the template
+            repo_template: template from the repository
+            fmg_metadata: template metadata from FMG
+
+        Returns:
+            True if the script doesn't need to be fetched
+        """
+        return (
+            state is not None
+            and state.fingerprint == repo_template.fingerprint
+            and state.version is not None
+            and state.version == fmg_metadata.get("obj ver")
+        )
+
+    @staticmethod
+    def _find_unused_templates(repo_tree: TemplateTree, fmg_tree: TemplateTree, explain: bool = False) -> TemplateTree:
         """Find undefined or unused templates or groups in FMG
 
         A template or template group is unused if:
 
         1. is not assigned to any device or group
         2. does not belong to any template-group
+
+        Args:
+            repo_tree: templates and template groups from the repository
+            fmg_tree: templates and template groups from FMG
+            explain: log why objects missing from the repository are kept
+
+        Returns:
+            unused objects, template groups are in safe deletion order
         """
-        # pre-run templates cannot be part of any group
-        to_del_pre_run = [
-            template
-            for template in fmg_tree.pre_run_templates
-            if template.name not in repo_tree.pre_run_templates and not template.scope_member
-        ]
-        # find all template groups which may be deleted
-        to_del_groups = []
-        fmg_groups = copy(fmg_tree.template_groups)
-        while True:
-            groups = [
-                group
-                for group in fmg_groups
-                if group.name not in repo_tree.template_groups  # not in repo
-                and not group.scope_member  # not assigned
-                and not any(group.name in other.member for other in fmg_groups if other.member)  # not a member
-            ]
-            if groups:  # found to be deleted groups
-                to_del_groups.extend(groups)
-                fmg_groups = [
-                    group for group in fmg_groups if group not in groups
-                ]  # remove to be deleted groups from list
-                # go and check for more groups to be deleted
-            else:  # no more to be deleted groups found
-                break
-
-        to_del_templates = [
-            template
-            for template in fmg_tree.templates
-            if template.name not in repo_tree.templates
-            and not template.scope_member
-            and not any(template.name in group.member for group in fmg_groups if group.member)
-        ]
-        return TemplateTree(pre_run_templates=to_del_pre_run, templates=to_del_templates, template_groups=to_del_groups)
+        unused = MembershipGraph(fmg_tree).find_unused(repo_tree)
+        if explain:
+            for (_, name), reason in unused.keep_reasons.items():
+                logger.info("TEST - keeping '%s' which is not in the repository: %s", name, reason)
+        return unused.to_delete
 
-    def _delete_templates(self, templates: TemplateTree):
+    def _delete_templates(self, templates: TemplateTree) -> bool:
         """Delete templates and template groups
 
+        Template groups are deleted before their members, independent objects are deleted concurrently.
+
         Args:
             templates (TemplateTree): template tree object containing CLI templates/groups to delete
+
+        Returns:
+            True if anything was deleted
+
+        Raises:
+            FMGSyncDeleteError: if any object couldn't be deleted
+        """
+        nodes = self._deletion_nodes(templates)
+        if nodes is None:
+            return bool(templates)
+        return self._check_deletion(self._apply_executor().run(nodes))
+
+    async def _delete_templates_async(self, templates: TemplateTree) -> bool:
+        """Delete templates and template groups on the asyncio connection, see `_delete_templates`"""
+        nodes = self._deletion_nodes(templates)
+        if nodes is None:
+            return bool(templates)
+        return self._check_deletion(await (await self._async_apply_executor()).run_async(nodes))
+
+    def _deletion_nodes(self, templates: TemplateTree) -> Optional[List[ApplyNode]]:
+        """Build deletion operations, template groups are deleted before their members
+
+        Returns:
+            deletion nodes or None on test run
         """
         logger.info("Deleting unused templates and template-groups")
-        for template_group in templates.template_groups:
-            if self.settings.prod_run:
-                logger.info("Deleting template group '%s'", template_group.name)
-                response = self.fmg.delete_cli_template_group(template_group.name)
-                if not response.success:
-                    error = f"Error deleting '{template_group.name}' template group: {response.data}"
-                    logger.warning(error)
-                    raise FMGSyncDeleteError(error)
-            else:
+        if not self.settings.prod_run:
+            for template_group in templates.template_groups:
                 logger.info("TEST - deleting template group '%s'", template_group.name)
-        for template in templates.pre_run_templates + templates.templates:
-            if self.settings.prod_run:
-                logger.info("Deleting template '%s'", template.name)
-                response = self.fmg.delete_cli_template(template.name)
-                if not response.success:
-                    error = f"Error deleting '{template.name}' template: {response.data}"
-                    logger.warning(error)
-                    raise FMGSyncDeleteError(error)
-            else:
+            for template in templates.pre_run_templates + templates.templates:
                 logger.info("TEST - deleting template '%s'", template.name)
+            return None
+        # members can be deleted only after all groups they belong to
+        deleted_groups_of: Dict[str, List[Tuple[str, str]]] = {}
+        for template_group in templates.template_groups:
+            for member in template_group.member or []:
+                deleted_groups_of.setdefault(member, []).append(("template group", template_group.name))
+        nodes = []
+        for kind_name, objects, build_operation in (
+            ("template group", templates.template_groups, self.fmg.delete_cli_template_group_operation),
+            ("template", templates.pre_run_templates + templates.templates, self.fmg.delete_cli_template_operation),
+        ):
+            for obj in objects:
+                logger.info("Deleting %s '%s'", kind_name, obj.name)
+                nodes.append(
+                    ApplyNode(
+                        key=(kind_name, obj.name),
+                        operation=build_operation(name=obj.name),
+                        depends_on=tuple(deleted_groups_of.get(obj.name, ())),
+                    )
+                )
+        return nodes
+
+    @staticmethod
+    def _check_deletion(result: ApplyResult) -> bool:
+        """Check result of the deletion
+
+        Returns:
+            True if anything was deleted
+
+        Raises:
+            FMGSyncDeleteError: if any object couldn't be deleted
+        """
+        errors = [f"Error deleting '{name}' {kind_name}: {error}" for (kind_name, name), error in result.failed.items()]
+        errors.extend(f"'{name}' {kind_name} was not deleted" for kind_name, name in result.cancelled)
+        for error in errors:
+            logger.warning(error)
+        if errors:
+            raise FMGSyncDeleteError("\n".join(errors))
+        return bool(result.succeeded)
 
     @staticmethod
     def _changed_templates(repo_data: TemplateTree, fmg_data: TemplateTree) -> TemplateTree:
-        """Determine to be updated templates and template groups"""
-        # check pre-run templates first
-        update_pre_run_templates = []
-        for template in repo_data.pre_run_templates:
-            # search for existing template
-            fmg_template = first(
-                (templ for templ in fmg_data.pre_run_templates if template.name == templ.name), default=None
-            )
-            # if template need to be updated, add it to the list
-            if fmg_template != template:
-                update_pre_run_templates.append(template)
-        # check templates
-        update_templates = []
-        for template in repo_data.templates:
-            # search for existing template
-            fmg_template = first((templ for templ in fmg_data.templates if template.name == templ.name), default=None)
-            # if template need to be updated, add it to the list
-            if fmg_template != template:
-                update_templates.append(template)
-        # check template groups
-        update_template_groups = []
-        for group in repo_data.template_groups:
-            # search for existing template
-            fmg_group = first((grp for grp in fmg_data.template_groups if group.name == grp.name), default=None)
-            # if template group need to be updated, add it to the list
-            if fmg_group != group:
-                update_template_groups.append(group)
-        return TemplateTree(
-            templates=update_templates,
-            pre_run_templates=update_pre_run_templates,
-            template_groups=update_template_groups,
-        )
+        """Determine to be updated templates and template groups
+
+        Args:
+            repo_data: templates and template groups from the repository
+            fmg_data: templates and template groups from FMG
+
+        Returns:
+            new and modified repository objects
+        """
+        diff = diff_template_trees(repo_data, fmg_data)
+        for name, fields in diff.modified_fields.items():
+            logger.debug("'%s' differs in: %s", name, ", ".join(fields))
+        return diff.changed
+
+    def _apply_executor(self) -> ApplyExecutor:
+        """Prepare executor of FMG changes
+
+        The ADOM is locked in advance for concurrent workers, so they don't race for the lock.
+        """
+        workers = self.settings.apply_workers
+        if workers > 1:
+            self.fmg.set_connection_pool_size(workers)
+            if self.settings.fmg_adom not in self.fmg.lock.locked_adoms:
+                self.fmg.lock(self.settings.fmg_adom)
+        return ApplyExecutor(self.fmg, max_workers=workers, batch_size=self.settings.fmg_batch_size)
+
+    async def _async_apply_executor(self) -> ApplyExecutor:
+        """Prepare executor of FMG changes on the asyncio connection, see `_apply_executor`"""
+        workers = self.settings.apply_workers
+        if workers > 1 and self.settings.fmg_adom not in self.fmg.lock.locked_adoms:
+            await self.fmg.lock(self.settings.fmg_adom)
+        return ApplyExecutor(self.fmg, max_workers=workers, batch_size=self.settings.fmg_batch_size)
 
     def _update_fmg_templates(self, templates: TemplateTree, fmg_templates: TemplateTree) -> bool:
-        """Update templates and template groups"""
-        # need to update variables first
-        had_changed = False
-        to_add_vars = [variable for variable in templates.variables if variable.name not in fmg_templates.variables]
-        if to_add_vars:
-            logger.info("Adding missing variables")
-        for variable in to_add_vars:
-            if self.settings.prod_run:
-                result = self.fmg.set_fmg_variable(**variable.model_dump(by_alias=True))
-                if not result.success:
-                    logger.error("Error adding variable '%s'", variable.name)
-                    continue
-            else:
-                logger.info("TEST - Adding variable '%s'", variable.name)
-            had_changed = True
+        """Update templates and template groups
+
+        Changes are applied along their dependencies: variables, then templates using them, then template groups
+        including the templates, and finally the scope assignments. Independent changes are sent in batches and
+        concurrently. Objects which couldn't be written are collected in `failed_objects`, objects depending on them
+        are skipped.
+
+        Args:
+            templates: templates and template groups to update
+            fmg_templates: templates and template groups loaded from FMG
+
+        Returns:
+            True if anything was changed
+        """
+        nodes = self._update_nodes(templates, fmg_templates, self._load_fmg_variables(templates))
+        if nodes is None:
+            return bool(templates)
+        return self._record_update_result(self._apply_executor().run(nodes), templates)
+
+    async def _update_fmg_templates_async(self, templates: TemplateTree, fmg_templates: TemplateTree) -> bool:
+        """Update templates and template groups on the asyncio connection, see `_update_fmg_templates`"""
+        nodes = self._update_nodes(templates, fmg_templates, await self._load_fmg_variables_async(templates))
+        if nodes is None:
+            return bool(templates)
+        return self._record_update_result(await (await self._async_apply_executor()).run_async(nodes), templates)
+
+    def _load_fmg_variables(self, templates: TemplateTree) -> Dict[str, Variable]:
+        """Load the FMG metadata variable table if the templates use any variable
+
+        Returns:
+            FMG variables by name
+        """
+        if not templates.variables:
+            return {}
+        return self._index_variables(self.fmg.iter_fmg_variables(page_size=self.settings.fmg_page_size))
+
+    async def _load_fmg_variables_async(self, templates: TemplateTree) -> Dict[str, Variable]:
+        """Load the FMG metadata variable table on the asyncio connection, see `_load_fmg_variables`"""
+        if not templates.variables:
+            return {}
+        return self._index_variables(
+            await self._collect(self.fmg.iter_fmg_variables(page_size=self.settings.fmg_page_size))
+        )
+
+    @staticmethod
+    def _index_variables(all_variables: Iterable[Dict[str, Any]]) -> Dict[str, Variable]:
+        variables = {
+            variable["name"]: Variable(
+                name=variable["name"], description=variable.get("description"), value=variable.get("value")
+            )
+            for variable in all_variables
+        }
+        logger.debug("%d FMG variables loaded", len(variables))
+        return variables
+
+    @staticmethod
+    def _variables_to_set(variables: Iterable[Variable], fmg_variables: Dict[str, Variable]) -> List[Variable]:
+        """Select variables which are missing from FMG or differ in default value or description
+
+        Only attributes defined in the repository are compared, the others keep their FMG value.
+
+        Args:
+            variables: variables used by the templates
+            fmg_variables: FMG variables by name
+
+        Returns:
+            variables to set with their complete data
+        """
+        to_set = []
+        for variable in variables:
+            fmg_variable = fmg_variables.get(variable.name)
+            if fmg_variable is None:
+                to_set.append(variable)
+                continue
+            defined = variable.model_dump(include={"value", "description"}, exclude_none=True)
+            if any(value != getattr(fmg_variable, attribute) for attribute, value in defined.items()):
+                to_set.append(fmg_variable.model_copy(update=defined))
+        return to_set
+
+    def _update_nodes(
+        self, templates: TemplateTree, fmg_templates: TemplateTree, fmg_variables: Dict[str, Variable]
+    ) -> Optional[List[ApplyNode]]:
+        """Build update operations with their dependencies
 
+        Variables are set if they are missing from FMG or their default value or description differs. Objects are
+        only set when anything but their scope differs. Scope assignments are changed by the delta to the FMG scope
+        members: missing scopes are assigned and scopes missing from the repository header are unassigned.
+
+        Args:
+            templates: templates and template groups to update
+            fmg_templates: templates and template groups loaded from FMG
+            fmg_variables: FMG variables by name
+
+        Returns:
+            update nodes or None on test run
+        """
+        # need to update variables first
+        to_set_vars = self._variables_to_set(templates.variable_registry, fmg_variables)
+        if to_set_vars:
+            logger.info("Updating %d variables", len(to_set_vars))
         logger.info("Updating templates")
-        for template in (*templates.pre_run_templates, *templates.templates):
-            if self.settings.prod_run:
-                result = self.fmg.set_cli_template(**template.model_dump(by_alias=True))
-                if not result.success:
-                    logger.error("Error updating template '%s'", template.name)
-                    continue
-                elif template.scope_member:
-                    self.fmg.assign_cli_template(template.name, template.scope_member)
-            else:
-                logger.info("TEST - Updating template '%s'", template.name)
-            had_changed = True
+        template_changes = self._object_changes(
+            "template",
+            [*templates.pre_run_templates, *templates.templates],
+            [*fmg_templates.pre_run_templates, *fmg_templates.templates],
+        )
+        group_changes = self._object_changes("template group", templates.template_groups, fmg_templates.template_groups)
+        changes = template_changes + group_changes
+        if not self.settings.prod_run:
+            self._log_test_updates(to_set_vars, fmg_variables, changes)
+            return None
+        added_vars = {variable.name for variable in to_set_vars}
+        updated = {change.obj.name: (change.kind_name, change.obj.name) for change in changes if change.needs_set}
+        return [
+            *self._variable_nodes(to_set_vars),
+            *self._template_nodes(template_changes, added_vars),
+            *self._group_nodes(group_changes, added_vars, updated),
+            *self._assignment_nodes(changes),
+        ]
 
-        for template_group in templates.template_groups:
-            if self.settings.prod_run:
-                result = self.fmg.set_cli_template_group(**template_group.model_dump(by_alias=True))
-                if not result.success:
-                    logger.error("Error updating template group '%s'", template_group.name)
-                    continue
-                elif template_group.scope_member:
-                    self.fmg.assign_cli_template_group(template_group.name, template_group.scope_member)
+    @staticmethod
+    def _object_changes(
+        kind_name: str,
+        objects: Iterable[Union[CLITemplate, CLITemplateGroup]],
+        fmg_objects: Iterable[Union[CLITemplate, CLITemplateGroup]],
+    ) -> List[ObjectChange]:
+        """Compare objects with their FMG counterpart
+
+        Args:
+            kind_name: FMG name of the object kind
+            objects: objects to update
+            fmg_objects: objects of the same kind loaded from FMG
+
+        Returns:
+            changes of the objects
+        """
+        fmg_index = {fmg_obj.name: fmg_obj for fmg_obj in fmg_objects}
+        changes = []
+        for obj in objects:
+            fmg_obj = fmg_index.get(obj.name)
+            needs_set = fmg_obj is None or bool(set(changed_fields(obj, fmg_obj)) - {"scope_member"})
+            changes.append(ObjectChange(kind_name, obj, needs_set, *scope_delta(obj, fmg_obj)))
+        return changes
+
+    @staticmethod
+    def _log_test_updates(to_set_vars: List[Variable], fmg_variables: Dict[str, Variable], changes: List[ObjectChange]):
+        for variable in to_set_vars:
+            action = "Updating" if variable.name in fmg_variables else "Adding"
+            logger.info("TEST - %s variable '%s'", action, variable.name)
+        for change in changes:
+            if change.needs_set:
+                logger.info("TEST - Updating %s '%s'", change.kind_name.replace(" ", "_"), change.obj.name)
+            if change.to_assign:
+                logger.info("TEST - Assigning %s '%s' to %s", change.kind_name, change.obj.name, change.to_assign)
+            if change.to_unassign:
+                logger.info("TEST - Unassigning %s '%s' from %s", change.kind_name, change.obj.name, change.to_unassign)
+
+    def _variable_nodes(self, to_set_vars: List[Variable]) -> List[ApplyNode]:
+        return [
+            ApplyNode(
+                key=("variable", variable.name),
+                operation=self.fmg.set_fmg_variable_operation(**variable.model_dump(by_alias=True)),
+            )
+            for variable in to_set_vars
+        ]
+
+    @staticmethod
+    def _variable_dependencies(
+        obj: Union[CLITemplate, CLITemplateGroup], added_vars: Set[str]
+    ) -> List[Tuple[str, str]]:
+        return [("variable", variable.name) for variable in obj.variables or [] if variable.name in added_vars]
+
+    def _template_nodes(self, changes: List[ObjectChange], added_vars: Set[str]) -> List[ApplyNode]:
+        """Build set operations of templates, they depend on the added variables they use"""
+        return [
+            ApplyNode(
+                key=(change.kind_name, change.obj.name),
+                operation=self.fmg.set_cli_template_operation(change.obj),
+                depends_on=tuple(self._variable_dependencies(change.obj, added_vars)),
+            )
+            for change in changes
+            if change.needs_set
+        ]
+
+    def _group_nodes(
+        self, changes: List[ObjectChange], added_vars: Set[str], updated: Dict[str, Tuple[str, str]]
+    ) -> List[ApplyNode]:
+        """Build set operations of template groups, they depend on the added variables and the updated members
+
+        Args:
+            changes: template group changes
+            added_vars: names of the variables to set
+            updated: node keys of the objects to set by name
+        """
+        nodes = []
+        for change in changes:
+            if not change.needs_set:
+                continue
+            group = change.obj
+            depends_on = self._variable_dependencies(group, added_vars)
+            depends_on.extend(updated[member] for member in group.member or [] if member in updated)
+            nodes.append(
+                ApplyNode(
+                    key=(change.kind_name, group.name),
+                    operation=self.fmg.set_cli_template_group_operation(
+                        **group.model_dump(by_alias=True, exclude={"fingerprint"})
+                    ),
+                    depends_on=tuple(depends_on),
+                )
+            )
+        return nodes
+
+    def _assignment_nodes(self, changes: List[ObjectChange]) -> List[ApplyNode]:
+        """Build scope assignment and unassignment operations
+
+        Assignments depend on setting their object, unassignments can run right away.
+        """
+        operations = {
+            "template": (self.fmg.assign_cli_template_operation, self.fmg.unassign_cli_template_operation),
+            "template group": (
+                self.fmg.assign_cli_template_group_operation,
+                self.fmg.unassign_cli_template_group_operation,
+            ),
+        }
+        nodes = []
+        for change in changes:
+            build_assignment, build_unassignment = operations[change.kind_name]
+            if change.to_assign:
+                nodes.append(
+                    ApplyNode(
+                        key=(f"{change.kind_name} assignment", change.obj.name),
+                        operation=build_assignment(change.obj.name, change.to_assign),
+                        depends_on=((change.kind_name, change.obj.name),) if change.needs_set else (),
+                    )
+                )
+            if change.to_unassign:
+                nodes.append(
+                    ApplyNode(
+                        key=(f"{change.kind_name} unassignment", change.obj.name),
+                        operation=build_unassignment(change.obj.name, change.to_unassign),
+                    )
+                )
+        return nodes
+
+    def _record_update_result(self, result: ApplyResult, templates: TemplateTree) -> bool:
+        """Log errors and collect objects which couldn't be updated in `failed_objects`
+
+        Returns:
+            True if anything was changed
+        """
+        variable_registry = templates.variable_registry
+        for (kind_name, name), error in result.failed.items():
+            if kind_name == "variable":
+                logger.error("Error adding variable '%s': %s", name, error)
+                self.failed_objects.update(variable_registry.sources(name))
+            elif kind_name.endswith("unassignment"):
+                logger.error("Error unassigning %s '%s': %s", kind_name.replace(" unassignment", ""), name, error)
+                self.failed_objects.add(name)
+            elif kind_name.endswith("assignment"):
+                logger.error("Error assigning %s '%s': %s", kind_name.replace(" assignment", ""), name, error)
+                self.failed_objects.add(name)
             else:
-                logger.info("TEST - Updating template_group '%s'", template_group.name)
-            had_changed = True
-        return had_changed
+                logger.error("Error updating %s '%s': %s", kind_name, name, error)
+                self.failed_objects.add(name)
+        self.failed_objects.update(name for _, name in result.cancelled)
+        return bool(result.succeeded)
+
+
+def parse_template_entry(name: str, data: str) -> Dict[str, Any]:
+    """Parse template file into a compact, serializable result
+
+    This is used as parse cache entry and as the result of parsing in worker processes.
+
+    Args:
+        name: name of the template (file name without extension)
+        data: raw text of the script file
+
+    Returns:
+        template attributes except name and script
+    """
+    template = FMGSyncTask._parse_template_data(name=name, data=data)
+    return {
+        "description": template.description,
+        "variables": [variable.model_dump() for variable in template.variables],
+        "scope_member": template.scope_member,
+    }
@@ -0,0 +1,78 @@
+"""Jinja template analysis"""
+
+import hashlib
+from collections import OrderedDict
+from typing import FrozenSet, NamedTuple, Optional, Tuple
+
+from jinja2 import Environment, TemplateSyntaxError, meta, nodes
+
+
+class TemplateAnalysis(NamedTuple):
+    """Result of a template analysis
+
+    Attributes:
+        ast: parsed template or None on syntax error
+        variables: undeclared variables used by the template
+        includes: statically referenced templates in order of appearance (e.g. templates/template1.j2)
+        error: syntax error if the template couldn't be parsed
+    """
+
+    ast: Optional[nodes.Template]
+    variables: FrozenSet[str]
+    includes: Tuple[str, ...]
+    error: Optional[TemplateSyntaxError] = None
+
+
+class TemplateAnalyzer:
+    """Jinja template analysis engine
+
+    One Jinja environment is used for all templates. Results are cached by the content hash, so a template is
+    parsed only once even if it is analyzed multiple times.
+
+    Attributes:
+        environment (Environment): Jinja environment used for parsing
+        max_entries (int): maximum number of cached analyses
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        """Initialize analyzer
+
+        Args:
+            max_entries: maximum number of cached analyses, least recently used ones are evicted
+        """
+        self.environment = Environment()
+        self.max_entries = max_entries
+        self._cache: OrderedDict[str, TemplateAnalysis] = OrderedDict()
+
+    def analyze(self, content: str) -> TemplateAnalysis:
+        """Parse template and collect its variables and includes
+
+        Args:
+            content: template content
+
+        Returns:
+            analysis result, syntax errors are returned in the `error` attribute
+        """
+        key = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        analysis = self._cache.get(key)
+        if analysis is not None:
+            self._cache.move_to_end(key)
+            return analysis
+        try:
+            ast = self.environment.parse(content)
+        except TemplateSyntaxError as err:
+            analysis = TemplateAnalysis(ast=None, variables=frozenset(), includes=(), error=err)
+        else:
+            analysis = TemplateAnalysis(
+                ast=ast,
+                variables=frozenset(meta.find_undeclared_variables(ast)),
+                includes=tuple(include for include in meta.find_referenced_templates(ast) if include),
+            )
+        self._cache[key] = analysis
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return analysis
+
+
+# shared analyzer of the process
+analyzer = TemplateAnalyzer()
@@ -0,0 +1,137 @@
+"""Diff engine of template trees"""
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from pydantic import Field
+from pydantic.dataclasses import dataclass
+
+from fortimanager_template_sync.fmg_api.data import CLITemplate, CLITemplateGroup, TemplateTree
+
+# TemplateTree attributes holding FMG objects
+TREE_KINDS = ("pre_run_templates", "templates", "template_groups")
+
+
+def _empty_tree() -> TemplateTree:
+    return TemplateTree(pre_run_templates=[], templates=[], template_groups=[])
+
+
+@dataclass
+class TemplateDiff:
+    """Differences of a repository and an FMG template tree
+
+    Attributes:
+        added (TemplateTree): repository objects missing from FMG
+        modified (TemplateTree): repository objects which differ from their FMG version
+        unchanged (TemplateTree): repository objects which are the same in FMG
+        removed (TemplateTree): FMG objects missing from the repository
+        modified_fields (Dict[str, Tuple[str, ...]]): differing attributes by name of modified objects
+    """
+
+    added: TemplateTree = Field(default_factory=_empty_tree)
+    modified: TemplateTree = Field(default_factory=_empty_tree)
+    unchanged: TemplateTree = Field(default_factory=_empty_tree)
+    removed: TemplateTree = Field(default_factory=_empty_tree)
+    modified_fields: Dict[str, Tuple[str, ...]] = Field(default_factory=dict)
+
+    @property
+    def changed(self) -> TemplateTree:
+        """Get added and modified objects, these need to be uploaded to FMG"""
+        return TemplateTree(
+            **{kind: getattr(self.added, kind) + getattr(self.modified, kind) for kind in TREE_KINDS},
+        )
+
+    def __bool__(self) -> bool:
+        """Check for any difference
+
+        Returns:
+            True if there is any added, modified or removed object
+        """
+        return bool(self.added or self.modified or self.removed)
+
+
+def changed_fields(
+    repo_object: Union[CLITemplate, CLITemplateGroup], fmg_object: Union[CLITemplate, CLITemplateGroup]
+) -> Tuple[str, ...]:
+    """Compare a repository object to its FMG version
+
+    Fingerprints are compared first, normalized attributes are only compared for differing objects.
+
+    Args:
+        repo_object: template or template group from the repository
+        fmg_object: same object from FMG
+
+    Returns:
+        names of the differing attributes, empty if the objects are the same
+    """
+    if repo_object.fingerprint == fmg_object.fingerprint:
+        return ()
+    repo_attributes = repo_object.fingerprint_attributes()
+    fmg_attributes = fmg_object.fingerprint_attributes()
+    return tuple(field for field, value in repo_attributes.items() if value != fmg_attributes.get(field))
+
+
+def _scope_key(scope: Dict[str, str]) -> Tuple[str, str]:
+    return scope.get("name", ""), scope.get("vdom") or ""
+
+
+def scope_delta(
+    repo_object: Union[CLITemplate, CLITemplateGroup], fmg_object: Optional[Union[CLITemplate, CLITemplateGroup]]
+) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+    """Compare the scope assignments of a repository object to its FMG version
+
+    Scopes are matched by name and VDOM, their order doesn't matter. Scopes are only unassigned if the repository
+    object has assignments configured, otherwise the FMG assignments are kept.
+
+    Args:
+        repo_object: template or template group from the repository
+        fmg_object: same object from FMG, None if it doesn't exist in FMG yet
+
+    Returns:
+        scopes to assign and scopes to unassign
+    """
+    current = {_scope_key(scope): scope for scope in (fmg_object.scope_member if fmg_object else None) or []}
+    wanted = {_scope_key(scope): scope for scope in repo_object.scope_member or []}
+    to_unassign = []
+    if repo_object.scope_member is not None:
+        to_unassign = [scope for key, scope in current.items() if key not in wanted]
+    return [scope for key, scope in wanted.items() if key not in current], to_unassign
+
+
+def _index(objects: Iterable[Union[CLITemplate, CLITemplateGroup]]) -> Dict[str, Union[CLITemplate, CLITemplateGroup]]:
+    return {obj.name: obj for obj in objects}
+
+
+def diff_template_trees(repo_tree: TemplateTree, fmg_tree: TemplateTree) -> TemplateDiff:
+    """Compare repository and FMG template trees
+
+    Both trees are indexed by name once, so the comparison is linear in the number of objects. Objects are
+    compared within their kind, e.g. a pre-run template is only matched with a pre-run template.
+
+    Args:
+        repo_tree: templates and template groups from the repository
+        fmg_tree: templates and template groups from FMG
+
+    Returns:
+        change set of the trees
+    """
+    diff = TemplateDiff()
+    for kind in TREE_KINDS:
+        fmg_index = _index(getattr(fmg_tree, kind))
+        repo_names = set()
+        added: List = getattr(diff.added, kind)
+        modified: List = getattr(diff.modified, kind)
+        unchanged: List = getattr(diff.unchanged, kind)
+        for repo_object in getattr(repo_tree, kind):
+            repo_names.add(repo_object.name)
+            fmg_object = fmg_index.get(repo_object.name)
+            if fmg_object is None:
+                added.append(repo_object)
+                continue
+            fields = changed_fields(repo_object, fmg_object)
+            if fields:
+                modified.append(repo_object)
+                diff.modified_fields[repo_object.name] = fields
+            else:
+                unchanged.append(repo_object)
+        getattr(diff.removed, kind).extend(obj for name, obj in fmg_index.items() if name not in repo_names)
+    return diff
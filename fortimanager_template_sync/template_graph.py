@@ -0,0 +1,105 @@
+"""Membership graph of templates and template groups"""
+
+from collections import deque
+from typing import Dict, List, NamedTuple, Tuple, Union
+
+from fortimanager_template_sync.fmg_api.data import CLITemplate, CLITemplateGroup, TemplateTree
+from fortimanager_template_sync.template_diff import TREE_KINDS
+
+# graph node: (TemplateTree attribute, object name)
+Node = Tuple[str, str]
+
+
+class UnusedObjects(NamedTuple):
+    """Result of the unused object search
+
+    Attributes:
+        to_delete: unused objects, template groups are in safe deletion order (groups before their members)
+        keep_reasons: reason of keeping each object which is missing from the repository
+    """
+
+    to_delete: TemplateTree
+    keep_reasons: Dict[Node, str]
+
+
+class MembershipGraph:
+    """Membership graph of templates and template groups
+
+    Every template and template group is a node. Template groups have edges to their members, the reverse edges
+    point to the groups an object belongs to. Pre-run templates cannot be members of groups.
+
+    Attributes:
+        objects (Dict[Node, Union[CLITemplate, CLITemplateGroup]]): objects by node
+        members (Dict[Node, List[Node]]): member nodes of template groups
+        parents (Dict[Node, List[Node]]): template group nodes the object is member of
+    """
+
+    def __init__(self, tree: TemplateTree):
+        """Build graph
+
+        Args:
+            tree: templates and template groups
+        """
+        self.objects: Dict[Node, Union[CLITemplate, CLITemplateGroup]] = {}
+        self.members: Dict[Node, List[Node]] = {}
+        self.parents: Dict[Node, List[Node]] = {}
+        member_nodes: Dict[str, List[Node]] = {}
+        for kind in TREE_KINDS:
+            for obj in getattr(tree, kind):
+                node = (kind, obj.name)
+                self.objects[node] = obj
+                self.parents[node] = []
+                if kind != "pre_run_templates":
+                    member_nodes.setdefault(obj.name, []).append(node)
+        for group in tree.template_groups:
+            node = ("template_groups", group.name)
+            self.members[node] = [member for name in group.member or [] for member in member_nodes.get(name, [])]
+            for member in self.members[node]:
+                self.parents[member].append(node)
+
+    def find_unused(self, repo_tree: TemplateTree) -> UnusedObjects:
+        """Find objects which are not in the repository and not used
+
+        An object is unused if it is missing from the repository, it is not assigned to any device or group and
+        it is not a member of a template group which is kept. Objects are released in one topological pass: an
+        object becomes deletable when all groups it belongs to were deleted.
+
+        Args:
+            repo_tree: templates and template groups from the repository
+
+        Returns:
+            unused objects and the reasons of keeping the others
+        """
+        repo_names = {kind: {obj.name for obj in getattr(repo_tree, kind)} for kind in TREE_KINDS}
+        candidates = {
+            node for node, obj in self.objects.items() if node[1] not in repo_names[node[0]] and not obj.scope_member
+        }
+        # number of groups which still hold the object
+        holders = {node: len(parents) for node, parents in self.parents.items()}
+        queue = deque(node for node in self.objects if node in candidates and not holders[node])
+        deleted: Dict[Node, None] = {}  # ordered set
+        while queue:
+            node = queue.popleft()
+            deleted[node] = None
+            for member in self.members.get(node, []):
+                holders[member] -= 1
+                if not holders[member] and member in candidates:
+                    queue.append(member)
+
+        to_delete = TemplateTree(pre_run_templates=[], templates=[], template_groups=[])
+        for node in deleted:
+            getattr(to_delete, node[0]).append(self.objects[node])
+        keep_reasons = {}
+        for node, obj in self.objects.items():
+            if node[1] in repo_names[node[0]] or node in deleted:
+                continue
+            if obj.scope_member:
+                scopes = [
+                    f"{scope['name']}/{scope['vdom']}" if scope.get("vdom") else scope["name"]
+                    for scope in obj.scope_member
+                ]
+                keep_reasons[node] = f"assigned to {', '.join(scopes)}"
+            else:
+                groups = sorted({parent[1] for parent in self.parents[node] if parent not in deleted})
+                keep_reasons[node] = f"member of template group(s) {', '.join(groups)}"
+        return UnusedObjects(to_delete=to_delete, keep_reasons=keep_reasons)
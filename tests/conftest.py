@@ -1,10 +1,14 @@
 """Pytest setup"""
 
 from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 import dotenv
 import pytest
 import requests
+from git import Actor, Repo
+from pyfortinet import FMGResponse
+from pyfortinet.fmg_api.common import F
 
 from fortimanager_template_sync.config import FMGSyncSettings
 
@@ -38,3 +42,171 @@ def prepare_lab():
     # disable SSL warnings for testing
     # pylint: disable=no-member
     requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+
+
+@pytest.fixture
+def local_settings(tmp_path: Path) -> FMGSyncSettings:
+    """Settings with local repository in a temporary directory (no lab needed)"""
+    return FMGSyncSettings(
+        template_repo="https://example.com/templates.git",
+        template_branch="main",
+        local_repo=tmp_path / "repo",
+        fmg_url="https://fmg.example.com/",
+        fmg_user="test",
+        fmg_pass="test",
+        fmg_adom="root",
+        protected_fw_group="automation",
+    )
+
+
+class FakeFMG:
+    """In-memory FMG stand-in for offline tests, it records the called methods and arguments
+
+    Attributes:
+        templates: raw CLI template data as FMG returns it
+        template_groups: raw CLI template group data as FMG returns it
+        calls: (method, kwargs) of every call
+    """
+
+    def __init__(self, templates: Optional[List[Dict[str, Any]]] = None, template_groups=None):
+        self.templates = templates or []
+        self.template_groups = template_groups or []
+        self.calls = []
+
+    @staticmethod
+    def _select(objects: List[Dict[str, Any]], filters: Optional[F], fields: Optional[List[str]] = None):
+        if filters is not None:
+            targets = filters.targets if filters.op == "in" else [filters.targets]
+            objects = [obj for obj in objects if obj[filters.source] in targets]
+        if fields:
+            objects = [{key: value for key, value in obj.items() if key in fields} for obj in objects]
+        else:
+            objects = [dict(obj) for obj in objects]
+        return FMGResponse(data={"data": objects}, status=0, success=True)
+
+    def get_cli_templates(self, filters=None, fields=None):
+        self.calls.append(("get_cli_templates", {"filters": filters, "fields": fields}))
+        return self._select(self.templates, filters, fields)
+
+    def get_cli_template_groups(self, filters=None):
+        self.calls.append(("get_cli_template_groups", {"filters": filters}))
+        return self._select(self.template_groups, filters)
+
+    def _iter_pages(self, method: str, objects, filters=None, fields=None, page_size=1000):
+        selected = self._select(objects, filters, fields).data["data"]
+        for offset in range(0, len(selected) + 1, page_size):
+            self.calls.append((method, {"filters": filters, "fields": fields, "range": [offset, page_size]}))
+            page = selected[offset : offset + page_size]
+            yield from page
+            if len(page) < page_size:
+                return
+
+    def iter_cli_templates(self, filters=None, fields=None, page_size=1000):
+        return self._iter_pages("iter_cli_templates", self.templates, filters, fields, page_size)
+
+    def iter_cli_template_groups(self, filters=None, fields=None, page_size=1000):
+        return self._iter_pages("iter_cli_template_groups", self.template_groups, filters, fields, page_size)
+
+
+class FakeAsyncFMG(FakeFMG):
+    """In-memory stand-in of the asyncio FMG connection"""
+
+    async def get_cli_templates(self, filters=None, fields=None):
+        return super().get_cli_templates(filters=filters, fields=fields)
+
+    async def get_cli_template_groups(self, filters=None):
+        return super().get_cli_template_groups(filters=filters)
+
+    async def _aiter_pages(self, method: str, objects, filters=None, fields=None, page_size=1000):
+        for obj in self._iter_pages(method, objects, filters, fields, page_size):
+            yield obj
+
+    def iter_cli_templates(self, filters=None, fields=None, page_size=1000):
+        return self._aiter_pages("iter_cli_templates", self.templates, filters, fields, page_size)
+
+    def iter_cli_template_groups(self, filters=None, fields=None, page_size=1000):
+        return self._aiter_pages("iter_cli_template_groups", self.template_groups, filters, fields, page_size)
+
+
+class FakeDeviceFMG:
+    """In-memory FMG stand-in with device groups, all devices are in sync
+
+    Attributes:
+        groups: device group members by group name, the protected group is `automation`
+        requests: device names of every device status request
+        group_loads: number of device group loads
+    """
+
+    class Lock:
+        """Fake workspace lock in workspace mode"""
+
+        def __init__(self):
+            self.locked_adoms = set()
+
+        def __call__(self, *adoms):
+            self.locked_adoms.update(adoms)
+            return self
+
+    def __init__(self, devices, groups=None):
+        self.groups = {"automation": devices, **(groups or {})}
+        self.requests = []
+        self.group_loads = 0
+        self.adom = "root"
+        self.lock = self.Lock()
+
+    def iter_device_groups(self, page_size):
+        self.group_loads += 1
+        for name, members in self.groups.items():
+            yield {"name": name, "object member": [{"name": member, "vdom": "root"} for member in members]}
+
+    def get_devices(self, filters):
+        names = [member.targets for member in filters.members]
+        self.requests.append(names)
+        return FMGResponse(
+            data={
+                "data": [
+                    {"name": name, "conf_status": 1, "db_status": 1, "dev_status": 4, "vdom": [{"name": "root"}]}
+                    for name in names
+                ]
+            }
+        )
+
+    def set_connection_pool_size(self, size):
+        pass
+
+
+@pytest.fixture
+def fake_fmg():
+    """Factory of in-memory FMG stand-ins"""
+    return FakeFMG
+
+
+@pytest.fixture
+def fake_async_fmg():
+    """Factory of in-memory asyncio FMG stand-ins"""
+    return FakeAsyncFMG
+
+
+@pytest.fixture
+def fake_device_fmg():
+    """Factory of in-memory FMG stand-ins with device groups"""
+    return FakeDeviceFMG
+
+
+@pytest.fixture
+def commit_files():
+    """Write/delete files in a repository and commit them, returns the commit SHA"""
+
+    def commit(repo: Repo, files: Dict[str, Optional[str]], message: str) -> str:
+        for path, content in files.items():
+            file = Path(repo.working_dir) / path
+            if content is None:
+                repo.index.remove([path], working_tree=True)
+                continue
+            file.parent.mkdir(exist_ok=True)
+            file.write_text(content)
+            repo.index.add([path])
+        actor = Actor("test", "test@example.com")
+        return repo.index.commit(message, author=actor, committer=actor).hexsha
+
+    return commit
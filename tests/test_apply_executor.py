@@ -0,0 +1,92 @@
+"""Test dependency ordered change execution"""
+
+import asyncio
+
+import pytest
+from pyfortinet import FMGResponse
+
+from fortimanager_template_sync.apply_executor import ApplyExecutor, ApplyNode
+from fortimanager_template_sync.exceptions import FMGSyncException
+from fortimanager_template_sync.fmg_api import BatchOperation
+
+
+class TestApplyExecutor:
+    """Test dependency aware apply executor"""
+
+    class FMG:
+        """Fake FMG executing batches"""
+
+        def __init__(self, failing=()):
+            self.failing = failing
+            self.batches = []
+
+        def execute_batch(self, operations, batch_size):
+            self.batches.append([operation.key for operation in operations])
+            return [
+                (
+                    operation,
+                    FMGResponse(
+                        data={"error": "failed"} if operation.key in self.failing else {},
+                        success=operation.key not in self.failing,
+                    ),
+                )
+                for operation in operations
+            ]
+
+    @staticmethod
+    def _node(key, method="set", depends_on=()):
+        return ApplyNode(key=key, operation=BatchOperation(key, method, {"url": key}), depends_on=depends_on)
+
+    def test_dependency_order(self):
+        fmg = self.FMG()
+        nodes = [
+            self._node("group", depends_on=("template1", "template2")),
+            self._node("template1", depends_on=("var",)),
+            self._node("template2"),
+            self._node("var"),
+            self._node("assign", method="add", depends_on=("group",)),
+        ]
+        result = ApplyExecutor(fmg, max_workers=4).run(nodes)
+        assert result.succeeded == {"group", "template1", "template2", "var", "assign"}
+        assert not result.failed and not result.cancelled
+        assert fmg.batches == [["template2", "var"], ["template1"], ["group"], ["assign"]]
+
+    def test_failure_cancels_dependants(self):
+        fmg = self.FMG(failing=("template1",))
+        nodes = [
+            self._node("template1"),
+            self._node("template2"),
+            self._node("group1", depends_on=("template1",)),
+            self._node("group2", depends_on=("group1",)),
+            self._node("group3", depends_on=("template2",)),
+        ]
+        result = ApplyExecutor(fmg, batch_size=1).run(nodes)
+        assert result.succeeded == {"template2", "group3"}
+        assert result.failed == {"template1": "failed"}
+        assert result.cancelled == {"group1", "group2"}
+
+    def test_run_async(self):
+        class AsyncFMG(self.FMG):
+            async def execute_batch(self, operations, batch_size):
+                return TestApplyExecutor.FMG.execute_batch(self, operations, batch_size)
+
+        fmg = AsyncFMG(failing=("template1",))
+        nodes = [
+            self._node("template1", depends_on=("var",)),
+            self._node("template2", depends_on=("var",)),
+            self._node("var"),
+            self._node("group", depends_on=("template1", "template2")),
+            self._node("assign", method="add", depends_on=("template2",)),
+        ]
+        result = asyncio.run(ApplyExecutor(fmg, max_workers=4).run_async(nodes))
+        assert fmg.batches == [["var"], ["template1", "template2"], ["assign"]]
+        assert result.succeeded == {"var", "template2", "assign"}
+        assert result.failed == {"template1": "failed"}
+        assert result.cancelled == {"group"}
+
+    def test_invalid_graph(self):
+        executor = ApplyExecutor(self.FMG())
+        with pytest.raises(FMGSyncException, match="loop"):
+            executor.run([self._node("a", depends_on=("b",)), self._node("b", depends_on=("a",)), self._node("c")])
+        with pytest.raises(FMGSyncException, match="Unknown"):
+            executor.run([self._node("a", depends_on=("missing",))])
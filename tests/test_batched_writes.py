@@ -0,0 +1,254 @@
+"""Test batched FMG writes"""
+
+import inspect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import SecretStr
+from pyfortinet import FMG
+
+from fortimanager_template_sync.fmg_api import AsyncFMGSync, FMGSync
+from fortimanager_template_sync.fmg_api.data import CLITemplate, CLITemplateGroup, Variable
+from fortimanager_template_sync.sync_task import FMGSyncTask, TemplateTree
+from fortimanager_template_sync.template_diff import scope_delta
+
+
+class TestBatchedWrites:
+    """Test batched write requests"""
+
+    @staticmethod
+    def _fmg():
+        fmg = FMGSync(base_url="https://fmg.example.com/", username="test", password="test", adom="root")
+        fmg._token = SecretStr("token")
+        return fmg
+
+    def test_execute_batch(self):
+        fmg = self._fmg()
+        bodies = []
+
+        class Session:
+            @staticmethod
+            def post(url, json, **kwargs):
+                bodies.append(json)
+                statuses = [
+                    {"code": -3, "message": "Object does not exist"} if "bad" in params["url"] else {"code": 0}
+                    for params in json["params"]
+                ]
+
+                class Response:
+                    @staticmethod
+                    def json():
+                        return {"result": [{"status": status} for status in statuses]}
+
+                return Response
+
+        fmg._session = Session
+        operations = [
+            fmg.set_fmg_variable_operation(name="var1"),
+            fmg.delete_cli_template_operation(name="bad"),
+            fmg.delete_cli_template_operation(name="template1"),
+            fmg.delete_cli_template_operation(name="template2"),
+            fmg.set_fmg_variable_operation(name="var2"),
+        ]
+        results = fmg.execute_batch(operations, batch_size=2)
+        assert [body["method"] for body in bodies] == ["set", "delete", "delete", "set"]
+        assert [len(body["params"]) for body in bodies] == [1, 2, 1, 1]
+        assert "data" not in bodies[1]["params"][0]
+        assert [(operation.key, response.success) for operation, response in results] == [
+            ("var1", True),
+            ("bad", False),
+            ("template1", True),
+            ("template2", True),
+            ("var2", True),
+        ]
+        assert results[1][1].data == {"error": "Object does not exist"}
+
+    @staticmethod
+    def _expiring_fmg(monkeypatch, delays=None):
+        """FMG with an expired session, requests of the threads are delayed until the given events"""
+        fmg = TestBatchedWrites._fmg()
+        logins = []
+
+        def login(self):
+            time.sleep(0.1)
+            logins.append(1)
+            return SecretStr(f"token{len(logins)}")
+
+        class Session:
+            @staticmethod
+            def post(url, json, **kwargs):
+                event = (delays or {}).get(threading.current_thread().name)
+                if event:
+                    event.wait(5)
+                valid = json["session"] == f"token{len(logins)}"
+                status = {"code": 0} if valid else {"code": -11, "message": "No permission for the resource"}
+
+                class Response:
+                    @staticmethod
+                    def json():
+                        return {"result": [{"status": status}]}
+
+                return Response
+
+        monkeypatch.setattr(FMG, "_get_token", login)
+        fmg._session = Session
+        return fmg, logins
+
+    def test_concurrent_token_refresh(self, monkeypatch):
+        fmg, logins = self._expiring_fmg(monkeypatch)
+        operations = [fmg.set_fmg_variable_operation(name="var1")]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: fmg.execute_batch(operations), range(4)))
+        assert len(logins) == 1
+        assert all(response.success for result in results for _, response in result)
+        assert fmg._token.get_secret_value() == "token1"
+
+    def test_token_refreshed_before_retry(self, monkeypatch):
+        refreshed = threading.Event()
+        fmg, logins = self._expiring_fmg(monkeypatch, delays={"late": refreshed})
+        operations = [fmg.set_fmg_variable_operation(name="var1")]
+
+        def late_request():
+            # fails with the expired token after the other thread already logged in
+            late_results.extend(fmg.execute_batch(operations))
+
+        late_results = []
+        late = threading.Thread(target=late_request, name="late")
+        late.start()
+        time.sleep(0.05)  # the late request is sent with the expired token
+        assert fmg.execute_batch(operations)[0][1].success
+        refreshed.set()
+        late.join()
+        assert late_results[0][1].success
+        assert len(logins) == 1
+
+    def test_set_cli_template_operation(self):
+        template = CLITemplate(name="template1", script="{{ var1 }}", variables=[Variable(name="var1")])
+        operation = self._fmg().set_cli_template_operation(template, new_name="template2")
+        assert operation.key == "template1" and operation.method == "set"
+        assert operation.request["url"] == "/pm/config/adom/root/obj/cli/template/template1"
+        assert operation.request["data"] == {
+            "description": "",
+            "name": "template2",
+            "provision": "disable",
+            "script": "{{ var1 }}",
+            "type": "jinja",
+            "variables": ["var1"],
+        }
+
+    def test_shared_set_cli_template_signature(self):
+        assert (
+            inspect.signature(AsyncFMGSync.set_cli_template).parameters
+            == inspect.signature(FMGSync.set_cli_template).parameters
+        )
+
+    def test_update_fmg_templates(self, local_settings):
+        local_settings.prod_run = True
+        fmg = self._fmg()
+        posted = []
+
+        def post_batch(method, params):
+            posted.append((method, [request["url"].rsplit("/", 2)[-2:] for request in params]))
+            return [
+                {"code": -1, "message": "error"} if "template2" in request["url"] else {"code": 0} for request in params
+            ]
+
+        fmg._post_batch = post_batch
+        fmg.iter_fmg_variables = lambda page_size: iter([{"name": "var2", "value": "default"}])
+        task = FMGSyncTask(settings=local_settings, fmg=fmg)
+        templates = TemplateTree(
+            pre_run_templates=[],
+            templates=[
+                CLITemplate(name="template1", scope_member=[{"name": "fw1", "vdom": "root"}]),
+                CLITemplate(name="template2", variables=[Variable(name="var1")], scope_member=[{"name": "fw1"}]),
+            ],
+            template_groups=[CLITemplateGroup(name="group1", member=["template1"])],
+        )
+        fmg_templates = TemplateTree(pre_run_templates=[], templates=[], template_groups=[])
+        assert task._update_fmg_templates(templates, fmg_templates) is True
+        # independent objects are sent together, dependants follow their dependencies
+        assert posted == [
+            ("set", [["fmg", "variable"], ["template", "template1"]]),
+            ("set", [["template", "template2"], ["cli", "template-group"]]),
+            ("add", [["template1", "scope member"]]),
+        ]
+        # only the successfully updated template is assigned
+        assert task.failed_objects == {"template2"}
+
+    def test_update_scope_delta(self, local_settings):
+        local_settings.prod_run = True
+        fmg = self._fmg()
+        posted = []
+
+        def post_batch(method, params):
+            posted.append((method, [(request["url"].rsplit("/", 2)[-2], request.get("data")) for request in params]))
+            return [{"code": 0} for _ in params]
+
+        fmg._post_batch = post_batch
+        task = FMGSyncTask(settings=local_settings, fmg=fmg)
+        fmg_templates = TemplateTree(
+            pre_run_templates=[],
+            templates=[
+                CLITemplate(
+                    name="template1", scope_member=[{"name": "fw1", "vdom": "root"}, {"name": "fw2", "vdom": "root"}]
+                )
+            ],
+            template_groups=[CLITemplateGroup(name="group1", member=["template1"], scope_member=[{"name": "grp"}])],
+        )
+        repo_templates = TemplateTree(
+            pre_run_templates=[],
+            templates=[
+                CLITemplate(
+                    name="template1", scope_member=[{"name": "fw3", "vdom": "root"}, {"vdom": "root", "name": "fw1"}]
+                )
+            ],
+            template_groups=[CLITemplateGroup(name="group1", member=["template1"], scope_member=[{"name": "grp"}])],
+        )
+        templates = task._changed_templates(repo_templates, fmg_templates)
+        assert task._update_fmg_templates(templates, fmg_templates) is True
+        # only the scope differs: no set, the group is unchanged
+        assert sorted(posted) == [
+            ("add", [("template1", [{"name": "fw3", "vdom": "root"}])]),
+            ("delete", [("template1", [{"name": "fw2", "vdom": "root"}])]),
+        ]
+        assert not task.failed_objects
+
+    def test_scope_delta_without_header(self):
+        fmg_template = CLITemplate(name="template1", scope_member=[{"name": "fw1", "vdom": "root"}])
+        # no assignment in the header: FMG assignments are kept
+        assert scope_delta(CLITemplate(name="template1"), fmg_template) == ([], [])
+        assert scope_delta(CLITemplate(name="template1", scope_member=[]), fmg_template) == (
+            [],
+            [{"name": "fw1", "vdom": "root"}],
+        )
+        assert scope_delta(CLITemplateGroup(name="group1", scope_member=[{"name": "grp"}]), None) == (
+            [{"name": "grp"}],
+            [],
+        )
+
+    def test_variables_to_set(self):
+        fmg_variables = {
+            "same": Variable(name="same", description="desc", value="1"),
+            "default": Variable(name="default", description="desc", value="1"),
+            "undocumented": Variable(name="undocumented", description="desc", value="1"),
+        }
+        variables = [
+            Variable(name="same", description="desc", value="1"),
+            Variable(name="default", value="2"),
+            Variable(name="undocumented"),
+            Variable(name="new", description="new variable"),
+        ]
+        to_set = FMGSyncTask._variables_to_set(variables, fmg_variables)
+        # undefined attributes keep their FMG value
+        assert [variable.model_dump() for variable in to_set] == [
+            {"name": "default", "description": "desc", "value": "2"},
+            {"name": "new", "description": "new variable", "value": None},
+        ]
+
+    def test_scope_member_projection(self):
+        fmg = self._fmg()
+        request = fmg._cli_templates_request(fields=["name", "scope member"])
+        assert request["fields"] == ["name"]
+        assert request["option"] == "scope member"
+        assert "option" not in fmg._cli_templates_request(fields=["name"])
@@ -0,0 +1,235 @@
+"""Test deployment"""
+
+import asyncio
+
+from pyfortinet import FMGResponse
+from pyfortinet.fmg_api.common import Scope
+from pyfortinet.fmg_api.task import Task, TaskLine
+
+from fortimanager_template_sync.deploy_task import FMGDeployTask, ScopeResult
+
+
+class TestDeployVerification:
+    """Test verification of installed firewall VDOMs"""
+
+    def test_install_results(self):
+        lines = [
+            TaskLine(name="fw1", vdom="root", state="done", history=None),
+            TaskLine(name="fw1", vdom="vdom2", state=5, detail="install failed", history=None),
+            TaskLine(name="fw2", state="done", history=None),
+        ]
+        scopes = [
+            Scope(name="fw1", vdom="root"),
+            Scope(name="fw1", vdom="vdom2"),
+            Scope(name="fw2", vdom="root"),
+            Scope(name="fw3", vdom="root"),
+        ]
+        results = FMGDeployTask._install_results(scopes, lines)
+        assert [(result.install_state, result.detail) for result in results.values()] == [
+            ("done", ""),
+            ("error", "install failed"),
+            ("done", ""),
+            ("unknown", ""),
+        ]
+
+    def test_verify_deployment(self, local_settings, fake_device_fmg):
+        fmg = fake_device_fmg(["fw1", "fw2", "fw3", "fw4"])
+        vdoms = [
+            {"name": "root", "assignment info": [{"type": "cli", "status": "installed"}]},
+            {"name": "vdom2", "assignment info": [{"type": "cli", "status": "modified"}]},
+        ]
+
+        def get_devices(filters):
+            names = [member.targets for member in filters.members]
+            fmg.requests.extend(names)
+            # fw2 is not returned
+            devices = [
+                {"name": name, "conf_status": 1, "db_status": 1, "dev_status": 4, "vdom": vdoms}
+                for name in names
+                if name != "fw2"
+            ]
+            return FMGResponse(data={"data": devices})
+
+        fmg.get_devices = get_devices
+        task = FMGDeployTask(settings=local_settings, fmg=fmg)
+        results = {
+            ("fw1", "root"): ScopeResult(device="fw1", vdom="root", install_state="done"),
+            ("fw1", "vdom2"): ScopeResult(device="fw1", vdom="vdom2", install_state="done"),
+            ("fw2", "root"): ScopeResult(device="fw2", vdom="root", install_state="done"),
+        }
+        verified = task._verify_deployment(results)
+        # only the installed firewalls are queried
+        assert fmg.requests == ["fw1", "fw2"]
+        assert [result.success for result in verified.values()] == [True, False, False]
+        assert [result.modified for result in verified.values()] == [False, True, None]
+        # without install task line the template status decides
+        unknown = task._verify_deployment({("fw1", "root"): ScopeResult(device="fw1", vdom="root")})
+        assert unknown[("fw1", "root")].success
+        assert not ScopeResult(device="fw1", vdom="root", install_state="error", modified=False).success
+        table = task._format_results(verified.values()).splitlines()
+        assert table[0].split() == ["FIREWALL", "VDOM", "INSTALL", "TEMPLATES", "DETAIL"]
+        assert table[2].split() == ["fw1", "vdom2", "done", "modified"]
+
+
+class TestDeployWaves:
+    """Test wave based deployment"""
+
+    @staticmethod
+    def _task(local_settings, fake_device_fmg, failing=(), unknown=()):
+        local_settings.prod_run = True
+        task = FMGDeployTask(settings=local_settings, fmg=fake_device_fmg([]))
+        task.installs = []
+
+        def install_state(name):
+            if name in failing:
+                return "error"
+            return "unknown" if name in unknown else "done"
+
+        def install(scopes):
+            task.installs.append([scope.name for scope in scopes])
+            return {
+                (scope.name, scope.vdom): ScopeResult(
+                    device=scope.name, vdom=scope.vdom, install_state=install_state(scope.name)
+                )
+                for scope in scopes
+            }
+
+        task._install = install
+        return task
+
+    def test_waves(self, local_settings, fake_device_fmg):
+        local_settings.deploy_wave_size = 2
+        local_settings.deploy_canary_size = 1
+        local_settings.deploy_workers = 10
+        task = self._task(local_settings, fake_device_fmg)
+        scopes = [Scope(name=f"fw{index}", vdom="root") for index in range(12)]
+        waves = [[[scope.name for scope in batch] for batch in wave] for wave in task._waves(scopes)]
+        # canary first, then at most 4 concurrent install tasks
+        assert waves == [
+            [["fw0"]],
+            [["fw1", "fw2"], ["fw3", "fw4"], ["fw5", "fw6"], ["fw7", "fw8"]],
+            [["fw9", "fw10"], ["fw11"]],
+        ]
+        local_settings.deploy_wave_size = local_settings.deploy_canary_size = 0
+        assert [len(wave) for wave in task._waves(scopes)] == [1]
+
+    def test_deploy_changes(self, local_settings, fake_device_fmg):
+        local_settings.deploy_wave_size = 2
+        local_settings.deploy_workers = 2
+        task = self._task(local_settings, fake_device_fmg, failing=("fw1",))
+        results = task._deploy_changes({f"fw{index}": ["root"] for index in range(6)})
+        assert sorted(task.installs) == [["fw0", "fw1"], ["fw2", "fw3"], ["fw4", "fw5"]]
+        # concurrent install tasks share one workspace lock
+        assert task.fmg.lock.locked_adoms == {"root"}
+        assert [result.install_state for result in results.values()] == [
+            "done",
+            "error",
+            "done",
+            "done",
+            "done",
+            "done",
+        ]
+
+    def test_failure_rate_stops_deployment(self, local_settings, fake_device_fmg):
+        local_settings.deploy_wave_size = 2
+        local_settings.deploy_canary_size = 1
+        local_settings.deploy_fail_rate = 0.5
+        task = self._task(local_settings, fake_device_fmg, failing=("fw0",))
+        results = task._deploy_changes({f"fw{index}": ["root"] for index in range(4)})
+        # the failed canary stops the deployment
+        assert task.installs == [["fw0"]]
+        assert [result.install_state for result in results.values()] == ["error", "skipped", "skipped", "skipped"]
+        assert not any(result.success for result in results.values())
+
+    def test_unknown_state_is_not_failure(self, local_settings, fake_device_fmg):
+        local_settings.deploy_wave_size = 1
+        local_settings.deploy_canary_size = 1
+        local_settings.deploy_fail_rate = 0
+        task = self._task(local_settings, fake_device_fmg, unknown=("fw0",))
+        results = task._deploy_changes({f"fw{index}": ["root"] for index in range(3)})
+        # unreadable task line of the canary doesn't stop the deployment
+        assert task.installs == [["fw0"], ["fw1"], ["fw2"]]
+        assert [result.install_state for result in results.values()] == ["unknown", "done", "done"]
+
+    def test_deploy_changes_async(self, local_settings, fake_device_fmg):
+        local_settings.deploy_wave_size = 1
+        local_settings.deploy_workers = 3
+        task = self._task(local_settings, fake_device_fmg)
+        install = task._install
+
+        async def install_async(scopes):
+            return install(scopes)
+
+        async def lock(*adoms):
+            task.locked = adoms
+
+        task._install_async = install_async
+        task.fmg.lock = lock
+        results = asyncio.run(task._deploy_changes_async({"fw1": ["root", "vdom2"], "fw2": ["root"]}))
+        assert sorted(task.installs) == [["fw1"], ["fw1"], ["fw2"]]
+        assert len(results) == 3
+        assert task.locked == ("root",)
+
+    def test_failed_deployment(self, local_settings, fake_device_fmg):
+        local_settings.deploy_workers = 2
+        local_settings.deploy_wave_size = 1
+        task = self._task(local_settings, fake_device_fmg)
+        task.fmg.close = lambda: None
+        task._get_firewall_statuses = lambda group: {
+            name: {"cli_status": {"root": {"status": "modified"}}} for name in ("fw1", "fw2")
+        }
+
+        def lock(adom):
+            raise RuntimeError("Workspace is locked by other user")
+
+        task.fmg.lock = lock
+        assert task.run() is False
+
+    def test_install_task_lock(self, local_settings, fake_device_fmg):
+        local_settings.deploy_wave_size = 1
+        task = self._task(local_settings, fake_device_fmg)
+        task.fmg.get_obj = lambda cls, **kwargs: kwargs["flags"]
+        task._deploy_changes({"fw1": ["root"], "fw2": ["root"]})
+        # single install task at a time: the task locks the workspace itself
+        assert not task.fmg.lock.locked_adoms
+        assert task._install_task([Scope(name="fw1", vdom="root")]) == ["auto_lock_ws"]
+        task.fmg.lock("root")
+        assert task._install_task([Scope(name="fw1", vdom="root")]) == ["none"]
+
+    def test_install(self, local_settings, fake_device_fmg):
+        local_settings.prod_run = True
+        fmg = fake_device_fmg([])
+
+        class Result:
+            success = True
+            data = {"data": {"taskid": 42}}
+
+            @staticmethod
+            def wait_for_task(timeout, callback):
+                raise TimeoutError("Timed out waiting")
+
+        class InstallTask:
+            @staticmethod
+            def exec():
+                return Result()
+
+        fmg.adom = "root"
+        fmg.get_obj = lambda cls, **kwargs: InstallTask()
+        fmg.get = lambda cls, filters: FMGResponse(
+            data={
+                "data": [
+                    Task(
+                        adom=3,
+                        end_tm=0,
+                        flags=0,
+                        id=42,
+                        line=[TaskLine(name="fw1", vdom="root", state="done", history=None)],
+                    )
+                ]
+            }
+        )
+        results = FMGDeployTask(settings=local_settings, fmg=fmg)._install(
+            [Scope(name="fw1", vdom="root"), Scope(name="fw2", vdom="root")]
+        )
+        # lines are loaded after timeout, unfinished scopes are unknown
+        assert [result.install_state for result in results.values()] == ["done", "unknown"]
@@ -0,0 +1,127 @@
+"""Test device status collection"""
+
+import asyncio
+import time
+
+import pytest
+
+from fortimanager_template_sync import status_cache
+from fortimanager_template_sync.common_task import DEVICE_GROUP_INDEXES, STATUS_CACHES
+from fortimanager_template_sync.deploy_task import FMGDeployTask
+from fortimanager_template_sync.device_groups import DeviceGroupIndex
+from fortimanager_template_sync.exceptions import FMGSyncException
+from fortimanager_template_sync.sync_task import FMGSyncTask
+
+
+class TestFirewallStatuses:
+    """Test chunked device status collection"""
+
+    @pytest.fixture(autouse=True)
+    def clear_process_caches(self):
+        DEVICE_GROUP_INDEXES.clear()
+        STATUS_CACHES.clear()
+        yield
+        DEVICE_GROUP_INDEXES.clear()
+        STATUS_CACHES.clear()
+
+    def test_chunked_statuses(self, local_settings, fake_device_fmg):
+        local_settings.status_chunk_size = 2
+        fmg = fake_device_fmg([f"fw{index}" for index in range(5)])
+        statuses = FMGSyncTask(settings=local_settings, fmg=fmg)._get_firewall_statuses("automation")
+        assert sorted(fmg.requests) == [["fw0", "fw1"], ["fw2", "fw3"], ["fw4"]]
+        assert sorted(statuses) == [f"fw{index}" for index in range(5)]
+        assert statuses["fw4"]["conf_status"] == "insync"
+
+    def test_chunked_statuses_async(self, local_settings, fake_device_fmg):
+        class AsyncFMG(fake_device_fmg):
+            async def iter_device_groups(self, page_size):
+                for group in fake_device_fmg.iter_device_groups(self, page_size):
+                    yield group
+
+            async def get_devices(self, filters):
+                return fake_device_fmg.get_devices(self, filters)
+
+        local_settings.status_chunk_size = 3
+        fmg = AsyncFMG([f"fw{index}" for index in range(5)])
+        task = FMGSyncTask(settings=local_settings, fmg=fmg)
+        statuses = asyncio.run(task._get_firewall_statuses_async("automation"))
+        assert fmg.requests == [["fw0", "fw1", "fw2"], ["fw3", "fw4"]]
+        assert len(statuses) == 5
+
+    def test_empty_group(self, local_settings, fake_device_fmg):
+        fmg = fake_device_fmg([])
+        assert FMGSyncTask(settings=local_settings, fmg=fmg)._get_firewall_statuses("automation") == {}
+        assert not fmg.requests
+
+    def test_nested_groups(self, local_settings, fake_device_fmg):
+        fmg = fake_device_fmg(["fw1", "region1"], groups={"region1": ["fw2", "site1"], "site1": ["fw1", "fw3"]})
+        statuses = FMGSyncTask(settings=local_settings, fmg=fmg)._get_firewall_statuses("automation")
+        assert fmg.requests == [["fw1", "fw2", "fw3"]]
+        assert sorted(statuses) == ["fw1", "fw2", "fw3"]
+        # groups are loaded once per process
+        FMGSyncTask(settings=local_settings, fmg=fmg)._get_firewall_statuses("automation")
+        assert fmg.group_loads == 1
+
+    def test_status_cache(self, local_settings, monkeypatch, fake_device_fmg):
+        local_settings.status_cache_ttl = 60
+        fmg = fake_device_fmg(["fw1", "fw2"])
+        first = FMGSyncTask(settings=local_settings, fmg=fmg)._get_firewall_statuses("automation")
+        # deploy task of the same process reuses the statuses
+        deploy_task = FMGDeployTask(settings=local_settings, fmg=fmg)
+        assert deploy_task._get_firewall_statuses("automation") == first
+        assert len(fmg.requests) == 1
+        deploy_task._invalidate_firewall_statuses("automation")
+        deploy_task._get_firewall_statuses("automation")
+        assert len(fmg.requests) == 2
+        # expired
+        now = time.time()
+        monkeypatch.setattr(status_cache.time, "time", lambda: now + 61)
+        deploy_task._get_firewall_statuses("automation")
+        assert len(fmg.requests) == 3
+
+    def test_status_snapshot(self, local_settings, fake_device_fmg):
+        local_settings.status_cache_ttl = 60
+        local_settings.status_snapshot = True
+        fmg = fake_device_fmg(["fw1", "fw2"])
+        statuses = FMGSyncTask(settings=local_settings, fmg=fmg)._get_firewall_statuses("automation")
+        assert (local_settings.cache_dir / "device-status.json").is_file()
+        # another process
+        STATUS_CACHES.clear()
+        assert FMGDeployTask(settings=local_settings, fmg=fmg)._get_firewall_statuses("automation") == statuses
+        assert len(fmg.requests) == 1
+        STATUS_CACHES.clear()
+        FMGDeployTask(settings=local_settings, fmg=fmg)._invalidate_firewall_statuses("automation")
+        STATUS_CACHES.clear()
+        FMGDeployTask(settings=local_settings, fmg=fmg)._get_firewall_statuses("automation")
+        assert len(fmg.requests) == 2
+
+    def test_status_cache_disabled(self, local_settings, fake_device_fmg):
+        fmg = fake_device_fmg(["fw1"])
+        task = FMGSyncTask(settings=local_settings, fmg=fmg)
+        task._get_firewall_statuses("automation")
+        task._get_firewall_statuses("automation")
+        assert len(fmg.requests) == 2
+
+
+class TestDeviceGroupIndex:
+    """Test device group resolution"""
+
+    @staticmethod
+    def _index(groups):
+        return DeviceGroupIndex(
+            {"name": name, "object member": [{"name": member} for member in members]}
+            for name, members in groups.items()
+        )
+
+    def test_devices(self):
+        index = self._index({"all": ["group1", "fw1", "group2"], "group1": ["fw2", "fw1"], "group2": ["group1", "fw3"]})
+        assert index.devices("all") == ["fw2", "fw1", "fw3"]
+        assert index.devices("group2") == ["fw2", "fw1", "fw3"]
+        assert "group1" in index and "fw1" not in index
+
+    def test_invalid_groups(self):
+        index = self._index({"group1": ["group2"], "group2": ["fw1", "group3"], "group3": ["group1"]})
+        with pytest.raises(FMGSyncException, match="group1 -> group2 -> group3 -> group1"):
+            index.devices("group1")
+        with pytest.raises(FMGSyncException, match="doesn't exist"):
+            index.devices("missing")
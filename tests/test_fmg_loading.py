@@ -0,0 +1,129 @@
+"""Test loading FMG objects"""
+
+import asyncio
+
+from pyfortinet import FMGResponse
+
+from fortimanager_template_sync.fmg_api import FMGSync
+from fortimanager_template_sync.fmg_api.data import CLITemplate
+from fortimanager_template_sync.sync_state import ObjectState
+from fortimanager_template_sync.sync_task import FMGSyncTask, TemplateTree
+
+
+class TestFMGLoading:
+    """Test loading templates from FMG (with in-memory FMG)"""
+
+    @staticmethod
+    def _fmg_template(name: str, script: str, version: int, provision: int = 0):
+        return {
+            "name": name,
+            "description": "",
+            "provision": provision,
+            "type": 1,
+            "script": script,
+            "variables": [],
+            "obj ver": version,
+        }
+
+    def test_two_phase_load(self, local_settings, fake_fmg):
+        repo_data = TemplateTree(
+            pre_run_templates=[CLITemplate(name="pre-run1", provision="enable", script="pre")],
+            templates=[
+                CLITemplate(name="template1", script="same"),
+                CLITemplate(name="template2", script="changed in repo"),
+                CLITemplate(name="template3", script="same"),
+            ],
+            template_groups=[],
+        )
+        fmg = fake_fmg(
+            templates=[
+                self._fmg_template("pre-run1", "pre", 1, provision=1),
+                self._fmg_template("template1", "same", 2),
+                self._fmg_template("template2", "old", 3),
+                self._fmg_template("template3", "changed in FMG", 5),
+                self._fmg_template("template4", "not in repo", 1),
+            ]
+        )
+        object_states = {
+            ("pre_run_templates", "pre-run1"): ObjectState(
+                "pre_run_templates", "pre-run1", repo_data.pre_run_templates[0].fingerprint, version=1
+            ),
+            ("templates", "template1"): ObjectState("templates", "template1", repo_data.templates[0].fingerprint, 2),
+            ("templates", "template2"): ObjectState("templates", "template2", "old fingerprint", 3),
+            ("templates", "template3"): ObjectState("templates", "template3", repo_data.templates[2].fingerprint, 4),
+        }
+        task = FMGSyncTask(settings=local_settings, fmg=fmg)
+        fmg_tree = task._load_fmg_templates(repo_data=repo_data, object_states=object_states)
+        template_loads = [kwargs for method, kwargs in fmg.calls if "cli_templates" in method]
+        assert template_loads[0]["fields"] and "script" not in template_loads[0]["fields"]
+        assert "obj ver" in template_loads[0]["fields"]
+        assert len(template_loads) == 2
+        assert template_loads[1]["filters"].targets == ["template2", "template3"]
+        scripts = {template.name: template.script for template in fmg_tree.pre_run_templates + fmg_tree.templates}
+        assert scripts == {
+            "pre-run1": "pre",
+            "template1": "same",
+            "template2": "old",
+            "template3": "changed in FMG",
+            "template4": "",
+        }
+        assert FMGSyncTask._changed_templates(repo_data, fmg_tree).names == {"template2", "template3"}
+
+    def test_async_load(self, local_settings, fake_fmg, fake_async_fmg):
+        repo_data = TemplateTree(
+            pre_run_templates=[],
+            templates=[CLITemplate(name="template1", script="same"), CLITemplate(name="template2", script="new")],
+            template_groups=[],
+        )
+        templates = [self._fmg_template("template1", "same", 2), self._fmg_template("template2", "old", 3)]
+        template_groups = [
+            {"name": "group1", "description": "", "member": ["template1"], "variables": [], "obj ver": 1}
+        ]
+        object_states = {
+            ("templates", "template1"): ObjectState("templates", "template1", repo_data.templates[0].fingerprint, 2),
+        }
+        for states in ({}, object_states):
+            expected = FMGSyncTask(
+                settings=local_settings, fmg=fake_fmg(templates=templates, template_groups=template_groups)
+            )._load_fmg_templates(repo_data=repo_data, object_states=states)
+            fmg = fake_async_fmg(templates=templates, template_groups=template_groups)
+            task = FMGSyncTask(settings=local_settings, fmg=fmg)
+            fmg_tree = asyncio.run(task._load_fmg_templates_async(repo_data=repo_data, object_states=states))
+            assert fmg_tree == expected
+            assert [template.script for template in fmg_tree.templates] == ["same", "old"]
+
+    def test_single_phase_load_without_versions(self, local_settings, fake_fmg):
+        fmg = fake_fmg(templates=[self._fmg_template("template1", "script", None)])
+        repo_data = TemplateTree(pre_run_templates=[], templates=[CLITemplate(name="template1")], template_groups=[])
+        object_states = {("templates", "template1"): ObjectState("templates", "template1", "fingerprint")}
+        task = FMGSyncTask(settings=local_settings, fmg=fmg)
+        fmg_tree = task._load_fmg_templates(repo_data=repo_data, object_states=object_states)
+        assert fmg_tree.templates[0].script == "script"
+        assert [kwargs["fields"] for method, kwargs in fmg.calls if "cli_templates" in method] == [None]
+
+    def test_paged_load(self, local_settings, fake_fmg):
+        local_settings.fmg_page_size = 2
+        fmg = fake_fmg(
+            templates=[self._fmg_template(f"template{i}", "", i, provision=i % 2) for i in range(5)],
+            template_groups=[{"name": "group1", "description": "", "member": ["template1"], "variables": []}],
+        )
+        fmg_tree = FMGSyncTask(settings=local_settings, fmg=fmg)._load_fmg_templates()
+        assert [template.name for template in fmg_tree.templates] == ["template0", "template2", "template4"]
+        assert [template.name for template in fmg_tree.pre_run_templates] == ["template1", "template3"]
+        assert fmg_tree.template_groups[0].member == ["template1"]
+        ranges = [kwargs["range"] for method, kwargs in fmg.calls if method == "iter_cli_templates"]
+        assert ranges == [[0, 2], [2, 2], [4, 2]]
+
+    def test_iter_pages(self):
+        fmg = FMGSync(base_url="https://fmg.example.com/", username="test", password="test", adom="root")
+        requests = []
+
+        def get(request):
+            requests.append(request)
+            offset, limit = request["range"]
+            return FMGResponse(data={"data": [{"name": f"obj{i}"} for i in range(offset, min(offset + limit, 5))]})
+
+        fmg.get = get
+        assert [obj["name"] for obj in fmg.iter_fmg_variables(page_size=5)] == [f"obj{i}" for i in range(5)]
+        assert [request["range"] for request in requests] == [[0, 5], [5, 5]]
+        assert requests[0]["url"] == "/pm/config/adom/root/obj/fmg/variable"
@@ -4,8 +4,9 @@ import pytest
 
 from fortimanager_template_sync.exceptions import FMGSyncInvalidStatusException, FMGSyncVariableException
 from fortimanager_template_sync.fmg_api.data import CLITemplate, CLITemplateGroup, Variable
-from fortimanager_template_sync.misc import sanitize_variables
+from fortimanager_template_sync.misc import VariableRegistry, sanitize_variables
 from fortimanager_template_sync.sync_task import FMGSyncTask, TemplateTree
+from fortimanager_template_sync.template_graph import MembershipGraph
 
 
 class TestHelpers:
@@ -93,6 +94,46 @@ class TestHelpers:
             ]
         )
 
+    def test_unused_deletion_order(self):
+        fmg_tree = TemplateTree(
+            pre_run_templates=[],
+            templates=[CLITemplate(name="template1"), CLITemplate(name="template2")],
+            template_groups=[
+                CLITemplateGroup(name="inner", member=["template1"]),
+                CLITemplateGroup(name="middle", member=["inner", "template1"]),
+                CLITemplateGroup(name="outer", member=["middle"]),
+                CLITemplateGroup(name="loop1", member=["loop2"]),
+                CLITemplateGroup(name="loop2", member=["loop1", "template2"]),
+            ],
+        )
+        repo_tree = TemplateTree(pre_run_templates=[], templates=[], template_groups=[])
+        unused = MembershipGraph(fmg_tree).find_unused(repo_tree)
+        assert [group.name for group in unused.to_delete.template_groups] == ["outer", "middle", "inner"]
+        assert [template.name for template in unused.to_delete.templates] == ["template1"]
+        assert unused.keep_reasons == {
+            ("templates", "template2"): "member of template group(s) loop2",
+            ("template_groups", "loop1"): "member of template group(s) loop2",
+            ("template_groups", "loop2"): "member of template group(s) loop1",
+        }
+
+    def test_unused_keep_reasons(self):
+        fmg_tree = TemplateTree(
+            pre_run_templates=[CLITemplate(name="pre-run1", scope_member=[{"name": "fw1", "vdom": "root"}])],
+            templates=[CLITemplate(name="template1"), CLITemplate(name="template2")],
+            template_groups=[
+                CLITemplateGroup(name="group1", member=["template1"]),
+                CLITemplateGroup(name="group2", member=["group1"], scope_member=[{"name": "devgroup1"}]),
+            ],
+        )
+        repo_tree = TemplateTree(pre_run_templates=[], templates=[], template_groups=[CLITemplateGroup(name="group1")])
+        unused = MembershipGraph(fmg_tree).find_unused(repo_tree)
+        assert unused.to_delete.names == {"template2"}
+        assert unused.keep_reasons == {
+            ("pre_run_templates", "pre-run1"): "assigned to fw1/root",
+            ("templates", "template1"): "member of template group(s) group1",
+            ("template_groups", "group2"): "assigned to devgroup1",
+        }
+
     def test_sanitize_good_vars(self):
         """Test sanitize_variables with same default values"""
         variables = [
@@ -121,3 +162,23 @@ class TestHelpers:
             templates=[CLITemplate(name="template1", variables=[Variable(name="var2")])],
         )
         assert all([var in tree.variables for var in [Variable(name="var1"), Variable(name="var2")]])
+
+    def test_variable_registry(self):
+        registry = VariableRegistry([Variable(name="var1", value="1")], source="template1")
+        registry.add(Variable(name="var1", value="1", description="Ignored description"), source="template2")
+        registry.add(Variable(name="var2"), source="template2")
+        assert "var1" in registry and Variable(name="var2") in registry and "var3" not in registry
+        assert registry["var1"].value == "1"
+        assert registry.sources("var1") == ["template1", "template2"]
+        assert [var.name for var in registry] == ["var1", "var2"]
+        with pytest.raises(FMGSyncVariableException, match="template1, template2 vs. template3"):
+            registry.add(Variable(name="var1", value="2"), source="template3")
+
+    def test_template_tree_variable_registry(self):
+        tree = TemplateTree(
+            template_groups=[],
+            pre_run_templates=[],
+            templates=[CLITemplate(name="template1", variables=[Variable(name="var1")])],
+        )
+        assert tree.variable_registry is tree.variable_registry
+        assert tree.variable_registry.sources("var1") == ["template1"]
@@ -0,0 +1,314 @@
+"""Test incremental sync and sync state"""
+
+import shutil
+
+from git import Repo
+
+from fortimanager_template_sync.fmg_api.data import CLITemplate, CLITemplateGroup, RepoChanges
+from fortimanager_template_sync.sync_state import ObjectState, SyncState
+from fortimanager_template_sync.sync_task import FMGSyncTask, SyncPlan, TemplateTree
+
+
+class TestIncrementalSync:
+    """Test incremental sync helpers"""
+
+    def test_sync_state(self, tmp_path):
+        with SyncState(tmp_path / "state.sqlite") as state:
+            assert state.last_commit("root") is None
+            state.set_last_commit("root", "abc")
+            state.set_last_commit("root", "def")
+        with SyncState(tmp_path / "state.sqlite") as state:
+            assert state.last_commit("root") == "def"
+            assert state.last_commit("other") is None
+
+    def test_object_state(self, tmp_path):
+        with SyncState(tmp_path / "state.sqlite") as state:
+            state.record_objects(
+                "root",
+                [
+                    ObjectState(kind="templates", name="template1", fingerprint="a", version=3, commit="abc"),
+                    ObjectState(kind="template_groups", name="group1", fingerprint="b"),
+                ],
+            )
+            state.record_objects("root", [ObjectState(kind="templates", name="template1", fingerprint="c")])
+            state.record_objects("other", [ObjectState(kind="templates", name="template2", fingerprint="d")])
+            state.forget_objects("root", [("template_groups", "group1")])
+        with SyncState(tmp_path / "state.sqlite") as state:
+            states = state.object_states("root")
+        assert list(states) == [("templates", "template1")]
+        assert states[("templates", "template1")].fingerprint == "c"
+        assert states[("templates", "template1")].version is None
+        assert states[("templates", "template1")].updated > 0
+
+    def test_select_stale_objects(self):
+        template1 = CLITemplate(name="template1", script="same")
+        template2 = CLITemplate(name="template2", script="changed")
+        template3 = CLITemplate(name="template3", script="old state")
+        repo_tree = TemplateTree(
+            pre_run_templates=[],
+            templates=[template1, template2, template3, CLITemplate(name="template4")],
+            template_groups=[],
+        )
+        object_states = {
+            ("templates", "template1"): ObjectState("templates", "template1", template1.fingerprint, updated=1000),
+            ("templates", "template2"): ObjectState("templates", "template2", "other", updated=1000),
+            ("templates", "template3"): ObjectState("templates", "template3", template3.fingerprint, updated=10),
+        }
+        selected = FMGSyncTask._select_stale_objects(repo_tree, object_states, ttl=100, now=1050)
+        assert selected.names == {"template2", "template3", "template4"}
+
+    def test_applied_object_states(self):
+        repo_tree = TemplateTree(
+            pre_run_templates=[CLITemplate(name="pre-run1", provision="enable")],
+            templates=[CLITemplate(name="template1", script="new"), CLITemplate(name="template2")],
+            template_groups=[CLITemplateGroup(name="group1")],
+        )
+        fmg_tree = TemplateTree(
+            pre_run_templates=[CLITemplate(name="pre-run1", provision="enable", version=5)],
+            templates=[CLITemplate(name="template1", script="old", version=7)],
+            template_groups=[],
+        )
+        states = {
+            (state.kind, state.name): state
+            for state in FMGSyncTask._applied_object_states(repo_tree, fmg_tree, "abc", failed={"template2"})
+        }
+        assert set(states) == {
+            ("pre_run_templates", "pre-run1"),
+            ("templates", "template1"),
+            ("template_groups", "group1"),
+        }
+        assert states[("pre_run_templates", "pre-run1")].version == 5
+        assert states[("templates", "template1")].version is None
+        assert states[("templates", "template1")].fingerprint == repo_tree.templates[0].fingerprint
+        assert all(state.commit == "abc" for state in states.values())
+        # versions after the sync are recorded for all applied objects
+        versions = {("pre_run_templates", "pre-run1"): 6, ("templates", "template1"): 8}
+        states = {
+            (state.kind, state.name): state.version
+            for state in FMGSyncTask._applied_object_states(repo_tree, fmg_tree, "abc", {"template2"}, versions)
+        }
+        assert states == {
+            ("pre_run_templates", "pre-run1"): 6,
+            ("templates", "template1"): 8,
+            ("template_groups", "group1"): None,
+        }
+
+    def test_get_repo_changes(self, tmp_path, commit_files):
+        repo = Repo.init(tmp_path / "repo")
+        first_commit = commit_files(
+            repo,
+            {
+                "templates/template1.j2": "1",
+                "templates/template2.j2": "2",
+                "pre-run/pre1.j2": "1",
+                "README.md": "readme",
+            },
+            "initial",
+        )
+        commit_files(
+            repo,
+            {
+                "templates/template1.j2": "1 modified",
+                "templates/template2.j2": None,
+                "template-groups/group1.j2": '{% include "templates/template1.j2" %}',
+                "README.md": "readme modified",
+            },
+            "changes",
+        )
+        changes = FMGSyncTask._get_repo_changes(repo, first_commit)
+        assert changes.changed == {"pre-run": set(), "templates": {"template1"}, "template-groups": {"group1"}}
+        assert changes.deleted == {"pre-run": set(), "templates": {"template2"}, "template-groups": set()}
+        assert FMGSyncTask._get_repo_changes(repo, None) is None
+        assert FMGSyncTask._get_repo_changes(repo, "0" * 40) is None
+
+    def test_test_run_keeps_no_state(self, local_settings, monkeypatch, commit_files):
+        repo = Repo.init(local_settings.local_repo)
+        monkeypatch.setattr(FMGSyncTask, "_update_local_repository", lambda self: repo)
+        commit_files(repo, {"templates/template1.j2": "1"}, "initial")
+        task = FMGSyncTask(settings=local_settings)
+        assert task._plan_run().object_states == {}
+        assert not task._sync_state_path.exists()
+
+    def test_failed_objects_retried(self, local_settings, monkeypatch, commit_files):
+        local_settings.incremental_sync = True
+        repo = Repo.init(local_settings.local_repo)
+        monkeypatch.setattr(FMGSyncTask, "_update_local_repository", lambda self: repo)
+        first_commit = commit_files(repo, {"templates/template1.j2": "1", "templates/template2.j2": "2"}, "initial")
+        task = FMGSyncTask(settings=local_settings)
+        fmg_tree = TemplateTree(pre_run_templates=[], templates=[], template_groups=[])
+        task._record_run(first_commit, task._plan_run().repo_data, fmg_tree, None)
+        commit_files(repo, {"templates/template1.j2": "1 modified", "templates/template2.j2": "2 modified"}, "changes")
+        # first run: template2 couldn't be updated
+        plan = task._plan_run()
+        assert plan.repo_changes.changed["templates"] == {"template1", "template2"}
+        task.failed_objects = {"template2"}
+        task._record_run(plan.head_commit, plan.repo_data, fmg_tree, None)
+        # second run: template2 is compared again
+        plan = task._plan_run()
+        assert "template2" in plan.repo_changes.changed["templates"]
+        task.failed_objects = set()
+        task._record_run(plan.head_commit, plan.repo_data, fmg_tree, None)
+        assert task._plan_run() is True
+
+    def test_failed_objects_not_skipped(self, local_settings, monkeypatch, commit_files):
+        local_settings.incremental_sync = True
+        repo = Repo.init(local_settings.local_repo)
+        monkeypatch.setattr(FMGSyncTask, "_update_local_repository", lambda self: repo)
+        commit = commit_files(repo, {"templates/template1.j2": "1", "templates/template2.j2": "2"}, "initial")
+        task = FMGSyncTask(settings=local_settings)
+        fmg_tree = TemplateTree(pre_run_templates=[], templates=[], template_groups=[])
+        versions = {("templates", "template1"): 1, ("templates", "template2"): 1}
+        task._record_run(commit, task._plan_run().repo_data, fmg_tree, None, versions)
+        # template2 changed in FMG, the run couldn't restore it
+        moved_versions = {("templates", "template1"): 1, ("templates", "template2"): 2}
+        plan = task._plan_run()
+        assert task._moved_objects(plan.fmg_versions, moved_versions) == {"template2"}
+        task.failed_objects = {"template2"}
+        task._record_run(plan.head_commit, plan.repo_data, fmg_tree, None, moved_versions)
+        # next run must not be skipped
+        plan = task._plan_run()
+        assert plan.fmg_versions == versions
+        assert not task._is_unchanged(plan, task._moved_objects(plan.fmg_versions, moved_versions))
+        with task._open_sync_state() as state:
+            assert ("templates", "template2") not in state.object_states("root")
+
+    def test_select_changed_objects(self):
+        repo_tree = TemplateTree(
+            pre_run_templates=[CLITemplate(name="pre1")],
+            templates=[CLITemplate(name="template1"), CLITemplate(name="template2")],
+            template_groups=[
+                CLITemplateGroup(name="group1", member=["template1"]),
+                CLITemplateGroup(name="group2", member=["template2"]),
+                CLITemplateGroup(name="group3"),
+            ],
+        )
+        changes = RepoChanges(
+            changed={"pre-run": set(), "templates": {"template1"}, "template-groups": {"group3"}},
+            deleted={"pre-run": set(), "templates": set(), "template-groups": set()},
+        )
+        selected = FMGSyncTask._select_changed_objects(repo_tree, changes)
+        assert selected.names == {"template1", "group1", "group3"}
+
+    def test_select_changed_nested_groups(self):
+        repo_tree = TemplateTree(
+            pre_run_templates=[],
+            templates=[CLITemplate(name="template1")],
+            template_groups=[
+                CLITemplateGroup(name="group1", member=["template1"]),
+                CLITemplateGroup(name="outer", member=["group1"]),
+                CLITemplateGroup(name="unrelated"),
+            ],
+        )
+        changes = RepoChanges(
+            changed={"pre-run": set(), "templates": {"template1"}, "template-groups": set()},
+            deleted={"pre-run": set(), "templates": set(), "template-groups": set()},
+        )
+        selected = FMGSyncTask._select_changed_objects(repo_tree, changes)
+        assert selected.names == {"template1", "group1", "outer"}
+
+    def test_fmg_versions(self, tmp_path):
+        with SyncState(tmp_path / "state.sqlite") as state:
+            assert state.fmg_versions("root") == {}
+            state.record_fmg_versions("root", {("templates", "template1"): 1, ("template_groups", "group1"): 2})
+            state.record_fmg_versions("root", {("templates", "template1"): 3})
+            state.record_fmg_versions("other", {("templates", "template2"): 1})
+        with SyncState(tmp_path / "state.sqlite") as state:
+            assert state.fmg_versions("root") == {("templates", "template1"): 3}
+
+    def test_load_fmg_versions(self, local_settings, fake_fmg):
+        fmg = fake_fmg(
+            templates=[
+                {"name": "pre1", "provision": 1, "script": "x", "obj ver": 1},
+                {"name": "template1", "provision": 0, "script": "y", "obj ver": 2},
+            ],
+            template_groups=[{"name": "group1", "member": ["template1"], "obj ver": 3}],
+        )
+        versions = FMGSyncTask(settings=local_settings, fmg=fmg)._load_fmg_versions()
+        assert versions == {
+            ("pre_run_templates", "pre1"): 1,
+            ("templates", "template1"): 2,
+            ("template_groups", "group1"): 3,
+        }
+        # only names and versions are loaded
+        assert all(kwargs["fields"] for _, kwargs in fmg.calls)
+
+    def test_moved_objects(self):
+        recorded = {("templates", "template1"): 1, ("templates", "template2"): 1, ("template_groups", "group1"): 4}
+        current = {("templates", "template1"): 1, ("templates", "template2"): 2, ("templates", "template3"): 1}
+        assert FMGSyncTask._moved_objects(recorded, current) == {"template2", "template3", "group1"}
+        assert FMGSyncTask._moved_objects(recorded, dict(recorded)) == set()
+        # nothing recorded or FMG doesn't report versions
+        assert FMGSyncTask._moved_objects({}, current) is None
+        assert FMGSyncTask._moved_objects(recorded, {("templates", "template1"): None}) is None
+
+    def test_narrow_to_fmg_changes(self, local_settings):
+        local_settings.incremental_sync = True
+        repo_tree = TemplateTree(
+            pre_run_templates=[],
+            templates=[CLITemplate(name="template1"), CLITemplate(name="template2"), CLITemplate(name="template3")],
+            template_groups=[],
+        )
+        no_changes = RepoChanges(
+            changed={"pre-run": set(), "templates": set(), "template-groups": set()},
+            deleted={"pre-run": set(), "templates": set(), "template-groups": set()},
+        )
+        plan = SyncPlan(
+            head_commit="abc", repo_data=repo_tree, repo_changes=no_changes, object_states={}, fmg_versions={}
+        )
+        task = FMGSyncTask(settings=local_settings)
+        assert FMGSyncTask._is_unchanged(plan, set())
+        assert not FMGSyncTask._is_unchanged(plan, {"template2"})
+        assert not FMGSyncTask._is_unchanged(plan, None)
+        # only FMG moved: compare just the changed objects
+        repo_data, names = task._narrow_repo_data(plan, {"template2", "unknown"})
+        assert repo_data.names == {"template2"}
+        assert names == {"template2", "unknown"}
+        # unknown objects may be unused, deletion needs all objects
+        local_settings.delete_unused_templates = True
+        repo_data, names = task._narrow_repo_data(plan, {"template2", "unknown"})
+        assert names is None and repo_data.names == repo_tree.names
+        repo_data, names = task._narrow_repo_data(plan, {"template2"})
+        assert names == {"template2"}
+
+    def test_narrow_with_deletion_enabled(self, local_settings):
+        local_settings.delete_unused_templates = True
+        repo_tree = TemplateTree(
+            pre_run_templates=[],
+            templates=[CLITemplate(name="template1"), CLITemplate(name="template2")],
+            template_groups=[],
+        )
+        changes = RepoChanges(
+            changed={"pre-run": set(), "templates": {"template1"}, "template-groups": set()},
+            deleted={"pre-run": set(), "templates": set(), "template-groups": set()},
+        )
+        plan = SyncPlan(head_commit="abc", repo_data=repo_tree, repo_changes=changes, object_states={}, fmg_versions={})
+        task = FMGSyncTask(settings=local_settings)
+        # nothing was deleted from the repository: changed objects are enough
+        repo_data, names = task._narrow_repo_data(plan)
+        assert names == {"template1"} and repo_data.names == {"template1"}
+        changes.deleted["templates"].add("template3")
+        repo_data, names = task._narrow_repo_data(plan)
+        assert names is None and repo_data.names == repo_tree.names
+
+    def test_load_repository_from_git_objects(self, local_settings, commit_files):
+        repo = Repo.init(local_settings.local_repo)
+        commit = commit_files(
+            repo,
+            {
+                "templates/template1.j2": "{# Template 1\n-#}\n{{ var1 }}\n",
+                "pre-run/pre1.j2": "{{ var2 }}\n",
+                "template-groups/group1.j2": '{% include "templates/template1.j2" %}\n',
+                "docs/README.md": "readme",
+            },
+            "initial",
+        )
+        task = FMGSyncTask(settings=local_settings)
+        from_worktree = task._load_local_repository()
+        # remove working tree, data must come from the object database
+        for path in ("templates", "pre-run", "template-groups"):
+            shutil.rmtree(local_settings.local_repo / path)
+        from_git = task._load_local_repository(commit=repo.commit(commit))
+        assert from_git.templates == from_worktree.templates
+        assert from_git.pre_run_templates == from_worktree.pre_run_templates
+        assert from_git.pre_run_templates[0].provision == "enable"
+        assert from_git.template_groups[0].member == ["template1"]
@@ -0,0 +1,70 @@
+"""Test repository parse cache"""
+
+import textwrap
+
+from fortimanager_template_sync.parse_cache import ParseCache, git_blob_sha
+from fortimanager_template_sync.sync_task import FMGSyncTask
+
+
+class TestParseCache:
+    """Test parse cache"""
+
+    def test_git_blob_sha(self):
+        # same as `echo -n "test" | git hash-object --stdin`
+        assert git_blob_sha("test") == "30d74d258442c7c65512eafab474568dd706c430"
+
+    def test_eviction(self, tmp_path):
+        cache = ParseCache(path=tmp_path / "cache.json", parser_version=1, max_entries=2)
+        cache.put("template", "sha1", {"description": "1"})
+        cache.put("template", "sha2", {"description": "2"})
+        assert cache.get("template", "sha1")  # sha1 becomes the most recently used
+        cache.put("template", "sha3", {"description": "3"})
+        assert len(cache) == 2
+        assert cache.get("template", "sha2") is None
+        assert cache.get("template", "sha1") and cache.get("template", "sha3")
+
+    def test_parser_version_invalidation(self, tmp_path):
+        cache = ParseCache(path=tmp_path / "cache.json", parser_version=1)
+        cache.put("template", "sha1", {"description": "1"})
+        cache.save()
+        assert ParseCache(path=tmp_path / "cache.json", parser_version=1).get("template", "sha1")
+        assert ParseCache(path=tmp_path / "cache.json", parser_version=2).get("template", "sha1") is None
+
+    def test_save_only_changes(self, tmp_path):
+        cache = ParseCache(path=tmp_path / "cache.json", parser_version=1)
+        cache.put("template", "sha1", {"description": "1"})
+        cache.save()
+        cache = ParseCache(path=tmp_path / "cache.json", parser_version=1)
+        assert cache.get("template", "sha1")
+        (tmp_path / "cache.json").unlink()
+        cache.save()  # only hits, nothing to write
+        assert not (tmp_path / "cache.json").exists()
+        cache.put("template", "sha2", {"description": "2"})
+        cache.save()
+        assert len(ParseCache(path=tmp_path / "cache.json", parser_version=1)) == 2
+
+    def test_load_local_repository_cached(self, local_settings):
+        (local_settings.local_repo / "templates").mkdir()
+        (local_settings.local_repo / "template-groups").mkdir()
+        (local_settings.local_repo / "templates" / "template1.j2").write_text(
+            textwrap.dedent(
+                """\
+                {# Template 1
+                # assigned to: {"name": "group1"}
+                -#}
+                {{ var1 }}
+                """
+            )
+        )
+        (local_settings.local_repo / "template-groups" / "group1.j2").write_text(
+            '{% include "templates/template1.j2" %}\n'
+        )
+        task = FMGSyncTask(settings=local_settings)
+        first_run = task._load_local_repository()
+        second_run = task._load_local_repository()
+        cache = task._open_parse_cache()
+        assert len(cache) == 2
+        assert first_run.templates == second_run.templates
+        assert first_run.template_groups[0] == second_run.template_groups[0]
+        assert second_run.templates[0].scope_member == [{"name": "group1"}]
+        assert "var1" in second_run.template_groups[0].variables
@@ -0,0 +1,61 @@
+"""Test offline GIT repository loading"""
+
+from git import Repo
+
+from fortimanager_template_sync.sync_task import FMGSyncTask
+
+
+class TestRepositoryLoading:
+    """Test repository loading options"""
+
+    def test_git_clone_options(self, local_settings):
+        task = FMGSyncTask(settings=local_settings)
+        assert task._git_clone_options() == {}
+        local_settings.git_depth = 1
+        local_settings.git_filter = "blob:none"
+        local_settings.git_single_branch = True
+        assert task._git_fetch_options() == {"depth": 1, "filter": "blob:none"}
+        assert task._git_clone_options() == {"depth": 1, "filter": "blob:none", "single_branch": True}
+
+    def test_shallow_sparse_clone(self, local_settings, tmp_path, commit_files):
+        origin = Repo.init(tmp_path / "origin", initial_branch="main")
+        origin.config_writer().set_value("uploadpack", "allowFilter", "true").release()
+        for index in range(3):
+            commit_files(
+                origin,
+                {"templates/template1.j2": f"{index}\n", "pre-run/pre1.j2": "pre\n", "docs/README.md": f"{index}\n"},
+                f"commit {index}",
+            )
+        local_settings.template_repo = (tmp_path / "origin").as_uri()
+        local_settings.git_depth = 1
+        local_settings.git_single_branch = True
+        local_settings.git_filter = "blob:none"
+        local_settings.git_sparse = True
+        task = FMGSyncTask(settings=local_settings)
+        repo = task._update_local_repository()
+        assert len(list(repo.iter_commits())) == 1
+        assert sorted(path.name for path in local_settings.local_repo.iterdir() if path.name != ".git") == [
+            "pre-run",
+            "templates",
+        ]
+        assert task._load_local_repository().templates[0].script == "2\n"
+        # update by a shallow fetch
+        commit_files(origin, {"templates/template1.j2": "3\n"}, "commit 3")
+        repo = task._update_local_repository()
+        assert len(list(repo.iter_commits())) == 1
+        assert repo.head.commit.hexsha == origin.head.commit.hexsha
+        assert not (local_settings.local_repo / "docs").exists()
+
+    def test_parallel_parse(self, local_settings):
+        local_settings.parse_cache = False
+        (local_settings.local_repo / "templates").mkdir()
+        for index in range(60):
+            (local_settings.local_repo / "templates" / f"template{index}.j2").write_text(
+                f"{{# Template {index}\n-#}}\n{{{{ var{index} }}}}\n"
+            )
+        serial = FMGSyncTask(settings=local_settings)._load_local_repository()
+        local_settings.parse_workers = 2
+        parallel = FMGSyncTask(settings=local_settings)._load_local_repository()
+        assert [template.name for template in parallel.templates] == [template.name for template in serial.templates]
+        assert parallel.templates == serial.templates
+        assert parallel.templates[0].variables
@@ -0,0 +1,75 @@
+"""Test template analysis"""
+
+import pytest
+
+from fortimanager_template_sync.exceptions import FMGSyncException
+from fortimanager_template_sync.fmg_api.data import CLITemplate, CLITemplateGroup, Variable
+from fortimanager_template_sync.sync_task import FMGSyncTask
+from fortimanager_template_sync.template_analyzer import TemplateAnalyzer
+
+
+class TestTemplateAnalyzer:
+    """Test Jinja analysis engine"""
+
+    def test_analyze(self):
+        analyzer = TemplateAnalyzer()
+        content = '{% include "templates/t1.j2" %}\n{% set local = 1 %}{{ var1 }}{% include "templates/t2.j2" %}'
+        analysis = analyzer.analyze(content)
+        assert analysis.variables == {"var1"}
+        assert analysis.includes == ("templates/t1.j2", "templates/t2.j2")
+        assert analysis.error is None
+        # parsed only once
+        assert analyzer.analyze(content) is analysis
+
+    def test_syntax_error(self):
+        analysis = TemplateAnalyzer().analyze("{% if var1 %}")
+        assert analysis.error is not None
+        assert analysis.ast is None
+
+    def test_eviction(self):
+        analyzer = TemplateAnalyzer(max_entries=1)
+        analysis = analyzer.analyze("{{ var1 }}")
+        analyzer.analyze("{{ var2 }}")
+        assert analyzer.analyze("{{ var1 }}") is not analysis
+
+    def test_group_members_from_includes(self):
+        data = (
+            '{# group\n#}\n{% include "templates/t1.j2" %}\n{% include "other/x.j2" %}{% include "templates/t2.j2" %}'
+        )
+        group = FMGSyncTask._parse_template_groups_data(name="group1", data=data)
+        assert group.member == ["t1", "t2"]
+
+
+class TestGroupVariables:
+    """Test template group variable resolution"""
+
+    templates = [
+        CLITemplate(name="template1", variables=[Variable(name="var1")]),
+        CLITemplate(name="template2", variables=[Variable(name="var2")]),
+        CLITemplate(name="template3", variables=[Variable(name="var3")]),
+    ]
+
+    def test_member_variables_only(self):
+        group = FMGSyncTask._parse_template_groups_data(
+            name="group1", data='{% include "templates/template1.j2" %}', templates=self.templates
+        )
+        assert [var.name for var in group.variables] == ["var1"]
+
+    def test_nested_groups(self):
+        inner = CLITemplateGroup(name="inner", member=["template2"])
+        outer = CLITemplateGroup(name="outer", member=["template1", "inner", "missing"])
+        FMGSyncTask._resolve_group_variables([outer, inner], self.templates)
+        assert sorted(var.name for var in outer.variables) == ["var1", "var2"]
+        assert [var.name for var in inner.variables] == ["var2"]
+
+    def test_include_loop(self):
+        group1 = CLITemplateGroup(name="group1", member=["group2"])
+        group2 = CLITemplateGroup(name="group2", member=["group1"])
+        with pytest.raises(FMGSyncException, match="loop"):
+            FMGSyncTask._resolve_group_variables([group1, group2], self.templates)
+
+    def test_nested_group_members_parsed(self):
+        group = FMGSyncTask._parse_template_groups_data(
+            name="outer", data='{% include "template-groups/inner.j2" %}{% include "templates/template3.j2" %}'
+        )
+        assert group.member == ["inner", "template3"]
@@ -0,0 +1,120 @@
+"""Test template comparison"""
+
+import json
+import os
+import pickle
+import time
+
+import pytest
+
+from fortimanager_template_sync.fmg_api.data import CLITemplate, CLITemplateGroup, FingerprintModel, Variable
+from fortimanager_template_sync.sync_task import FMGSyncTask, TemplateTree
+from fortimanager_template_sync.template_diff import diff_template_trees
+
+
+class TestTemplateDiff:
+    """Test template tree diff engine"""
+
+    @staticmethod
+    def _trees(count: int):
+        repo_tree = TemplateTree(
+            pre_run_templates=[],
+            templates=[CLITemplate(name=f"template{i}", script=f"# {i}") for i in range(count)],
+            template_groups=[CLITemplateGroup(name=f"group{i}", member=[f"template{i}"]) for i in range(count)],
+        )
+        fmg_tree = TemplateTree(
+            pre_run_templates=[],
+            templates=[CLITemplate(name=f"template{i}", script=f"# {i}") for i in range(1, count + 1)],
+            template_groups=[CLITemplateGroup(name=f"group{i}", member=[f"template{i}"]) for i in range(count)],
+        )
+        return repo_tree, fmg_tree
+
+    def test_diff(self):
+        repo_tree = TemplateTree(
+            pre_run_templates=[CLITemplate(name="pre-run1", provision="enable")],
+            templates=[
+                CLITemplate(name="template1", script="new", variables=[Variable(name="var1")]),
+                CLITemplate(
+                    name="template2",
+                    variables=[Variable(name="var1"), Variable(name="var2")],
+                    scope_member=[{"name": "fw1", "vdom": "root"}, {"name": "fw2", "vdom": "root"}],
+                ),
+                CLITemplate(name="template3"),
+            ],
+            template_groups=[CLITemplateGroup(name="group1", member=["template1", "template2"])],
+        )
+        fmg_tree = TemplateTree(
+            pre_run_templates=[],
+            templates=[
+                CLITemplate(name="template1", script="old", variables=[Variable(name="var1")]),
+                CLITemplate(
+                    name="template2",
+                    variables=[Variable(name="var2"), Variable(name="var1")],
+                    scope_member=[{"name": "fw2", "vdom": "root"}, {"name": "fw1", "vdom": "root"}],
+                ),
+                CLITemplate(name="template4"),
+            ],
+            template_groups=[CLITemplateGroup(name="group1", member=["template2", "template1"])],
+        )
+        diff = diff_template_trees(repo_tree, fmg_tree)
+        assert diff.added.names == {"pre-run1", "template3"}
+        assert diff.modified.names == {"template1"}
+        assert diff.modified_fields == {"template1": ("script",)}
+        assert diff.unchanged.names == {"template2", "group1"}
+        assert diff.removed.names == {"template4"}
+        assert diff.changed.names == {"pre-run1", "template1", "template3"}
+        assert FMGSyncTask._changed_templates(repo_tree, fmg_tree).names == diff.changed.names
+
+    @pytest.mark.skipif(not os.getenv("FMGSYNC_BENCHMARK"), reason="set FMGSYNC_BENCHMARK=1 to run benchmarks")
+    def test_diff_scaling(self):
+        timings = {}
+        for count in (5000, 50000):
+            repo_tree, fmg_tree = self._trees(count)
+            start = time.perf_counter()
+            diff = diff_template_trees(repo_tree, fmg_tree)
+            timings[count] = time.perf_counter() - start
+            assert len(diff.added.templates) == len(diff.removed.templates) == 1
+            assert len(diff.unchanged.templates) == count - 1
+            assert len(diff.unchanged.template_groups) == count
+        print(f"diff timings by object count: {timings}")
+        # 10 times more objects, linear scaling gives ~10x, quadratic would be ~100x
+        assert timings[50000] / timings[5000] < 15
+
+
+class TestFingerprint:
+    """Test content fingerprints of templates and template groups"""
+
+    def test_canonical(self):
+        template1 = CLITemplate(
+            name="template1",
+            variables=[Variable(name="var1"), Variable(name="var2", value="1")],
+            scope_member=[{"name": "fw1", "vdom": "root"}, {"name": "fw2", "vdom": "root"}],
+        )
+        template2 = CLITemplate(
+            name="template1",
+            variables=[Variable(name="var2"), Variable(name="var1")],
+            scope_member=[{"vdom": "root", "name": "fw2"}, {"name": "fw1", "vdom": "root"}],
+        )
+        assert template1.fingerprint == template2.fingerprint
+        assert template1 == template2
+        assert CLITemplateGroup(name="group1") == CLITemplateGroup(name="group1", member=[], scope_member=[])
+        assert CLITemplate(name="template1") != CLITemplate(name="template1", provision="enable")
+
+    def test_invalidation(self):
+        template = CLITemplate(name="template1", script="old")
+        fingerprint = template.fingerprint
+        template.script = "new"
+        assert template.fingerprint != fingerprint
+
+    def test_export(self):
+        group = CLITemplateGroup(name="group1", member=["template2", "template1"], scope_member=[{"name": "grp"}])
+        fingerprint = group.fingerprint
+        restored = pickle.loads(pickle.dumps(group))
+        assert restored.__dict__["fingerprint"] == fingerprint
+        assert restored == group
+        assert json.loads(group.model_dump_json())["fingerprint"] == group.fingerprint
+        assert "fingerprint" not in group.model_dump(by_alias=True, exclude={"fingerprint"})
+
+    def test_abstract_base(self):
+        with pytest.raises(TypeError):
+            FingerprintModel()